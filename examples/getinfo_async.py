@@ -0,0 +1,33 @@
+#! /usr/bin/env python3
+
+# PFx Brick example script to retrieve basic information about every
+# USB connected brick concurrently from one asyncio event loop.
+
+import asyncio
+
+from pfxbrick import *
+
+
+async def brick_session(serial_no):
+    brick = AsyncPFxBrick()
+    res = await brick.open(serial_no)
+    if not res:
+        print("Unable to open session to PFx Brick %s" % (serial_no))
+        return
+    icd = await brick.get_icd_rev()
+    name = await brick.get_name()
+    await brick.get_status()
+    await brick.get_config()
+    print("PFx Brick %s ICD version %s name %s" % (serial_no, icd, name))
+    brick.print_status()
+    brick.print_config()
+    await brick.close()
+
+
+async def main():
+    bricks = find_bricks(True)
+    print("%d PFx Bricks found" % (len(bricks)))
+    await asyncio.gather(*[brick_session(b) for b in bricks])
+
+
+asyncio.run(main())
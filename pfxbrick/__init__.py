@@ -23,13 +23,33 @@ ICD_REV = '3.39'
 script_dir = os.path.dirname(__file__)
 
 from .pfx import *
+from .pfxcache import PFX_CACHE_MAX_SIZE, PFxFileCache, default_cache_dir
 from .pfxaction import PFxAction
 from .pfxconfig import PFxConfig
 from .pfxstate import PFxState
-from .pfxfiles import (PFxDir, PFxFile, fs_copy_file_from, fs_copy_file_to,
-                       fs_get_fileid_from_name, fs_remove_file)
+from .pfxfiles import (PFxDir, PFxFile, PFxSyncReport, PFxUploadPlan,
+                       fs_copy_file_from, fs_copy_file_to,
+                       fs_get_fileid_from_name, fs_plan_upload,
+                       fs_read_file_chunks, fs_remove_file, fs_sectors_for_size,
+                       fs_seek_file, fs_write_file_data)
+from .pfxtransport import (PFxTransport, PFxUSBTransport, PFxBLETransport,
+                           PFxRecordingTransport, PFxReplayTransport,
+                           PFxLogRecord, get_transport, read_session_log)
+from .pfxstats import PFxCommandStats, PFxTransportStats, icd_command_name
+from .pfxregistry import (PFX_HOTPLUG_ATTACH, PFX_HOTPLUG_DETACH,
+                          PFxBrickRegistry, PFxHotplugWatcher, PFxUSBDevice,
+                          hotplug_watcher, usb_registry)
+from .pfxfat import (PFX_FAT_REFORMAT_THRESHOLD, PFxFAT, PFxFATChain,
+                     fat_marker_dict)
+from .pfxflash import (PFX_SNAPSHOT_SAVE_INTERVAL, PFxFlashArchive,
+                       PFxFlashImage, PFxFsckReport, default_archive_dir,
+                       flash_archives, flash_size_from_product_id,
+                       save_flash_archive, snapshot_flash)
+from .pfxdiff import PFX_DIFF_BLOCK_SZ, PFxFlashDiff, diff_flash_images
 from .pfxbrick import PFxBrick, find_bricks
 from .pfxble import PFxBrickBLE, ble_device_scanner, find_ble_pfxbricks
+from .pfxasync import AsyncPFxBrick
+from .pfxemulator import PFxVirtualBrick
 from .pfxdict import *
 from .pfxexceptions import *
 from .pfxmsg import *
@@ -190,6 +190,19 @@ PFX_PFXBOT_PN = 0x2502
 PFX_PFXBOT_DESC = "PFx Bot"
 PFX_FLASH_SECTOR_SZ = 0x1000
 
+# File allocation table (FAT) stored in flash memory as one little-endian
+# 16-bit entry per sector which holds the index of the next sector of a file
+PFX_FLASH_FAT_ADDR = 0xFFC000
+PFX_FLASH_FAT_SZ = 0x2000
+PFX_FAT_SECTOR_FREE = 0xFFFF
+PFX_FAT_SECTOR_LAST = 0xFFFE
+PFX_FAT_SECTOR_RESERVED = 0xFFF3
+# other markers of sectors which are not available to files
+PFX_FAT_SECTOR_SYSTEM = 0xFFF1
+PFX_FAT_SECTOR_BAD = 0xFFF7
+# entries from this value upwards are markers rather than sector indexes
+PFX_FAT_SECTOR_MARKER = 0xFFF0
+
 # /*******************************************************************************
 #  *******************************************************************************
 #
@@ -0,0 +1,199 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2021  Fx Bricks Inc.
+# This file is part of the pfxbrick python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#
+# PFx Brick asyncio USB session helpers
+
+import asyncio
+import functools
+
+from pfxbrick import *
+from pfxbrick.pfxbrick import PFxBrick
+
+# PFxBrick methods which do not communicate with the PFx Brick and
+# therefore remain ordinary synchronous methods
+_SYNC_METHODS = [
+    "status_str",
+    "print_status",
+    "print_config",
+    "set_timeout",
+    "enable_file_cache",
+    "enable_transaction_stats",
+    "get_transaction_stats",
+    "reset_transaction_stats",
+]
+
+# PFxBrick methods which are not offered, since their effect is local to the
+# calling thread; use asyncio.wait_for to bound the time of a co-routine
+_EXCLUDED_METHODS = ["deadline"]
+
+
+class _PFxBrickLoop(PFxBrick):
+    """
+    :obj:`PFxBrick` which hands notification callbacks over to an asyncio event
+    loop rather than calling them from the USB reader thread.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+        self.owner = None
+
+    def _process_notification(self, msg):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(
+                PFxBrick._process_notification, self, list(msg)
+            )
+        else:
+            PFxBrick._process_notification(self, msg)
+
+    def _hotplug_event(self, event, serial_no):
+        # re-open and close the session from the event loop, serialized
+        # with the method calls of the owning AsyncPFxBrick
+        if (
+            self.owner is not None
+            and self.loop is not None
+            and not self.loop.is_closed()
+        ):
+            asyncio.run_coroutine_threadsafe(
+                self.owner._run(PFxBrick._hotplug_event, event, serial_no), self.loop
+            )
+        else:
+            PFxBrick._hotplug_event(self, event, serial_no)
+
+
+class AsyncPFxBrick:
+    """
+    asyncio wrapper of a USB connected :obj:`PFxBrick`.
+
+    Every :obj:`PFxBrick` method which communicates with the PFx Brick is
+    available as a co-routine with the same name and arguments, so that USB
+    and Bluetooth (:obj:`PFxBrickBLE`) PFx Bricks can be driven from the
+    same asyncio event loop.  Blocking USB I/O is run in an executor which is
+    shared between bricks (the event loop's default executor unless one is
+    specified), and calls to the same brick are serialized so that only one
+    method at a time uses its USB session.
+
+    All other attributes, e.g. ``config``, ``filedir``, ``state`` and the
+    ``callback_*`` notification callbacks, are those of the wrapped
+    :obj:`PFxBrick`.  Notification callbacks are called from the event loop
+    which opened the session.
+
+    Attributes:
+        brick (:obj:`PFxBrick`): the wrapped synchronous PFx Brick object
+
+        executor (:obj:`Executor`): optional executor used to run blocking USB I/O
+
+    :param serial_no: optional serial number to specify a particular PFx Brick if multiple connected
+    :param executor: optional :obj:`concurrent.futures.Executor` for USB I/O
+    """
+
+    def __init__(self, serial_no=None, executor=None):
+        self._brick = _PFxBrickLoop()
+        self._brick.owner = self
+        self._serial_no = serial_no
+        self._executor = executor
+        self._lock = None
+
+    @property
+    def brick(self):
+        return self._brick
+
+    @property
+    def executor(self):
+        return self._executor
+
+    def __getattr__(self, name):
+        return getattr(self._brick, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._brick, name, value)
+
+    async def _run(self, func, *args, **kwargs):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(func, self._brick, *args, **kwargs)
+            )
+
+    async def open(self, ser_no=None, transport=None, record=None):
+        """
+        Opens a USB communication session with a PFx Brick. If multiple PFx Bricks are
+        connected, then a serial number must be specified to connect to a unique PFx Brick.
+
+        :param ser_no: optional serial number to specify a particular PFx Brick if multiple connected
+        :param transport: optional :obj:`PFxTransport` to use instead of a USB connection
+        :param record: optional filename of a session log to record ICD transactions to
+        :returns: boolean indicating open session result
+        """
+        self._brick.loop = asyncio.get_running_loop()
+        if ser_no is None:
+            ser_no = self._serial_no
+        return await self._run(PFxBrick.open, ser_no, transport, record)
+
+    async def close(self):
+        """
+        Closes a USB communication session with a PFx Brick.
+        """
+        self._brick.set_auto_reopen(False)
+        await self._run(PFxBrick.close)
+
+    def set_auto_reopen(self, enable=True, watcher=None):
+        """
+        Watches the USB bus so that the session is closed when this PFx Brick
+        is detached and re-opened when it is attached again.  The session is
+        re-opened from the event loop, in turn with other method calls.
+
+        :param enable: :obj:`boolean` True to start watching, False to stop
+        :param watcher: optional :obj:`PFxHotplugWatcher`, defaults to a shared watcher thread
+        """
+        self._brick.set_auto_reopen(enable, watcher)
+
+
+def _async_method(name):
+    method = getattr(PFxBrick, name)
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        return await self._run(method, *args, **kwargs)
+
+    return wrapper
+
+
+for _name, _member in list(vars(PFxBrick).items()):
+    if (
+        callable(_member)
+        and not _name.startswith("_")
+        and _name not in _SYNC_METHODS
+        and _name not in _EXCLUDED_METHODS
+        and _name not in vars(AsyncPFxBrick)
+    ):
+        setattr(AsyncPFxBrick, _name, _async_method(_name))
+
+for _name in _SYNC_METHODS:
+    setattr(AsyncPFxBrick, _name, getattr(PFxBrick, _name))
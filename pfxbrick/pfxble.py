@@ -239,12 +239,6 @@ class PFxBrickBLE(PFxBrick):
         self.client = None
         self.is_open = False
         self.dev = None
-        self.callback_audio_done = None
-        self.callback_audio_play = None
-        self.callback_motora_stop = None
-        self.callback_motora_speed = None
-        self.callback_motorb_stop = None
-        self.callback_motorb_speed = None
         self._disconnect_flag = False
         self._rxbuff = None
         self._log = logging.getLogger(str(self.__class__))
@@ -271,6 +265,7 @@ class PFxBrickBLE(PFxBrick):
             self._log.info("Connected to PFx Brick %s" % (self.ble_address))
             await self.client.start_notify(PFX_BLE_GATT_UART_RX_UUID, self._rx_callback)
             self.dev = self
+            self.transport = PFxBLETransport(self)
             self.usb_manu_str = "Fx Bricks"
         else:
             self._log.error("Timeout connecting to %s" % (self.ble_address))
@@ -308,28 +303,19 @@ class PFxBrickBLE(PFxBrick):
             )
             raise BLEDeviceDisconnectedException()
 
-    def _process_notification(self, msg):
-        if msg[0] == PFX_MSG_NOTIFICATION:
-            if msg[1] == PFX_NOTIFICATION_AUDIO_PLAY_DONE:
-                if self.callback_audio_done is not None:
-                    fn = self.filedir.get_file_dir_entry(msg[2])
-                    self.callback_audio_done(msg[2], fn.name)
-            if msg[1] == PFX_NOTIFICATION_AUDIO_PLAY:
-                if self.callback_audio_play is not None:
-                    fn = self.filedir.get_file_dir_entry(msg[2])
-                    self.callback_audio_play(msg[2], fn.name)
-            if msg[1] == PFX_NOTIFICATION_MOTORA_CURR_SPD:
-                if self.callback_motora_speed is not None:
-                    self.callback_motora_speed(int8_toint(msg[2]))
-            if msg[1] == PFX_NOTIFICATION_MOTORA_STOP:
-                if self.callback_motora_stop is not None:
-                    self.callback_motora_stop()
-            if msg[1] == PFX_NOTIFICATION_MOTORB_CURR_SPD:
-                if self.callback_motorb_speed is not None:
-                    self.callback_motorb_speed(int8_toint(msg[2]))
-            if msg[1] == PFX_NOTIFICATION_MOTORB_STOP:
-                if self.callback_motorb_stop is not None:
-                    self.callback_motorb_stop()
+    def start_reader(self):
+        """
+        Not required over Bluetooth since every received message is already
+        processed by the BLE notification callback.
+        """
+        pass
+
+    def stop_reader(self):
+        """
+        Not required over Bluetooth since every received message is already
+        processed by the BLE notification callback.
+        """
+        pass
 
     def _rx_callback(self, sender, data):
         self._log.info("Rx Data: %s" % (data))
@@ -343,13 +329,14 @@ class PFxBrickBLE(PFxBrick):
                     self._process_notification(self._rxbuff[i : i + 3])
                     last_idx = i
 
-    async def _tx_msg(self, msg):
+    async def _tx_write(self, msg):
         self._rxbuff = []
-        msg_type = int(0x80 | msg[3])
         chunks = [msg[i : i + 20] for i in range(0, len(msg), 20)]
         for chunk in chunks:
             await self.client.write_gatt_char(PFX_BLE_GATT_UART_TX_UUID, chunk)
             self._log.info("Tx Data: %s" % (chunk))
+
+    async def _rx_wait(self, msg_type=None):
         retries = 0
         while len(self._rxbuff) == 0 and retries < MAX_RETRIES:
             await asyncio.sleep(RX_RETRY_TIME)
@@ -360,7 +347,7 @@ class PFxBrickBLE(PFxBrick):
             )
             await self.close()
             raise ResponseTimeoutException()
-        if len(self._rxbuff) > 0:
+        if len(self._rxbuff) > 0 and msg_type is not None:
             if self._rxbuff[0] != msg_type and self._rxbuff[0] != PFX_MSG_NOTIFICATION:
                 self._log.error(
                     "Invalid response from PFx Brick %s" % (self.ble_address)
@@ -368,22 +355,50 @@ class PFxBrickBLE(PFxBrick):
                 await self.close()
                 raise InvalidResponseException()
 
-    async def ble_transaction(self, msg):
+    async def _tx_msg(self, msg):
+        await self._tx_write(msg)
+        await self._rx_wait(int(0x80 | msg[3]))
+
+    def ble_wrap(self, msg):
         """
-        Wraps and sends an ICD message via Bluetooth and waits for and returns a
-        corresponding response from the PFx Brick.
+        Wraps an ICD message with the prefix/suffix delimiters required by
+        the Bluetooth UART link.
 
-        :param msg: [:obj:`int`] ICD message to send as an integeter list of bytes
-        :returns: [:obj:`int`] returned message in a byte array list
+        :param msg: [:obj:`int`] ICD message as an integer list of bytes
+        :returns: :obj:`bytearray` wrapped message
         """
         tx = bytearray()
         # wrap the message with the required prefix/suffix delimiters [[[ ]]]
         tx.extend([0x5B, 0x5B, 0x5B])
         tx.extend(msg)
         tx.extend([0x5D, 0x5D, 0x5D])
-        await self._tx_msg(tx)
+        return tx
+
+    async def ble_transaction(self, msg):
+        """
+        Wraps and sends an ICD message via Bluetooth and waits for and returns a
+        corresponding response from the PFx Brick.
+
+        :param msg: [:obj:`int`] ICD message to send as an integeter list of bytes
+        :returns: [:obj:`int`] returned message in a byte array list
+        """
+        await self._tx_msg(self.ble_wrap(msg))
         return self._rxbuff
 
+    async def ble_batch_transaction(self, msgs):
+        """
+        Sends a list of ICD messages via Bluetooth one at a time, since the
+        Bluetooth UART link only supports a single outstanding request.
+
+        :param msgs: [[:obj:`int`]] a list of ICD messages
+        :returns: [[:obj:`int`]] a list of returned messages in the same order
+        """
+        results = []
+        for msg in msgs:
+            res = await self.ble_transaction(msg)
+            results.append(res)
+        return results
+
     async def get_icd_rev(self, silent=False):
         """
         Requests the version of Interface Control Document (ICD)
@@ -514,6 +529,29 @@ class PFxBrickBLE(PFxBrick):
                 action.from_bytes(res)
             return action
 
+    async def get_actions(self, addresses):
+        """
+        Retrieves several stored actions from the event/action LUT.
+
+        :param addresses: [:obj:`int`] a list or range of event/action LUT addresses (0 - 0x7F)
+        :returns: [:obj:`PFxAction`] a list of actions in the same order as addresses
+        """
+        addresses = list(addresses)
+        for address in addresses:
+            if address > EVT_LUT_MAX:
+                self._log.warning(
+                    "Requested action at address %02X is out of range" % (address)
+                )
+                return None
+        evtchs = [address_to_evtch(address) for address in addresses]
+        actions = []
+        for res in await cmd_get_event_actions(self.dev, evtchs):
+            action = PFxAction()
+            if res:
+                action.from_bytes(res)
+            actions.append(action)
+        return actions
+
     async def set_action_by_address(self, address, action):
         """
         Sets a new stored action in the event/action LUT at the
@@ -738,12 +776,14 @@ class PFxBrickBLE(PFxBrick):
         """
         await self.test_action(PFxAction().set_volume(volume))
 
-    async def refresh_file_dir(self):
+    async def refresh_file_dir(self, fileID=None):
         """
         Reads the PFx Brick file system directory. This includes
         the total storage used as well as the remaining capacity.
         Individual file directory entries are stored in the
         :obj:`PFxBrick.filedir.files` class variable.
+
+        :param fileID: ignored, the whole directory is always read over Bluetooth
         """
         res = await cmd_get_free_space(self.dev)
         if res:
@@ -753,6 +793,7 @@ class PFxBrickBLE(PFxBrick):
         res = await cmd_get_num_files(self.dev)
         if res:
             self.filedir.files = []
+            self._file_ids.clear()
             self.filedir.numFiles = uint16_toint(res[3:5])
             file_count = 0
             for i in range(PFX_AUDIO_FILES_MAX):
@@ -774,7 +815,7 @@ class PFxBrickBLE(PFxBrick):
             "PFx Brick file system operations not supported over Bluetooth"
         )
 
-    async def get_file(self, fileID, fn=None, show_progress=True):
+    async def get_file(self, fileID, fn=None, show_progress=True, dest=None):
         """
         PFx Brick file system operations not supported over Bluetooth
         raises :obj:`NotImplementedError`
@@ -819,6 +860,65 @@ class PFxBrickBLE(PFxBrick):
             "PFx Brick file system operations not supported over Bluetooth"
         )
 
+    async def wait_file_ready(self, fileID, expected_crc=None, timeout=None):
+        """
+        PFx Brick file system operations not supported over Bluetooth
+        raises :obj:`NotImplementedError`
+        """
+        raise NotImplementedError(
+            "PFx Brick file system operations not supported over Bluetooth"
+        )
+
+    async def plan_upload(self, fns, removable=None, remove_stale=False):
+        """
+        Plans copying a set of local files to the PFx Brick from its file
+        directory and free space.  See :obj:`fs_plan_upload`.  The plan can
+        only be carried out over USB.
+
+        :param fns: [:obj:`str`] local filenames to copy
+        :param removable: optional iterable of file IDs or filenames on the PFx Brick which may be removed to make space
+        :param remove_stale: :obj:`boolean` remove every file on the PFx Brick which is not in fns
+        :returns: :obj:`PFxUploadPlan`
+        """
+        await self.refresh_file_dir()
+        return fs_plan_upload(self.filedir, fns, removable, remove_stale)
+
+    async def sync_dir(
+        self,
+        path,
+        remove_stale=False,
+        show_progress=True,
+        dry_run=False,
+        removable=None,
+    ):
+        """
+        PFx Brick file system operations not supported over Bluetooth
+        raises :obj:`NotImplementedError`
+        """
+        raise NotImplementedError(
+            "PFx Brick file system operations not supported over Bluetooth"
+        )
+
+    async def get_fat(self):
+        """
+        PFx Brick file system operations not supported over Bluetooth
+        raises :obj:`NotImplementedError`
+        """
+        raise NotImplementedError(
+            "PFx Brick file system operations not supported over Bluetooth"
+        )
+
+    async def restore_files(
+        self, source, remove_stale=False, show_progress=True, dry_run=False
+    ):
+        """
+        PFx Brick file system operations not supported over Bluetooth
+        raises :obj:`NotImplementedError`
+        """
+        raise NotImplementedError(
+            "PFx Brick file system operations not supported over Bluetooth"
+        )
+
     async def stop_script(self):
         """
         Stops all script execution.
@@ -847,12 +947,18 @@ class PFxBrickBLE(PFxBrick):
         filesystem directory.  This function performs this lookup if necessary,
         i.e. if a string filename is provided.
 
+        Filenames are resolved from the results of earlier queries, so
+        that the PFx Brick is only queried for a name the first time it is used.
+
         :param filespec: :obj:`int` or :obj:`str` file ID or file name string
         :returns: :obj:`int` numeric file ID from PFx Brick filesystem, or 0xFF if not found
         """
         if isinstance(filespec, int):
             return filespec
         elif isinstance(filespec, str):
+            fileid = self._cached_file_id(filespec)
+            if fileid is not None:
+                return fileid
             fileid = 0xFF
             fb = bytes(filespec, "utf-8")
             p = [len(fb)]
@@ -860,6 +966,7 @@ class PFxBrickBLE(PFxBrick):
             res = await cmd_file_dir(self.dev, PFX_DIR_REQ_GET_NAMED_FILE_ID, p)
             if len(res) >= 3 and not res[2] == PFX_ERR_FILE_NOT_FOUND:
                 fileid = int(res[2])
+            self._cache_file_id(filespec, fileid)
             return fileid
         return 0xFF
 
@@ -896,6 +1003,15 @@ class PFxBrickBLE(PFxBrick):
         res = await cmd_raw(self.dev, msg)
         return res
 
+    async def send_raw_icd_commands(self, msgs):
+        """
+        Sends a list of raw ICD command messages one after another.
+
+        :returns: [:obj:`bytes`] responses from the PFx Brick in the same order as msgs
+        """
+        res = await cmd_raw_batch(self.dev, msgs)
+        return res
+
     async def set_notifications(self, events):
         """
         Enables user selected notifications to be sent asynchronously from the PFx Brick.
@@ -24,43 +24,50 @@
 
 # PFx Brick python API
 
+import contextlib
+import os
+import time
+import zipfile
+
 import hid
 from bleak import BleakClient, BleakScanner
 
 from pfxbrick import *
-from pfxbrick.pfxfiles import fs_format
+from pfxbrick.pfxexceptions import (
+    FileCRCMismatchException,
+    FileSystemFullException,
+    ResponseTimeoutException,
+)
+from pfxbrick.pfxfat import PFxFAT
+from pfxbrick.pfxfiles import fs_format, fs_plan_upload, fs_sectors_for_size
+from pfxbrick.pfxflash import PFxFlashArchive, PFxFlashImage
 from pfxbrick.pfxhelpers import *
 from pfxbrick.pfxmsg import *
 
+# seconds to wait for the CRC32 of a copied file with PFxBrick.wait_file_ready
+PFX_FILE_READY_TIMEOUT = 10.0
+
+# first and longest interval in seconds between reads of a directory entry
+# while waiting for its CRC32
+PFX_FILE_READY_POLL_MIN = 0.01
+PFX_FILE_READY_POLL_MAX = 0.25
+
 
 def find_bricks(show_list=False):
     """
     Enumerate and optionally print a list PFx Bricks currently connected to the USB bus.
 
+    The enumeration is cached by :obj:`usb_registry` so that repeated calls do not
+    query the USB bus again, and PFx Bricks are not opened to read their descriptors.
+
     :param boolean show_list: optionally print a list of enumerated PFx Bricks
     :returns: [:obj:`str`] a list of PFx Brick serial numbers
     """
-    numBricks = 0
-    serials = []
-    for dev in hid.enumerate():
-        if (
-            dev["vendor_id"] == PFX_USB_VENDOR_ID
-            and dev["product_id"] == PFX_USB_PRODUCT_ID
-        ):
-            if dev["serial_number"] not in serials:
-                numBricks += 1
-                serials.append(dev["serial_number"])
-                h = hid.device()
-                h.open(PFX_USB_VENDOR_ID, PFX_USB_PRODUCT_ID, dev["serial_number"])
-                usb_prod_str = h.get_product_string()
-                usb_serno_str = h.get_serial_number_string()
-                if show_list == True:
-                    print(
-                        "%d. %s, Serial No: %s"
-                        % (numBricks, usb_prod_str, usb_serno_str)
-                    )
-                h.close()
-    return serials
+    devices = usb_registry.devices()
+    if show_list == True:
+        for i, dev in enumerate(devices):
+            print("%d. %s, Serial No: %s" % (i + 1, dev.product_string, dev.serial_no))
+    return [dev.serial_no for dev in devices]
 
 
 class PFxBrick:
@@ -98,7 +105,9 @@ class PFxBrick:
 
         usb_serno_str (:obj:`str`): the product serial number string reported to the host USB interface
 
-        dev (:obj:`device`): a device handle to the HIDAPI cdef class device
+        dev (:obj:`device`): a device handle to the HIDAPI cdef class device, or the :obj:`PFxTransport` passed to :obj:`open`
+
+        transport (:obj:`PFxTransport`): the transport which carries ICD messages to and from the PFx Brick
 
         is_open (:obj:`boolean`): a flag indicating connected session status
 
@@ -107,6 +116,20 @@ class PFxBrick:
         config (:obj:`PFxConfig`): child class to store configuration and settings
 
         filedir (:obj:`PFxDir`): child class to store the file system directory
+
+        file_cache (:obj:`PFxFileCache`): optional cache of file contents used when copying files from the PFx Brick, or None
+
+        callback_audio_done (:obj:`func`): a function callback reference in response to a `PFX_NOTIFICATION_AUDIO_PLAY_DONE` notification. Must have the call signature `func(fileid, filename)`
+
+        callback_audio_play (:obj:`func`): a function callback reference in response to a `PFX_NOTIFICATION_AUDIO_PLAY` notification. Must have the call signature `func(fileid, filename)`
+
+        callback_motora_stop (:obj:`func`): a function callback reference in response to a `PFX_NOTIFICATION_MOTORA_STOP` notification. Must have the call signature `func()`
+
+        callback_motora_speed (:obj:`func`): a function callback reference in response to a `PFX_NOTIFICATION_MOTORA_CURR_SPD` notification. Must have the call signature `func(speed)`
+
+        callback_motorb_stop (:obj:`func`): a function callback reference in response to a `PFX_NOTIFICATION_MOTORB_STOP` notification. Must have the call signature `func()`
+
+        callback_motorb_speed (:obj:`func`): a function callback reference in response to a `PFX_NOTIFICATION_MOTORB_CURR_SPD` notification. Must have the call signature `func(speed)`
     """
 
     def __init__(self, serial_no=None):
@@ -124,9 +147,21 @@ class PFxBrick:
         self.usb_prod_str = ""
         self.usb_serno_str = ""
         self.dev = None
+        self.transport = None
+        self.file_cache = None
+        self._filedir_valid = False
+        self._file_ids = {}
         self.is_open = False
+        self._watcher = None
+        self._reopen_state = (False, None)
         self.has_bluetooth = False
         self.name = ""
+        self.callback_audio_done = None
+        self.callback_audio_play = None
+        self.callback_motora_stop = None
+        self.callback_motora_speed = None
+        self.callback_motorb_stop = None
+        self.callback_motorb_speed = None
 
         self.config = PFxConfig()
         self.filedir = PFxDir()
@@ -135,27 +170,35 @@ class PFxBrick:
         if serial_no is not None:
             self.open(ser_no=serial_no)
 
-    def open(self, ser_no=None):
+    def open(self, ser_no=None, transport=None, record=None):
         """
         Opens a USB communication session with a PFx Brick. If multiple PFx Bricks are
         connected, then a serial number must be specified to connect to a unique PFx Brick.
 
+        A session can instead be opened over any :obj:`PFxTransport`, e.g. a
+        virtual PFx Brick, in which case USB enumeration is skipped.
+
         :param ser_no: optional serial number to specify a particular PFx Brick if multiple connected
+        :param transport: optional :obj:`PFxTransport` to use instead of a USB connection
+        :param record: optional filename of a session log to record every ICD transaction to, see :obj:`PFxRecordingTransport`
         :returns: boolean indicating open session result
         """
         if ser_no is not None:
             ser_no = ser_no.upper()
-        if not self.is_open:
-            numBricks = 0
-            serials = []
-            for dev in hid.enumerate():
-                if (
-                    dev["vendor_id"] == PFX_USB_VENDOR_ID
-                    and dev["product_id"] == PFX_USB_PRODUCT_ID
-                ):
-                    if dev["serial_number"] not in serials:
-                        numBricks += 1
-                        serials.append(dev["serial_number"])
+        if not self.is_open and transport is not None:
+            self.dev = transport
+            self.transport = transport
+            self.usb_manu_str = getattr(transport, "manufacturer_string", "")
+            self.usb_prod_str = getattr(transport, "product_string", "")
+            self.usb_serno_str = getattr(transport, "serial_number_string", "")
+            self._open_session(record)
+        elif not self.is_open:
+            devices = usb_registry.devices()
+            serials = [dev.serial_no for dev in devices]
+            if not serials or (ser_no is not None and ser_no not in serials):
+                devices = usb_registry.refresh()
+                serials = [dev.serial_no for dev in devices]
+            numBricks = len(serials)
             if ser_no is not None and ser_no not in serials:
                 print("The PFx Brick with serial number %s was not found." % (ser_no))
             else:
@@ -166,25 +209,182 @@ class PFxBrick:
                         "There are multiple PFx Bricks connected. Therefore a serial number is required to specify which PFx Brick to connect to."
                     )
                 else:
-                    self.dev = hid.device()
-                    self.dev.open(PFX_USB_VENDOR_ID, PFX_USB_PRODUCT_ID, ser_no)
-                    self.usb_manu_str = self.dev.get_manufacturer_string()
-                    self.usb_prod_str = self.dev.get_product_string()
-                    self.usb_serno_str = self.dev.get_serial_number_string()
-                    self.is_open = True
-                    self.get_icd_rev()
-                    self.config.icd_rev = self.icd_rev
-                    self.get_status()
-                    if self.product_id in ["A204", "A208", "A216"]:
-                        self.has_bluetooth = True
+                    if ser_no is None:
+                        ser_no = serials[0]
+                    self._open_usb(devices[serials.index(ser_no)])
+                    self._open_session(record)
         return self.is_open
 
+    def _open_usb(self, usbdev):
+        self.dev = hid.device()
+        try:
+            # opening by path avoids another enumeration inside hidapi
+            self.dev.open_path(usbdev.path)
+        except (IOError, OSError):
+            usb_registry.invalidate()
+            self.dev.open(PFX_USB_VENDOR_ID, PFX_USB_PRODUCT_ID, usbdev.serial_no)
+        self.usb_manu_str = usbdev.manufacturer_string
+        self.usb_prod_str = usbdev.product_string
+        self.usb_serno_str = usbdev.serial_no
+        self.transport = get_transport(self.dev)
+
+    def _open_session(self, record=None):
+        if record is not None:
+            self.transport = PFxRecordingTransport(self.transport, record)
+            self.dev = self.transport
+        # file IDs cached from a previous session may belong to another PFx Brick
+        self._file_ids.clear()
+        self._filedir_valid = False
+        self.is_open = True
+        self.get_icd_rev()
+        self.config.icd_rev = self.icd_rev
+        self.get_status()
+        if self.product_id in ["A204", "A208", "A216"]:
+            self.has_bluetooth = True
+
     def close(self):
         """
         Closes a USB communication session with a PFx Brick.
         """
+        self.set_auto_reopen(False)
+        if self.is_open:
+            self.transport.close()
+            self.is_open = False
+
+    def reopen(self):
+        """
+        Re-opens the USB session of a PFx Brick after it was detached and
+        attached again.  The ICD revision, configuration and file directory
+        from the previous session are kept rather than read again, and the
+        background reader and transaction statistics are restored.
+
+        :returns: boolean indicating open session result
+        """
+        if not self.usb_serno_str:
+            return False
+        usbdev = usb_registry.get(self.usb_serno_str)
+        if usbdev is None:
+            return False
         if self.is_open:
-            self.dev.close()
+            self._close_detached()
+        reader, stats = self._reopen_state
+        try:
+            self._open_usb(usbdev)
+        except (IOError, OSError):
+            return False
+        self.transport.stats = stats
+        self.is_open = True
+        self.config.icd_rev = self.icd_rev
+        if reader:
+            self.start_reader()
+        return True
+
+    def _close_detached(self):
+        reader = getattr(self.transport, "reader", None) is not None
+        self._reopen_state = (reader, self.transport.stats)
+        try:
+            self.transport.close()
+        except (IOError, OSError, ValueError):
+            pass
+        self.is_open = False
+
+    def set_auto_reopen(self, enable=True, watcher=None):
+        """
+        Watches the USB bus so that the session is closed when this PFx Brick
+        is detached and re-opened with :obj:`reopen` when it is attached again.
+        Method calls made while the PFx Brick is detached raise an exception.
+
+        :param enable: :obj:`boolean` True to start watching, False to stop
+        :param watcher: optional :obj:`PFxHotplugWatcher`, defaults to a shared watcher thread
+        """
+        if self._watcher is not None:
+            self._watcher.remove_listener(self._hotplug_event)
+            self._watcher = None
+        if enable:
+            self._watcher = watcher if watcher is not None else hotplug_watcher()
+            self._watcher.add_listener(self._hotplug_event)
+
+    def _hotplug_event(self, event, serial_no):
+        if serial_no != self.usb_serno_str:
+            return
+        if event == PFX_HOTPLUG_DETACH and self.is_open:
+            self._close_detached()
+        elif event == PFX_HOTPLUG_ATTACH and not self.is_open:
+            self.reopen()
+
+    def start_reader(self):
+        """
+        Starts a background thread which reads every USB message from the
+        PFx Brick.  Responses are routed to the waiting method calls and
+        notification messages are dispatched to the ``callback_*`` functions.
+        Callbacks are called from the reader thread.
+        """
+        if self.is_open and hasattr(self.transport, "start_reader"):
+            self.transport.start_reader(self._process_notification)
+
+    def stop_reader(self):
+        """
+        Stops the background reader thread started with :obj:`start_reader`.
+        """
+        if self.is_open and hasattr(self.transport, "stop_reader"):
+            self.transport.stop_reader()
+
+    def set_timeout(self, timeout, retries=None):
+        """
+        Sets how long to wait for each response from the PFx Brick before a
+        :obj:`USBResponseTimeoutException` is raised, and optionally how many
+        times idempotent queries such as :obj:`get_status` and
+        :obj:`get_current_state` are retried after a timeout.
+
+        :param timeout: :obj:`float` seconds to wait for each response, None waits forever
+        :param retries: :obj:`int` optional number of retries of idempotent queries
+        """
+        if hasattr(self.transport, "timeout"):
+            self.transport.timeout = timeout
+            if retries is not None:
+                self.transport.retries = retries
+
+    def deadline(self, timeout):
+        """
+        Returns a context manager which requires every ICD transaction made
+        inside the with block to complete within timeout seconds in total.
+        A :obj:`USBResponseTimeoutException` is raised when the deadline passes::
+
+            with brick.deadline(0.05):
+                state = brick.get_current_state()
+
+        :param timeout: :obj:`float` seconds from now
+        """
+        if hasattr(self.transport, "deadline"):
+            return self.transport.deadline(timeout)
+        return contextlib.nullcontext()
+
+    def _process_notification(self, msg):
+        def _filename(fileid):
+            f = self.filedir.get_file_dir_entry(fileid)
+            if f is not None:
+                return f.name
+            return None
+
+        if msg[0] == PFX_MSG_NOTIFICATION:
+            if msg[1] == PFX_NOTIFICATION_AUDIO_PLAY_DONE:
+                if self.callback_audio_done is not None:
+                    self.callback_audio_done(msg[2], _filename(msg[2]))
+            if msg[1] == PFX_NOTIFICATION_AUDIO_PLAY:
+                if self.callback_audio_play is not None:
+                    self.callback_audio_play(msg[2], _filename(msg[2]))
+            if msg[1] == PFX_NOTIFICATION_MOTORA_CURR_SPD:
+                if self.callback_motora_speed is not None:
+                    self.callback_motora_speed(int8_toint(msg[2]))
+            if msg[1] == PFX_NOTIFICATION_MOTORA_STOP:
+                if self.callback_motora_stop is not None:
+                    self.callback_motora_stop()
+            if msg[1] == PFX_NOTIFICATION_MOTORB_CURR_SPD:
+                if self.callback_motorb_speed is not None:
+                    self.callback_motorb_speed(int8_toint(msg[2]))
+            if msg[1] == PFX_NOTIFICATION_MOTORB_STOP:
+                if self.callback_motorb_stop is not None:
+                    self.callback_motorb_stop()
 
     def get_icd_rev(self, silent=False):
         """
@@ -361,6 +561,28 @@ class PFxBrick:
                 action.from_bytes(res)
             return action
 
+    def get_actions(self, addresses):
+        """
+        Retrieves several stored actions from the event/action LUT in one
+        pipelined batch of ICD messages.
+
+        :param addresses: [:obj:`int`] a list or range of event/action LUT addresses (0 - 0x7F)
+        :returns: [:obj:`PFxAction`] a list of actions in the same order as addresses
+        """
+        addresses = list(addresses)
+        for address in addresses:
+            if address > EVT_LUT_MAX:
+                print("Requested action at address %02X is out of range" % (address))
+                return None
+        evtchs = [address_to_evtch(address) for address in addresses]
+        actions = []
+        for res in cmd_get_event_actions(self.dev, evtchs):
+            action = PFxAction()
+            if res:
+                action.from_bytes(res)
+            actions.append(action)
+        return actions
+
     def set_action_by_address(self, address, action):
         """
         Sets a new stored action in the event/action LUT at the
@@ -470,9 +692,9 @@ class PFxBrick:
             req_matches += 1
         if motorfx is not None:
             req_matches += 1
-        for e in range(EVT_STARTUP_EVENT1, EVT_STARTUP_EVENT8 + 1):
+        startup_events = range(EVT_STARTUP_EVENT1, EVT_STARTUP_EVENT8 + 1)
+        for action in self.get_actions(startup_events):
             matches = 0
-            action = self.get_action_by_address(e)
             if lightfx is not None and action.lightFxId == lightfx:
                 matches += 1
             if soundfx is not None and action.soundFxId == soundfx:
@@ -605,13 +827,24 @@ class PFxBrick:
         """
         self.test_action(PFxAction().set_volume(volume))
 
-    def refresh_file_dir(self):
+    def refresh_file_dir(self, fileID=None):
         """
         Reads the PFx Brick file system directory. This includes
         the total storage used as well as the remaining capacity.
         Individual file directory entries are stored in the
         :obj:`PFxBrick.filedir.files` class variable.
+
+        If a file ID is specified and the directory has been read before,
+        only the directory entry of that file is read again along with the
+        file count and free space.  The whole directory is read if these do
+        not match the directory with the one entry updated, i.e. if
+        something else changed on the PFx Brick.
+
+        :param fileID: :obj:`int` optional file ID of the only file which changed
         """
+        if fileID is not None and self._filedir_valid:
+            if self._refresh_file_entry(fileID):
+                return
         res = cmd_get_free_space(self.dev)
         if res:
             self.filedir.bytesLeft = uint32_toint(res[3:7])
@@ -620,17 +853,65 @@ class PFxBrick:
         res = cmd_get_num_files(self.dev)
         if res:
             self.filedir.files = []
+            self._file_ids.clear()
             self.filedir.numFiles = uint16_toint(res[3:5])
             file_count = 0
-            for i in range(PFX_AUDIO_FILES_MAX):
-                res = cmd_get_dir_entry(self.dev, i + 1)
-                d = PFxFile()
-                d.from_bytes(res)
-                if d.id < 0xFF:
-                    self.filedir.files.append(d)
-                    file_count += 1
-                if file_count >= self.filedir.numFiles:
-                    break
+            idx = 1
+            # request as many directory entries as there are files remaining
+            # in one pipelined batch, and repeat if some indexes were empty
+            while file_count < self.filedir.numFiles and idx <= PFX_AUDIO_FILES_MAX:
+                count = min(
+                    self.filedir.numFiles - file_count, PFX_AUDIO_FILES_MAX - idx + 1
+                )
+                for res in cmd_get_dir_entries(self.dev, range(idx, idx + count)):
+                    d = PFxFile()
+                    d.from_bytes(res)
+                    if d.id < 0xFF:
+                        self.filedir.files.append(d)
+                        file_count += 1
+                idx += count
+            self._filedir_valid = True
+
+    def _refresh_file_entry(self, fileID):
+        # Updates one directory entry and returns False if the file count or
+        # used space show that other files changed as well
+        def _sectors(f):
+            return fs_sectors_for_size(f.size) if f is not None else 0
+
+        res, count, space = cmd_get_dir_entry_with_space(self.dev, fileID)
+        if not (res and count and space):
+            return False
+        new = PFxFile()
+        new.from_bytes(res)
+        if new.id != fileID:
+            new = None
+        old = self.filedir.get_file_dir_entry(fileID)
+        numFiles = len(self.filedir.files) - (old is not None) + (new is not None)
+        bytesUsed = self.filedir.bytesUsed + PFX_FLASH_SECTOR_SZ * (
+            _sectors(new) - _sectors(old)
+        )
+        bytesLeft = uint32_toint(space[3:7])
+        if (
+            uint16_toint(count[3:5]) != numFiles
+            or uint32_toint(space[7:11]) - bytesLeft != bytesUsed
+        ):
+            return False
+        if old is not None and new is not None:
+            self.filedir.files[self.filedir.files.index(old)] = new
+        elif old is not None:
+            self.filedir.files.remove(old)
+        elif new is not None:
+            self.filedir.files.append(new)
+        self.filedir.numFiles = numFiles
+        self.filedir.bytesLeft = bytesLeft
+        self.filedir.bytesUsed = bytesUsed
+        return True
+
+    def _file_changed(self, fileID):
+        # keeps a directory which has been read up to date after a change
+        self._file_ids.clear()
+        if self._filedir_valid:
+            self.refresh_file_dir(fileID)
 
     def put_file(self, fn, fileID=None, show_progress=True):
         """
@@ -645,19 +926,230 @@ class PFxBrick:
             fileID = self.filedir.find_available_file_id()
         if fileID is not None:
             fs_copy_file_to(self, fileID, fn, show_progress)
+            self._file_changed(fileID)
+
+    def wait_file_ready(
+        self, fileID, expected_crc=None, timeout=PFX_FILE_READY_TIMEOUT
+    ):
+        """
+        Waits for the PFx Brick to finish computing the CRC32 of a file which
+        was just copied to it.  Only the directory entry of the file is read,
+        at intervals which start short and grow while the CRC32 is not ready.
+
+        :param fileID: :obj:`int` or :obj:`str` the file ID or filename of the file
+        :param expected_crc: :obj:`int` optional CRC32 the file must have, e.g. from :obj:`get_file_crc32`
+        :param timeout: :obj:`float` seconds to wait for the CRC32
+        :returns: :obj:`PFxFile` directory entry of the file
+        :raises: :obj:`FileCRCMismatchException` if the CRC32 does not match expected_crc
+        :raises: :obj:`ResponseTimeoutException` if the CRC32 is not ready within timeout
+        :raises: :obj:`FileNotFoundError` if a filename is not found on the PFx Brick
+        """
+        name, fileID = fileID, self.file_id_from_str_or_int(fileID)
+        if fileID == 0xFF:
+            raise FileNotFoundError("File %s not found on the PFx Brick" % (name))
+        deadline = time.monotonic() + timeout
+        interval = PFX_FILE_READY_POLL_MIN
+        while True:
+            res = cmd_get_dir_entry_id(self.dev, fileID)
+            f = PFxFile()
+            f.from_bytes(res)
+            if f.id == fileID and f.crc32 != 0:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ResponseTimeoutException(
+                    "CRC32 of file %d not ready after %.1f s" % (fileID, timeout)
+                )
+            time.sleep(min(interval, remaining))
+            interval = min(2 * interval, PFX_FILE_READY_POLL_MAX)
+        old = self.filedir.get_file_dir_entry(fileID)
+        if old is not None:
+            self.filedir.files[self.filedir.files.index(old)] = f
+        if expected_crc is not None and f.crc32 != expected_crc & 0xFFFFFFFF:
+            raise FileCRCMismatchException(
+                "File %d has CRC32 0x%08X instead of 0x%08X"
+                % (fileID, f.crc32, expected_crc)
+            )
+        return f
+
+    def plan_upload(self, fns, removable=None, remove_stale=False):
+        """
+        Plans copying a set of local files to the PFx Brick before any of them
+        is copied, so that running out of space is found before any file is
+        opened.  See :obj:`fs_plan_upload`.
+
+        :param fns: [:obj:`str`] local filenames to copy
+        :param removable: optional iterable of file IDs or filenames on the PFx Brick which may be removed to make space
+        :param remove_stale: :obj:`boolean` remove every file on the PFx Brick which is not in fns
+        :returns: :obj:`PFxUploadPlan`
+        """
+        self.refresh_file_dir()
+        return fs_plan_upload(self.filedir, fns, removable, remove_stale)
+
+    def sync_dir(
+        self,
+        path,
+        remove_stale=False,
+        show_progress=True,
+        dry_run=False,
+        removable=None,
+    ):
+        """
+        Copies the files in a local directory to the PFx Brick, skipping files
+        which are already on the PFx Brick with the same name, size and CRC32.
+        Changed files keep their file ID so that event actions which refer
+        to them remain valid.  The copy is planned with :obj:`plan_upload`
+        first and nothing is changed on the PFx Brick if the files do not fit.
+
+        :param path: :obj:`str` the local directory to copy files from
+        :param remove_stale: :obj:`boolean` remove files on the PFx Brick which are not in the directory
+        :param show_progress: :obj:`boolean` a flag to show the progress bar indicator during transfer.
+        :param dry_run: :obj:`boolean` only report what would be copied and removed
+        :param removable: optional iterable of file IDs or filenames on the PFx Brick which may be removed to make space
+        :returns: :obj:`PFxSyncReport` summary of the synchronization
+        :raises: :obj:`FileSystemFullException` if the files do not fit on the PFx Brick
+        """
+        report = PFxSyncReport()
+        fns = []
+        for name in sorted(os.listdir(path)):
+            fn = os.path.join(path, name)
+            if not name.startswith(".") and os.path.isfile(fn):
+                fns.append(fn)
+        plan = self.plan_upload(fns, removable, remove_stale)
+        if not plan.fits and not dry_run:
+            raise FileSystemFullException(
+                "%.1f kB more space is needed on the PFx Brick"
+                % (float(plan.shortfall / 1000))
+            )
+        report.skipped = plan.skipped
+        for name in plan.unchanged:
+            report.unchanged.append(name)
+            report.bytes_saved += self.filedir.get_file_dir_entry_by_name(name).size
+        for f in plan.removals:
+            if not dry_run:
+                self.remove_file(f.id, silent=True)
+            report.removed.append(f.name)
+        for fn, fid in plan.uploads:
+            name = os.path.basename(fn)
+            size = os.path.getsize(fn)
+            if not dry_run:
+                if fs_copy_file_to(self, fid, fn, show_progress) < size:
+                    self._file_changed(fid)
+                    report.failed.append(name)
+                    continue
+                if name.lower().endswith(".pfx"):
+                    self.send_raw_icd_command(
+                        [PFX_CMD_FILE_DIR, PFX_DIR_REQ_SET_ATTR_ID, fid, 0x30, 0x80]
+                    )
+                self._file_changed(fid)
+            report.uploaded.append(name)
+            report.bytes_uploaded += size
+        return report
 
-    def get_file(self, fileID, fn=None, show_progress=True):
+    def get_fat(self):
+        """
+        Reads the file allocation table (FAT) from the PFx Brick flash memory.
+
+        :returns: :obj:`PFxFAT` the parsed file allocation table
+        :raises: :obj:`FlashReadException` if the file allocation table could not be read
+        """
+        rb = bytearray(PFX_FLASH_FAT_SZ)
+        flash_read_exact(self, PFX_FLASH_FAT_ADDR, rb)
+        fat = PFxFAT()
+        fat.from_bytes(rb)
+        return fat
+
+    def restore_files(
+        self, source, remove_stale=False, show_progress=True, dry_run=False
+    ):
+        """
+        Restores the files of a flash snapshot or archive to the PFx Brick.
+        Files keep their file ID, attributes and user data, and files which
+        are already on the PFx Brick with the same file ID, name, size and
+        CRC32 are not copied again.  The CRC32 of every copied file is
+        checked once the PFx Brick has computed it.
+
+        :param source: a :obj:`PFxFlashImage` or :obj:`PFxFlashArchive`, or the filename of either
+        :param remove_stale: :obj:`boolean` remove files on the PFx Brick which are not in the source
+        :param show_progress: :obj:`boolean` a flag to show the progress bar indicator during transfer.
+        :param dry_run: :obj:`boolean` only report what would be copied and removed
+        :returns: :obj:`PFxSyncReport` summary of the restore
+        :raises: :obj:`FileCRCMismatchException` if a file does not match its CRC32
+        """
+        if isinstance(source, str):
+            if zipfile.is_zipfile(source):
+                source = PFxFlashArchive(source)
+            else:
+                source = PFxFlashImage(source)
+            with source:
+                return self.restore_files(source, remove_stale, show_progress, dry_run)
+        report = PFxSyncReport()
+        self.refresh_file_dir()
+        onbrick = {f.id: f for f in self.filedir.files}
+        if remove_stale:
+            wanted = set(f.id for f in source.files)
+            for fid, f in onbrick.items():
+                if fid not in wanted:
+                    if not dry_run:
+                        self.remove_file(fid, silent=True)
+                    report.removed.append(f.name)
+        for f in source.files:
+            b = onbrick.get(f.id)
+            if b is not None and (b.name, b.size, b.crc32) == (f.name, f.size, f.crc32):
+                report.unchanged.append(f.name)
+                report.bytes_saved += f.size
+            else:
+                if not dry_run:
+                    data = source.read_file(f)
+                    n = fs_copy_file_to(
+                        self, f.id, f.name, show_progress, with_bytes=data
+                    )
+                    self._file_changed(f.id)
+                    if n < f.size:
+                        report.failed.append(f.name)
+                        continue
+                    self.wait_file_ready(f.id, expected_crc=f.crc32)
+                report.uploaded.append(f.name)
+                report.bytes_uploaded += f.size
+                b = None
+            if dry_run or (
+                b is not None
+                and (b.attributes, b.userData1, b.userData2)
+                == (f.attributes, f.userData1, f.userData2)
+            ):
+                continue
+            msgs = []
+            msg = [PFX_CMD_FILE_DIR, PFX_DIR_REQ_SET_ATTR_ID, f.id]
+            msg.extend(uint16_to_bytes(f.attributes))
+            msgs.append(msg)
+            msg = [PFX_CMD_FILE_DIR, PFX_DIR_REQ_SET_USER_DATA1_ID, f.id]
+            msg.extend(uint32_to_bytes(f.userData1))
+            msgs.append(msg)
+            msg = [PFX_CMD_FILE_DIR, PFX_DIR_REQ_SET_USER_DATA2_ID, f.id]
+            msg.extend(uint32_to_bytes(f.userData2))
+            msgs.append(msg)
+            self.send_raw_icd_commands(msgs)
+            self._file_changed(f.id)
+        return report
+
+    def get_file(self, fileID, fn=None, show_progress=True, dest=None):
         """
         Copies a file from the PFx Brick to the host.
 
         :param fileID: :obj:`int` or :obj:`str` the file ID or filename of the file to copy
         :param fn: :obj:`str` optional override for the filename when copied into the host
         :param show_progress: :obj:`boolean` a flag to show the progress bar indicator during transfer.
+        :param dest: optional writable binary file object or pre-allocated buffer to copy into instead of a host file
+        :returns: :obj:`int` number of bytes copied
         """
-        self.refresh_file_dir()
         fileID = self.file_id_from_str_or_int(fileID)
+        self.refresh_file_dir(fileID)
         f = self.filedir.get_file_dir_entry(fileID)
-        fs_copy_file_from(self, f, fn, show_progress)
+        if f is None or dest is not None:
+            return fs_copy_file_from(self, f, fn, show_progress, dest=dest)
+        # stream the file to the host file rather than returning its contents
+        with open(fn if fn is not None else f.name, "wb") as fo:
+            return fs_copy_file_from(self, f, fn, show_progress, dest=fo)
 
     def remove_file(self, fileID, silent=False):
         """
@@ -668,6 +1160,7 @@ class PFxBrick:
         """
         fileID = self.file_id_from_str_or_int(fileID)
         fs_remove_file(self.dev, fileID, silent=silent)
+        self._file_changed(fileID)
 
     def format_fs(self, quick=False):
         """
@@ -676,6 +1169,9 @@ class PFxBrick:
         :param quick: :obj:`boolean` If True, only occupied sectors are erased. If False, every sector is erased, i.e. a complete format.
         """
         fs_format(self.dev, quick)
+        self._file_ids.clear()
+        if self._filedir_valid:
+            self.refresh_file_dir()
 
     def set_file_attributes(self, fileID, attr, mask=0x7C):
         """
@@ -702,6 +1198,7 @@ class PFxBrick:
                 mask,
             ]
         )
+        self._file_changed(fileID)
 
     def rename_file(self, fileID, new_name):
         """
@@ -722,6 +1219,7 @@ class PFxBrick:
                 *mb,
             ]
         )
+        self._file_changed(fileID)
 
     def stop_script(self):
         """
@@ -751,16 +1249,36 @@ class PFxBrick:
         filesystem directory.  This function performs this lookup if necessary,
         i.e. if a string filename is provided.
 
+        Filenames are resolved from the directory if it has been read, or
+        from the results of earlier queries, so that the PFx Brick is only
+        queried for a name the first time it is used.  Resolved names are
+        forgotten whenever the file system is changed through this object.
+
         :param filespec: :obj:`int` or :obj:`str` file ID or file name string
         :returns: :obj:`int` numeric file ID from PFx Brick filesystem, or 0xFF if not found
         """
         if isinstance(filespec, int):
             return filespec
         elif isinstance(filespec, str):
-            fileid = fs_get_fileid_from_name(self.dev, filespec)
+            fileid = self._cached_file_id(filespec)
+            if fileid is None:
+                fileid = fs_get_fileid_from_name(self.dev, filespec)
+                self._cache_file_id(filespec, fileid)
             return fileid
         return 0xFF
 
+    def _cached_file_id(self, name):
+        fileid = self._file_ids.get(name)
+        if fileid is None and self._filedir_valid:
+            f = self.filedir.get_file_dir_entry_by_name(name)
+            if f is not None:
+                fileid = f.id
+        return fileid
+
+    def _cache_file_id(self, name, fileid):
+        if fileid != 0xFF:
+            self._file_ids[name] = fileid
+
     def get_current_state(self):
         """
         Returns the current state of the PFx Brick operating parameters.
@@ -791,6 +1309,88 @@ class PFxBrick:
         self.state.bt.from_bytes(res)
         return self.state.bt
 
+    def set_notifications(self, events):
+        """
+        Enables user selected notifications to be sent asynchronously from the PFx Brick
+        over USB.  The background reader thread is started if it is not already running.
+
+        :param events: :obj:`int` a bitwise OR of notification flags:
+
+        - :obj:`PFX_NOTIFICATION_AUDIO_PLAY_DONE = 0x01`
+        - :obj:`PFX_NOTIFICATION_AUDIO_PLAY = 0x02`
+        - :obj:`PFX_NOTIFICATION_MOTORA_CURR_SPD = 0x04`
+        - :obj:`PFX_NOTIFICATION_MOTORA_STOP = 0x08`
+        - :obj:`PFX_NOTIFICATION_MOTORB_CURR_SPD = 0x10`
+        - :obj:`PFX_NOTIFICATION_MOTORB_STOP = 0x20`
+
+        Note that :obj:`PFX_NOTIFICATION_TO_USB` is automatically set and does not need to be specified.
+        """
+
+        # if notifications are configured for audio events, refresh file directory
+        # so that we can resolve file ID numbers to filenames
+        if (
+            events & PFX_NOTIFICATION_AUDIO_PLAY
+            or events & PFX_NOTIFICATION_AUDIO_PLAY_DONE
+        ):
+            self.refresh_file_dir()
+        self.start_reader()
+        res = cmd_set_notifications(self.dev, PFX_NOTIFICATION_TO_USB | events)
+
+    def disable_notifications(self):
+        """
+        Disables asynchronous notifications sent from the PFx Brick.
+        """
+        res = cmd_set_notifications(self.dev, 0)
+
+    def enable_transaction_stats(self, enable=True):
+        """
+        Starts or stops collecting per ICD command transaction statistics,
+        i.e. call counts, bytes sent and received and a latency histogram.
+        Statistics are kept by the transport of an open session.
+
+        :param enable: :obj:`boolean` True to start collecting, False to stop and discard statistics
+        """
+        if self.transport is None:
+            return
+        if not enable:
+            self.transport.stats = None
+        elif self.transport.stats is None:
+            self.transport.stats = PFxTransportStats()
+
+    def get_transaction_stats(self):
+        """
+        Returns a snapshot of the transaction statistics collected since
+        :obj:`enable_transaction_stats` was called.
+
+        :returns: :obj:`PFxTransportStats` or None if statistics are not being collected
+        """
+        if self.transport is None or self.transport.stats is None:
+            return None
+        return self.transport.stats.snapshot()
+
+    def reset_transaction_stats(self):
+        """
+        Clears the transaction statistics collected so far.
+        """
+        if self.transport is not None and self.transport.stats is not None:
+            self.transport.stats.reset()
+
+    def enable_file_cache(self, enable=True, path=None, max_size=None):
+        """
+        Starts or stops serving file copies from the PFx Brick with a local
+        :obj:`PFxFileCache` addressed by CRC32 and size.  A file which was
+        copied from any PFx Brick before is then read from the cache rather
+        than over USB.
+
+        :param enable: :obj:`boolean` True to use the cache, False to stop using it
+        :param path: :obj:`str` optional cache directory, defaults to ``~/.cache/pfxbrick``
+        :param max_size: :obj:`int` optional limit of the total size of cached files in bytes
+        """
+        if not enable:
+            self.file_cache = None
+        else:
+            self.file_cache = PFxFileCache(path, max_size)
+
     def send_raw_icd_command(self, msg):
         """
         Sends a raw ICD command message represented as a list of bytes.
@@ -799,3 +1399,11 @@ class PFxBrick:
         """
         res = cmd_raw(self.dev, msg)
         return res
+
+    def send_raw_icd_commands(self, msgs):
+        """
+        Sends a list of raw ICD command messages as one pipelined batch.
+
+        :returns: [:obj:`bytes`] responses from the PFx Brick in the same order as msgs
+        """
+        return cmd_raw_batch(self.dev, msgs)
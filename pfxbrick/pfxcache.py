@@ -0,0 +1,202 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2021  Fx Bricks Inc.
+# This file is part of the pfxbrick python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# PFx Brick content-addressed file cache
+
+import os
+import tempfile
+import threading
+import zlib
+
+# default limit of the total size of cached files in bytes
+PFX_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+# size of the chunks read from cached files
+PFX_CACHE_CHUNK_SZ = 0x10000
+
+
+def default_cache_dir():
+    """Returns the default directory of the file cache, e.g. ``~/.cache/pfxbrick``."""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "pfxbrick")
+
+
+class PFxFileCache:
+    """
+    On-disk cache of PFx Brick file contents addressed by CRC32 and size.
+
+    PFx Brick directory entries report the CRC32 and size of every file, so
+    a file which has been copied from any PFx Brick before can be served
+    from the cache without a USB transfer.  Entries are only added when the
+    CRC32 of the data received matches the directory entry.  When the total
+    size of cached files exceeds max_size, the least recently used entries
+    are removed.
+
+    :param path: :obj:`str` optional cache directory, defaults to :obj:`default_cache_dir`
+    :param max_size: :obj:`int` optional limit of the total size of cached files in bytes
+
+    Attributes:
+        hits (:obj:`int`): number of files served from the cache
+
+        misses (:obj:`int`): number of files which were not in the cache
+    """
+
+    def __init__(self, path=None, max_size=None):
+        self.path = path if path is not None else default_cache_dir()
+        self.max_size = max_size if max_size is not None else PFX_CACHE_MAX_SIZE
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def _filename(self, crc32, size):
+        return os.path.join(self.path, "%08X-%d.bin" % (crc32 & 0xFFFFFFFF, size))
+
+    def get(self, crc32, size):
+        """
+        Returns the filename of a cached file and marks it as recently used.
+
+        :param crc32: :obj:`int` CRC32 of the file
+        :param size: :obj:`int` size of the file in bytes
+        :returns: :obj:`str` filename or None if the file is not cached
+        """
+        fn = self._filename(crc32, size)
+        try:
+            os.utime(fn)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return fn
+
+    def __contains__(self, key):
+        return os.path.isfile(self._filename(*key))
+
+    def read_chunks(self, crc32, size):
+        """
+        Generator which yields the contents of a cached file in chunks.
+
+        :raises: :obj:`KeyError` if the file is not cached
+        """
+        try:
+            f = open(self._filename(crc32, size), "rb")
+        except OSError:
+            raise KeyError((crc32, size))
+        with f:
+            for chunk in iter(lambda: f.read(PFX_CACHE_CHUNK_SZ), b""):
+                yield chunk
+
+    def put(self, crc32, size, data):
+        """
+        Adds the contents of a file to the cache.
+
+        :param crc32: :obj:`int` CRC32 of the file
+        :param size: :obj:`int` size of the file in bytes
+        :param data: bytes-like file contents
+        :returns: True if the data matches crc32 and size and was added
+        """
+        return self._store(crc32, size, [data])
+
+    def tee(self, crc32, size, chunks):
+        """
+        Generator which yields chunks of a file unchanged while adding them to
+        the cache.  The file is only added if every chunk was consumed and
+        the data matches crc32 and size.
+
+        :param chunks: an iterable of bytes-like chunks of the file
+        """
+        if size > self.max_size:
+            yield from chunks
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        crc, n = 0, 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    crc = zlib.crc32(chunk, crc)
+                    n += len(chunk)
+                    yield chunk
+            self._commit(tmp, crc32, size, crc, n)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _store(self, crc32, size, chunks):
+        if size > self.max_size:
+            return False
+        for _ in self.tee(crc32, size, chunks):
+            pass
+        return (crc32, size) in self
+
+    def _commit(self, tmp, crc32, size, crc, n):
+        if (crc & 0xFFFFFFFF) != (crc32 & 0xFFFFFFFF) or n != size:
+            return
+        os.replace(tmp, self._filename(crc32, size))
+        self.evict()
+
+    def entries(self):
+        """
+        Returns the cached files from least to most recently used.
+
+        :returns: [(:obj:`str`, :obj:`int`, :obj:`float`)] filename, size and time of last use
+        """
+        entries = []
+        for e in os.scandir(self.path):
+            if e.name.endswith(".bin") and e.is_file():
+                st = e.stat()
+                entries.append((e.path, st.st_size, st.st_mtime))
+        entries.sort(key=lambda e: e[2])
+        return entries
+
+    def total_size(self):
+        """Returns the total size of cached files in bytes."""
+        return sum(e[1] for e in self.entries())
+
+    def evict(self, max_size=None):
+        """
+        Removes least recently used files until the total size of cached
+        files is no more than max_size.
+
+        :param max_size: :obj:`int` optional size limit, defaults to the cache max_size
+        """
+        max_size = max_size if max_size is not None else self.max_size
+        with self._lock:
+            entries = self.entries()
+            total = sum(e[1] for e in entries)
+            for fn, size, _ in entries:
+                if total <= max_size:
+                    break
+                try:
+                    os.remove(fn)
+                except OSError:
+                    pass
+                total -= size
+
+    def clear(self):
+        """Removes every file from the cache."""
+        self.evict(0)
@@ -0,0 +1,228 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2021  Fx Bricks Inc.
+# This file is part of the pfxbrick python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# PFx Brick flash image comparison
+
+import re
+
+from .pfx import *
+from .pfxfat import PFxFAT, fat_marker_dict
+from .pfxfiles import fs_sectors_for_size
+from .pfxflash import PFxFlashImage
+from .pfxhelpers import pprint_diff
+
+# size of the blocks compared first, before changed blocks are compared
+# sector by sector and changed sectors byte by byte
+PFX_DIFF_BLOCK_SZ = 0x10000
+
+# number of bytes in each row of a rendered difference
+PFX_DIFF_ROW_SZ = 16
+
+_CHANGED_RUN = re.compile(rb"[^\x00]+")
+
+
+def _image_data(image):
+    if isinstance(image, PFxFlashImage):
+        return image.data
+    return image
+
+
+def _sector_owners(image, data):
+    # Describes what each flash sector of an image holds, from the file
+    # allocation table and the file directory of the image if it has one.
+    owners = {}
+    if len(data) < PFX_FLASH_FAT_ADDR + PFX_FLASH_FAT_SZ:
+        return owners
+    fat = PFxFAT()
+    fat.from_bytes(data[PFX_FLASH_FAT_ADDR : PFX_FLASH_FAT_ADDR + PFX_FLASH_FAT_SZ])
+    for s, e in enumerate(fat.entries):
+        if e in fat_marker_dict and e != PFX_FAT_SECTOR_LAST:
+            owners[s] = fat_marker_dict[e]
+    first = PFX_FLASH_FAT_ADDR // PFX_FLASH_SECTOR_SZ
+    for s in range(first, first + PFX_FLASH_FAT_SZ // PFX_FLASH_SECTOR_SZ):
+        owners[s] = "FAT"
+    files = image.files if isinstance(image, PFxFlashImage) else []
+    if files:
+        for f in files:
+            c = fat.chain(f.firstSector, fs_sectors_for_size(f.size))
+            for s in c.sectors:
+                owners[s] = f.name
+    else:
+        for first, c in fat.chains.items():
+            for s in c.sectors:
+                owners[s] = "chain %04X" % (first)
+    return owners
+
+
+class PFxFlashDiff:
+    """
+    Differences between two PFx Brick flash images.
+
+    Attributes:
+        ranges ([(:obj:`int`, :obj:`int`)]): start and end address of each run of changed bytes
+
+        sectors ([:obj:`int`]): indexes of the flash sectors with changed bytes
+
+        owners ({:obj:`int`: (:obj:`str`, :obj:`str`)}): what each changed sector holds in the first and second image, e.g. a filename, 'free' or 'FAT'
+    """
+
+    def __init__(self, a, b):
+        self._a = _image_data(a)
+        self._b = _image_data(b)
+        self.ranges = []
+        self.sectors = []
+        self.owners = {}
+
+    @property
+    def bytes_changed(self):
+        """Number of changed bytes."""
+        return sum(end - start for start, end in self.ranges)
+
+    def changed_files(self):
+        """
+        Returns the names of the files with changed sectors in either image,
+        or of the sector chains if an image has no file directory.
+
+        :returns: [:obj:`str`] sorted filenames
+        """
+        names = set()
+        for a, b in self.owners.values():
+            names.update(
+                x
+                for x in (a, b)
+                if x and x not in fat_marker_dict.values() and x != "FAT"
+            )
+        return sorted(names)
+
+    def windows(self, context=1):
+        """
+        Returns the address ranges to render, which are the rows with
+        changed bytes together with a number of rows of context.  Windows
+        which overlap are merged.
+
+        :param context: :obj:`int` number of unchanged rows shown before and after changed rows
+        :returns: [(:obj:`int`, :obj:`int`)] start and end address of each window
+        """
+        n = min(len(self._a), len(self._b))
+        windows = []
+        for start, end in self.ranges:
+            w0 = max((start // PFX_DIFF_ROW_SZ - context) * PFX_DIFF_ROW_SZ, 0)
+            w1 = min((-(-end // PFX_DIFF_ROW_SZ) + context) * PFX_DIFF_ROW_SZ, n)
+            if w0 >= w1:
+                continue
+            if windows and w0 <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(w1, windows[-1][1]))
+            else:
+                windows.append((w0, w1))
+        return windows
+
+    def pprint(self, context=1):
+        """
+        Prints the changed windows of the images side by side, with changed
+        bytes highlighted.
+
+        :param context: :obj:`int` number of unchanged rows shown before and after changed rows
+        """
+        for i, (w0, w1) in enumerate(self.windows(context)):
+            if i:
+                print("...")
+            pprint_diff(self._a[w0:w1], self._b[w0:w1], address=w0)
+
+    def __str__(self):
+        sb = []
+        for s in self.sectors:
+            n = 0
+            a0 = s * PFX_FLASH_SECTOR_SZ
+            a1 = a0 + PFX_FLASH_SECTOR_SZ
+            for start, end in self.ranges:
+                if start < a1 and end > a0:
+                    n += min(end, a1) - max(start, a0)
+            a, b = self.owners.get(s, ("", ""))
+            sb.append(
+                "%04X %06X %5d bytes  %s%s"
+                % (s, a0, n, a, " -> %s" % (b) if b != a else "")
+            )
+        sb.append(
+            "%d bytes changed in %d sectors, files changed: %s"
+            % (
+                self.bytes_changed,
+                len(self.sectors),
+                ", ".join(self.changed_files()) or "none",
+            )
+        )
+        return "\n".join(sb)
+
+
+def _diff_range(da, db, start, end, ranges):
+    # Appends the runs of changed bytes between start and end, found from
+    # the runs of non-zero bytes in the XOR of both images.
+    n = end - start
+    x = int.from_bytes(da[start:end], "big") ^ int.from_bytes(db[start:end], "big")
+    for m in _CHANGED_RUN.finditer(x.to_bytes(n, "big")):
+        s, e = start + m.start(), start + m.end()
+        if ranges and ranges[-1][1] == s:
+            ranges[-1] = (ranges[-1][0], e)
+        else:
+            ranges.append((s, e))
+
+
+def diff_flash_images(a, b, block=PFX_DIFF_BLOCK_SZ):
+    """
+    Compares two flash images and finds what changed between them.
+
+    Large blocks of both images are compared first, and only blocks which
+    differ are compared sector by sector.  The changed bytes in each changed
+    sector are then found all at once from the XOR of both sectors, so that
+    the time taken depends on how much has changed rather than on the size
+    of the images.  Changed sectors are attributed to files through the
+    file allocation table of each image.
+
+    :param a: the first image, a :obj:`PFxFlashImage` or any bytes-like object
+    :param b: the second image, a :obj:`PFxFlashImage` or any bytes-like object
+    :param block: :obj:`int` size of the blocks compared first, a multiple of the flash sector size
+    :returns: :obj:`PFxFlashDiff`
+    """
+    diff = PFxFlashDiff(a, b)
+    da, db = diff._a, diff._b
+    n = min(len(da), len(db))
+    for x in range(0, n, block):
+        x1 = min(x + block, n)
+        if da[x:x1] == db[x:x1]:
+            continue
+        for s0 in range(x, x1, PFX_FLASH_SECTOR_SZ):
+            s1 = min(s0 + PFX_FLASH_SECTOR_SZ, x1)
+            if da[s0:s1] != db[s0:s1]:
+                diff.sectors.append(s0 // PFX_FLASH_SECTOR_SZ)
+                _diff_range(da, db, s0, s1, diff.ranges)
+    if len(da) != len(db):
+        diff.ranges.append((n, max(len(da), len(db))))
+        last = (max(len(da), len(db)) - 1) // PFX_FLASH_SECTOR_SZ
+        for s in range(n // PFX_FLASH_SECTOR_SZ, last + 1):
+            if s not in diff.sectors:
+                diff.sectors.append(s)
+    if diff.sectors:
+        owners_a = _sector_owners(a, da)
+        owners_b = _sector_owners(b, db)
+        for s in diff.sectors:
+            diff.owners[s] = (owners_a.get(s, ""), owners_b.get(s, ""))
+    return diff
@@ -0,0 +1,560 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2021  Fx Bricks Inc.
+# This file is part of the pfxbrick python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# PFx Brick virtual device emulator
+
+import logging
+import threading
+import time
+import zlib
+from collections import deque
+
+from pfxbrick import *
+from pfxbrick.pfxhelpers import *
+from pfxbrick.pfxtransport import PFxTransport
+
+# maps each byte of a PFX_CMD_SET_CONFIG message payload to its position
+# in the PFX_CMD_GET_CONFIG response
+_SET_TO_GET_CONFIG = (
+    [7]
+    + list(range(8, 15))
+    + list(range(15, 26))
+    + list(range(26, 31))
+    + [35, 36, 37]
+    + list(range(38, 62))
+    + [62, 63]
+    + list(range(1, 7))
+    + [31, 32, 33, 34]
+)
+
+
+class PFxVirtualFile:
+    """A file stored in the flash memory of a :obj:`PFxVirtualBrick`."""
+
+    def __init__(self, id, name, size, sectors):
+        self.id = id
+        self.name = name
+        self.size = size
+        self.sectors = sectors
+        self.attributes = 0
+        self.userData1 = 0
+        self.userData2 = 0
+        self.crc32 = 0
+
+    @property
+    def firstSector(self):
+        return self.sectors[0] if self.sectors else 0xFFFF
+
+    def to_bytes(self):
+        """Returns the directory entry bytes used in PFX_CMD_FILE_DIR responses."""
+        msg = [self.id]
+        msg.extend(uint32_to_bytes(self.size))
+        msg.extend(uint16_to_bytes(self.firstSector))
+        msg.extend(uint16_to_bytes(self.attributes))
+        msg.extend(uint32_to_bytes(self.userData1))
+        msg.extend(uint32_to_bytes(self.userData2))
+        msg.extend(uint32_to_bytes(self.crc32))
+        nb = bytes(self.name, "utf-8")[:32]
+        msg.extend(nb)
+        msg.extend([0] * (32 - len(nb)))
+        return msg
+
+
+class PFxVirtualBrick(PFxTransport):
+    """
+    An in-process software PFx Brick which answers ICD messages.
+
+    The virtual PFx Brick keeps its flash memory, file system, configuration,
+    event/action LUT and name in memory.  Files are stored in 4 kB flash
+    sectors linked by a file allocation table kept at `PFX_FLASH_FAT_ADDR`
+    like a real PFx Brick, so that flash reads return the same kind of
+    content and the FAT tools work for any emulated flash size.
+    It is a :obj:`PFxTransport` and is opened with
+    ``PFxBrick().open(transport=PFxVirtualBrick())``.
+
+    Attributes:
+        serial_no (:obj:`str`): 8-digit hex serial number reported in the status
+
+        product_id (:obj:`int`): product part number, e.g. PFX_PFXBRICK_16MB_PN
+
+        product_desc (:obj:`str`): product descriptor reported in the status
+
+        icd_rev (:obj:`str`): ICD revision reported, e.g. '3.39'
+
+        firmware_ver (:obj:`str`): firmware version reported, e.g. '1.40'
+
+        flash (:obj:`bytearray`): contents of the flash memory, at least large enough to hold the file allocation table
+
+        flash_size (:obj:`int`): size of the flash memory available for files
+
+        files ({:obj:`int`: :obj:`PFxVirtualFile`}): files stored in the file system by file ID
+
+        latency (:obj:`float`): delay in seconds added to every request
+
+        notifications (:obj:`int`): notification flags most recently set
+    """
+
+    manufacturer_string = "Fx Bricks"
+
+    def __init__(
+        self,
+        serial_no="A0000001",
+        product_id=PFX_PFXBRICK_16MB_PN,
+        product_desc=PFX_PFXBRICK_16MB_DESC,
+        flash_size=PFX_PFXBRICK_16MB_FLASH_SZ,
+        icd_rev=None,
+        firmware_ver="1.40",
+        name="",
+        latency=0.0,
+    ):
+        self.serial_no = serial_no.upper()
+        self.product_id = product_id
+        self.product_desc = product_desc
+        self.icd_rev = icd_rev if icd_rev is not None else ICD_REV
+        self.firmware_ver = firmware_ver
+        self.firmware_build = 1
+        self.latency = latency
+        self.notifications = 0
+        self.flash_size = flash_size
+        self.flash = bytearray(
+            b"\xFF" * max(flash_size, PFX_FLASH_FAT_ADDR + PFX_FLASH_FAT_SZ)
+        )
+        self.fat_addr = PFX_FLASH_FAT_ADDR
+        self.files = {}
+        self._name = bytes(name, "utf-8")[:PFX_NAME_MAX]
+        self._actions = [[0] * 16 for _ in range(EVT_LUT_MAX + 1)]
+        self._config = [PFX_CMD_GET_CONFIG | 0x80] + [0] * 63
+        self._default_config = PFxConfig(icd_rev=self.icd_rev).to_bytes()
+        self._set_config(self._default_config)
+        self._open = {}
+        self._write_fid = None
+        self._rx = deque()
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic()
+        self._log = logging.getLogger(str(self.__class__))
+        self._format()
+
+    @property
+    def product_string(self):
+        return self.product_desc
+
+    @property
+    def serial_number_string(self):
+        return self.serial_no
+
+    @property
+    def num_sectors(self):
+        """Number of flash sectors covered by the file allocation table."""
+        return min(self.flash_size // PFX_FLASH_SECTOR_SZ, PFX_FLASH_FAT_SZ // 2)
+
+    def fat_entry(self, sector):
+        """Returns the file allocation table entry for a flash sector."""
+        a = self.fat_addr + 2 * sector
+        return self.flash[a] | (self.flash[a + 1] << 8)
+
+    def _set_fat_entry(self, sector, value):
+        a = self.fat_addr + 2 * sector
+        self.flash[a] = value & 0xFF
+        self.flash[a + 1] = (value >> 8) & 0xFF
+
+    def free_sectors(self):
+        """Returns a list of unallocated flash sector indexes in ascending order."""
+        return [
+            x
+            for x in range(self.num_sectors)
+            if self.fat_entry(x) == PFX_FAT_SECTOR_FREE
+        ]
+
+    def capacity(self):
+        """Returns the number of bytes available for files in an empty file system."""
+        reserved = sum(
+            1
+            for x in range(self.num_sectors)
+            if self.fat_entry(x) == PFX_FAT_SECTOR_RESERVED
+        )
+        return (self.num_sectors - reserved) * PFX_FLASH_SECTOR_SZ
+
+    def add_file(self, fid, name, data, attributes=0):
+        """
+        Stores a file directly in the file system without ICD messages,
+        e.g. to prepare the contents of the virtual PFx Brick before a test.
+
+        :param fid: :obj:`int` file ID
+        :param name: :obj:`str` filename
+        :param data: :obj:`bytes` file contents
+        :param attributes: :obj:`int` 16-bit file attributes
+        :returns: :obj:`PFxVirtualFile` or None if the file system is full
+        """
+        f = self._create(fid, name, len(data))
+        if f is None:
+            return None
+        self._write(f, 0, data)
+        f.crc32 = zlib.crc32(data) & 0xFFFFFFFF
+        f.attributes = attributes
+        return f
+
+    def file_data(self, fid):
+        """Returns the contents of a file as :obj:`bytes` or None if not found."""
+        if fid not in self.files:
+            return None
+        f = self.files[fid]
+        return self._read(f, 0, f.size)
+
+    def send(self, msg):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self._lock:
+            res = self.process(msg)
+            if res is not None:
+                self._rx.append(res)
+
+    def receive(self):
+        with self._lock:
+            if self._rx:
+                return self._rx.popleft()
+        return []
+
+    def close(self):
+        self._rx.clear()
+
+    def process(self, msg):
+        """
+        Handles an ICD message and returns the response message, or None for
+        messages which have no response.
+
+        :param msg: [:obj:`int`] ICD message as an integer list of bytes
+        :returns: [:obj:`int`] 64 byte response
+        """
+        msg = list(msg)
+        handler = self._handlers.get(msg[0])
+        res = [msg[0] | 0x80] + [0] * 63
+        if handler is None:
+            self._log.warning("Unsupported ICD message 0x%02X" % (msg[0]))
+            return res
+        return handler(self, msg, res)
+
+    # ICD message handlers
+
+    def _get_icd_rev(self, msg, res):
+        res[1], res[2] = ver_to_bytes(self.icd_rev)
+        return res
+
+    def _get_status(self, msg, res):
+        res[1] = PFX_STATUS_NORMAL
+        res[2] = PFX_ERR_NONE
+        res[7:9] = uint16_to_bytes(self.product_id)
+        res[9:13] = uint32_to_bytes(int(self.serial_no, 16))
+        desc = bytes(self.product_desc, "utf-8")[:24]
+        res[13 : 13 + len(desc)] = desc
+        res[37], res[38] = ver_to_bytes(self.firmware_ver)
+        res[39:41] = uint16_to_bytes(self.firmware_build)
+        return res
+
+    def _set_config(self, cfgbytes):
+        for idx, b in zip(_SET_TO_GET_CONFIG, cfgbytes):
+            self._config[idx] = b
+
+    def _get_config(self, msg, res):
+        return list(self._config)
+
+    def _set_config_msg(self, msg, res):
+        self._set_config(msg[1:])
+        return res
+
+    def _set_factory_defaults(self, msg, res):
+        self._set_config(self._default_config)
+        self._name = b""
+        self._actions = [[0] * 16 for _ in range(EVT_LUT_MAX + 1)]
+        return res
+
+    def _get_name(self, msg, res):
+        res[1 : 1 + len(self._name)] = self._name
+        return res
+
+    def _set_name(self, msg, res):
+        self._name = bytes(msg[1 : 1 + PFX_NAME_MAX]).rstrip(b"\x00")
+        return res
+
+    def _get_event_action(self, msg, res):
+        res[1:17] = self._actions[(msg[1] << 2) | (msg[2] & 0x03)]
+        return res
+
+    def _set_event_action(self, msg, res):
+        action = msg[3:19]
+        self._actions[(msg[1] << 2) | (msg[2] & 0x03)] = action + [0] * (
+            16 - len(action)
+        )
+        return res
+
+    def _get_current_state(self, msg, res):
+        res[1] = self._config[63]
+        res[2] = self._config[62]
+        ms = int((time.monotonic() - self._t0) * 1000)
+        res[53:55] = uint16_to_bytes(ms & 0xFFFF)
+        res[55:57] = uint16_to_bytes((ms // 1000) & 0xFFFF)
+        return res
+
+    def _set_notifications(self, msg, res):
+        self.notifications = msg[1]
+        return res
+
+    def _read_flash(self, msg, res):
+        add = uint32_toint(msg[1:5])
+        n = min(msg[5], 63)
+        data = self.flash[add : add + n]
+        res[1 : 1 + len(data)] = data
+        return res
+
+    # file system
+
+    def _format(self):
+        self.files = {}
+        self._open = {}
+        self._write_fid = None
+        # the sectors holding the FAT and any beyond the end of a smaller
+        # flash memory are reserved
+        fat_sector = self.fat_addr // PFX_FLASH_SECTOR_SZ
+        self.flash[:] = b"\xFF" * len(self.flash)
+        for x in range(min(fat_sector, self.num_sectors), PFX_FLASH_FAT_SZ // 2):
+            self._set_fat_entry(x, PFX_FAT_SECTOR_RESERVED)
+
+    def _create(self, fid, name, size):
+        if fid in self.files:
+            self._remove(fid)
+        nsectors = fs_sectors_for_size(size)
+        free = self.free_sectors()
+        if nsectors > len(free):
+            return None
+        sectors = free[:nsectors]
+        for s, n in zip(sectors, sectors[1:]):
+            self._set_fat_entry(s, n)
+        self._set_fat_entry(sectors[-1], PFX_FAT_SECTOR_LAST)
+        f = PFxVirtualFile(fid, name, size, sectors)
+        self.files[fid] = f
+        return f
+
+    def _remove(self, fid):
+        f = self.files.pop(fid)
+        for s in f.sectors:
+            self._set_fat_entry(s, PFX_FAT_SECTOR_FREE)
+            a = s * PFX_FLASH_SECTOR_SZ
+            self.flash[a : a + PFX_FLASH_SECTOR_SZ] = b"\xFF" * PFX_FLASH_SECTOR_SZ
+        self._open.pop(fid, None)
+        if self._write_fid == fid:
+            self._write_fid = None
+
+    def _write(self, f, pos, data):
+        while data:
+            sector, offset = divmod(pos, PFX_FLASH_SECTOR_SZ)
+            n = min(len(data), PFX_FLASH_SECTOR_SZ - offset)
+            a = f.sectors[sector] * PFX_FLASH_SECTOR_SZ + offset
+            self.flash[a : a + n] = data[:n]
+            data = data[n:]
+            pos += n
+
+    def _read(self, f, pos, n):
+        rb = bytearray()
+        while n > 0:
+            sector, offset = divmod(pos, PFX_FLASH_SECTOR_SZ)
+            nr = min(n, PFX_FLASH_SECTOR_SZ - offset)
+            a = f.sectors[sector] * PFX_FLASH_SECTOR_SZ + offset
+            rb.extend(self.flash[a : a + nr])
+            n -= nr
+            pos += nr
+        return bytes(rb)
+
+    def _file_open(self, msg, res):
+        fid, mode = msg[1], msg[2]
+        if mode & PFX_FILE_ACC_CREATE:
+            size = uint32_toint(msg[3:7])
+            name = safe_unicode_str(msg[7:39])
+            f = self._create(fid, name, size)
+            if f is None:
+                res[1] = PFX_ERR_FILE_SYSTEM_FULL
+                return res
+        elif fid not in self.files:
+            res[1] = PFX_ERR_FILE_NOT_FOUND
+            return res
+        self._open[fid] = {"mode": mode, "pos": 0}
+        if mode & PFX_FILE_ACC_WRITE:
+            self._write_fid = fid
+        return res
+
+    def _file_close(self, msg, res):
+        fid = msg[1]
+        if fid not in self._open:
+            res[1] = PFX_ERR_FILE_INVALID
+            return res
+        acc = self._open.pop(fid)
+        if acc["mode"] & PFX_FILE_ACC_WRITE:
+            f = self.files[fid]
+            f.crc32 = zlib.crc32(self._read(f, 0, f.size)) & 0xFFFFFFFF
+            if self._write_fid == fid:
+                self._write_fid = None
+        return res
+
+    def _file_write_data(self, fid, data, res):
+        if fid not in self._open or not self._open[fid]["mode"] & PFX_FILE_ACC_WRITE:
+            res[1] = PFX_ERR_FILE_ACCESS_DENIED
+            return res
+        f = self.files[fid]
+        acc = self._open[fid]
+        if acc["pos"] + len(data) > f.size:
+            res[1] = PFX_ERR_FILE_TOO_BIG
+            return res
+        self._write(f, acc["pos"], data)
+        acc["pos"] += len(data)
+        res[1] = len(data)
+        return res
+
+    def _file_write(self, msg, res):
+        return self._file_write_data(msg[1], bytes(msg[3 : 3 + msg[2]]), res)
+
+    def _file_write_fast(self, msg, res):
+        res = self._file_write_data(self._write_fid, bytes(msg[2 : 2 + msg[1]]), res)
+        if res[1] > 62:
+            self._log.error("Fast write failed: %s" % (get_error_str(res[1])))
+        return None
+
+    def _file_read(self, msg, res):
+        fid = msg[1]
+        if fid not in self._open or not self._open[fid]["mode"] & PFX_FILE_ACC_READ:
+            res[1] = PFX_ERR_FILE_ACCESS_DENIED
+            return res
+        f = self.files[fid]
+        acc = self._open[fid]
+        n = max(min(msg[2], 62, f.size - acc["pos"]), 0)
+        data = self._read(f, acc["pos"], n)
+        acc["pos"] += n
+        res[1] = n
+        res[2 : 2 + n] = data
+        return res
+
+    def _file_seek(self, msg, res):
+        fid = msg[1]
+        if fid not in self._open:
+            res[1] = PFX_ERR_FILE_INVALID
+            return res
+        offset = uint32_toint(msg[2:6])
+        if offset > self.files[fid].size:
+            res[1] = PFX_ERR_FILE_OUT_OF_RANGE
+            return res
+        self._open[fid]["pos"] = offset
+        return res
+
+    def _file_remove(self, msg, res):
+        if msg[1] not in self.files:
+            res[1] = PFX_ERR_FILE_NOT_FOUND
+        else:
+            self._remove(msg[1])
+        return res
+
+    def _file_format(self, msg, res):
+        self._format()
+        return res
+
+    def _file_get_fs_state(self, msg, res):
+        free = len(self.free_sectors())
+        res[1] = len(self.files) & 0xFF
+        res[12:14] = uint16_to_bytes(self.capacity() // PFX_FLASH_SECTOR_SZ)
+        res[14:16] = uint16_to_bytes(free)
+        res[16:18] = uint16_to_bytes(free)
+        res[18:20] = uint16_to_bytes(len(self._open))
+        return res
+
+    def _file_dir(self, msg, res):
+        req = msg[1]
+        res[1] = req
+        if req == PFX_DIR_REQ_GET_FILE_COUNT:
+            res[3:5] = uint16_to_bytes(len(self.files))
+            return res
+        if req == PFX_DIR_REQ_GET_FREE_SPACE:
+            res[3:7] = uint32_to_bytes(len(self.free_sectors()) * PFX_FLASH_SECTOR_SZ)
+            res[7:11] = uint32_to_bytes(self.capacity())
+            return res
+        if req == PFX_DIR_REQ_GET_NAMED_FILE_ID:
+            name = safe_unicode_str(msg[3 : 3 + msg[2]])
+            res[2] = PFX_ERR_FILE_NOT_FOUND
+            for f in self.files.values():
+                if f.name == name:
+                    res[2] = f.id
+            return res
+        if req == PFX_DIR_REQ_GET_DIR_ENTRY_IDX:
+            ids = sorted(self.files)
+            f = self.files[ids[msg[2] - 1]] if 0 < msg[2] <= len(ids) else None
+        else:
+            f = self.files.get(msg[2])
+        if f is None:
+            res[2] = PFX_ERR_FILE_NOT_FOUND
+            res[3] = PFX_FILE_INVALID_ID
+            return res
+        if req == PFX_DIR_REQ_RENAME_FILE_ID:
+            f.name = safe_unicode_str(msg[3:35])
+        elif req == PFX_DIR_REQ_SET_ATTR_ID:
+            f.attributes = uint16_toint(msg[3:5])
+        elif req == PFX_DIR_REQ_SET_ATTR_MASKED_ID:
+            mask = msg[6] << 8
+            f.attributes = (f.attributes & ~mask) | ((msg[4] << 8) & mask)
+        elif req == PFX_DIR_REQ_SET_USER_DATA1_ID:
+            f.userData1 = uint32_toint(msg[3:7])
+        elif req == PFX_DIR_REQ_SET_USER_DATA2_ID:
+            f.userData2 = uint32_toint(msg[3:7])
+        elif req == PFX_DIR_REQ_COMPUTE_CRC32_ID:
+            f.crc32 = zlib.crc32(self._read(f, 0, f.size)) & 0xFFFFFFFF
+        elif req not in (PFX_DIR_REQ_GET_DIR_ENTRY_IDX, PFX_DIR_REQ_GET_DIR_ENTRY_ID):
+            res[2] = PFX_ERR_FILE_INVALID
+            return res
+        entry = f.to_bytes()
+        res[3 : 3 + len(entry)] = entry
+        return res
+
+    def _ack(self, msg, res):
+        return res
+
+    _handlers = {
+        PFX_CMD_GET_ICD_REV: _get_icd_rev,
+        PFX_CMD_GET_STATUS: _get_status,
+        PFX_CMD_GET_CONFIG: _get_config,
+        PFX_CMD_SET_CONFIG: _set_config_msg,
+        PFX_CMD_SET_FACTORY_DEFAULTS: _set_factory_defaults,
+        PFX_CMD_GET_NAME: _get_name,
+        PFX_CMD_SET_NAME: _set_name,
+        PFX_CMD_GET_EVENT_ACTION: _get_event_action,
+        PFX_CMD_SET_EVENT_ACTION: _set_event_action,
+        PFX_CMD_TEST_ACTION: _ack,
+        PFX_CMD_RUN_SCRIPT: _ack,
+        PFX_CMD_GET_CURRENT_STATE: _get_current_state,
+        PFX_CMD_GET_BT_STATUS: _ack,
+        PFX_CMD_SET_NOTIFICATIONS: _set_notifications,
+        PFX_CMD_READ_FLASH: _read_flash,
+        PFX_CMD_FILE_OPEN: _file_open,
+        PFX_CMD_FILE_CLOSE: _file_close,
+        PFX_CMD_FILE_READ: _file_read,
+        PFX_CMD_FILE_WRITE: _file_write,
+        PFX_CMD_FILE_WRITE_FAST: _file_write_fast,
+        PFX_CMD_FILE_SEEK: _file_seek,
+        PFX_CMD_FILE_REMOVE: _file_remove,
+        PFX_CMD_FILE_FORMAT_FS: _file_format,
+        PFX_CMD_FILE_GET_FS_STATE: _file_get_fs_state,
+        PFX_CMD_FILE_DIR: _file_dir,
+    }
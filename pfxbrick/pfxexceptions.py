@@ -34,6 +34,10 @@ class ResponseTimeoutException(Exception):
     pass
 
 
+class USBResponseTimeoutException(ResponseTimeoutException):
+    pass
+
+
 class BLEConnectTimeoutException(Exception):
     pass
 
@@ -44,3 +48,19 @@ class BLEDeviceDisconnectedException(Exception):
 
 class BLEDeviceMissingAddressException(Exception):
     pass
+
+
+class ReplayMismatchException(InvalidResponseException):
+    pass
+
+
+class FileCRCMismatchException(Exception):
+    pass
+
+
+class FileSystemFullException(Exception):
+    pass
+
+
+class FlashReadException(InvalidResponseException):
+    pass
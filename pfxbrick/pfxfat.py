@@ -0,0 +1,287 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2021  Fx Bricks Inc.
+# This file is part of the pfxbrick python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# PFx Brick file allocation table
+
+import array
+import sys
+
+from .pfx import *
+from .pfxfiles import fs_sectors_for_size
+
+# fraction of non-contiguous sector links in files, or of free space outside
+# the largest free extent, above which a reformat and re-copy is suggested
+PFX_FAT_REFORMAT_THRESHOLD = 0.25
+
+# names of the markers which can be stored in a file allocation table entry
+fat_marker_dict = {
+    PFX_FAT_SECTOR_FREE: "free",
+    PFX_FAT_SECTOR_LAST: "last",
+    PFX_FAT_SECTOR_RESERVED: "reserved",
+    PFX_FAT_SECTOR_SYSTEM: "system",
+    PFX_FAT_SECTOR_BAD: "bad",
+}
+
+
+class PFxFATChain:
+    """
+    A chain of flash sectors linked by the file allocation table.
+
+    Attributes:
+        first (:obj:`int`): index of the first sector
+
+        sectors ([:obj:`int`]): sector indexes in file order
+
+        complete (:obj:`boolean`): True if the chain ends with a last sector marker
+
+        fragments (:obj:`int`): number of runs of consecutive sectors in the chain
+    """
+
+    def __init__(self, first=0):
+        self.first = first
+        self.sectors = []
+        self.complete = False
+        self.fragments = 0
+
+    def __len__(self):
+        return len(self.sectors)
+
+    def __str__(self):
+        return "%04X %5d sectors %4d fragments%s" % (
+            self.first,
+            len(self.sectors),
+            self.fragments,
+            "" if self.complete else " incomplete",
+        )
+
+
+class PFxFAT:
+    """
+    Parsed PFx Brick file allocation table (FAT).
+
+    The FAT holds one 16-bit entry for each 4 kB flash sector.  The entry
+    of a sector which belongs to a file is the index of the next sector of
+    the file, or :obj:`PFX_FAT_SECTOR_LAST` for its last sector.  Other
+    sectors are marked free, reserved, etc.
+
+    Attributes:
+        entries (:obj:`array.array`): the 16-bit entry of each sector
+
+        chains ({:obj:`int`: :obj:`PFxFATChain`}): sector chains keyed by their first sector
+
+        free_runs ([(:obj:`int`, :obj:`int`)]): first sector and number of sectors of each run of free sectors
+
+        markers ({:obj:`int`: :obj:`int`}): number of entries with each marker value
+    """
+
+    def __init__(self):
+        self.entries = array.array("H")
+        self.chains = {}
+        self.free_runs = []
+        self.markers = {}
+
+    def from_bytes(self, data):
+        """
+        Parses the raw little-endian contents of the FAT, e.g. as read from
+        the flash memory at :obj:`PFX_FLASH_FAT_ADDR`.
+        """
+        self.entries = array.array("H")
+        self.entries.frombytes(bytes(data[: len(data) & ~1]))
+        if sys.byteorder == "big":
+            self.entries.byteswap()
+        self._analyze()
+
+    def to_bytes(self):
+        """Returns the raw little-endian contents of the FAT."""
+        a = array.array("H", self.entries)
+        if sys.byteorder == "big":
+            a.byteswap()
+        return a.tobytes()
+
+    @property
+    def num_sectors(self):
+        """Number of flash sectors covered by the FAT."""
+        return len(self.entries)
+
+    def _analyze(self):
+        n = self.num_sectors
+        self.markers = {}
+        self.free_runs = []
+        referenced = set()
+        start = None
+        for s, e in enumerate(self.entries):
+            if e < n:
+                referenced.add(e)
+            elif e >= PFX_FAT_SECTOR_MARKER:
+                self.markers[e] = self.markers.get(e, 0) + 1
+            if e == PFX_FAT_SECTOR_FREE:
+                if start is None:
+                    start = s
+            elif start is not None:
+                self.free_runs.append((start, s - start))
+                start = None
+        if start is not None:
+            self.free_runs.append((start, n - start))
+        self.chains = {}
+        for s, e in enumerate(self.entries):
+            if (e < n or e == PFX_FAT_SECTOR_LAST) and s not in referenced:
+                self.chains[s] = self.chain(s)
+
+    def entry(self, sector):
+        """Returns the FAT entry of a flash sector."""
+        return self.entries[sector]
+
+    def chain(self, first, max_sectors=None):
+        """
+        Follows the chain of sectors which starts at a sector.  The chain
+        stops at a last sector marker, at any other marker, or where it
+        would loop back on itself.
+
+        :param first: :obj:`int` index of the first sector, e.g. :obj:`PFxFile.firstSector`
+        :param max_sectors: :obj:`int` optional maximum number of sectors to follow
+        :returns: :obj:`PFxFATChain`
+        """
+        c = PFxFATChain(first)
+        n = self.num_sectors
+        seen = set()
+        s = first
+        while s < n and s not in seen:
+            if max_sectors is not None and len(c.sectors) >= max_sectors:
+                break
+            if c.sectors and s != c.sectors[-1] + 1:
+                c.fragments += 1
+            elif not c.sectors:
+                c.fragments = 1
+            c.sectors.append(s)
+            seen.add(s)
+            s = self.entries[s]
+            if s == PFX_FAT_SECTOR_LAST:
+                c.complete = True
+                break
+        return c
+
+    def file_chains(self, files):
+        """
+        Returns the sector chain of each file in a file directory.
+
+        :param files: [:obj:`PFxFile`] directory entries, e.g. :obj:`PFxDir.files`
+        :returns: [(:obj:`PFxFile`, :obj:`PFxFATChain`)]
+        """
+        return [
+            (f, self.chain(f.firstSector, fs_sectors_for_size(f.size))) for f in files
+        ]
+
+    @property
+    def free_sectors(self):
+        """Number of free sectors."""
+        return self.markers.get(PFX_FAT_SECTOR_FREE, 0)
+
+    @property
+    def used_sectors(self):
+        """Number of sectors in file chains."""
+        return sum(len(c) for c in self.chains.values())
+
+    def largest_free_extent(self):
+        """
+        Returns the largest run of consecutive free sectors.
+
+        :returns: (:obj:`int`, :obj:`int`) first sector and number of sectors, (0, 0) if there are no free sectors
+        """
+        return max(self.free_runs, key=lambda r: r[1], default=(0, 0))
+
+    def fragmentation(self):
+        """
+        Returns the fragmentation of files as the fraction of links between
+        sectors of a file which are not to the following sector.
+
+        :returns: :obj:`float` from 0.0 for contiguous files to 1.0
+        """
+        links = sum(len(c) - 1 for c in self.chains.values())
+        breaks = sum(c.fragments - 1 for c in self.chains.values())
+        return breaks / links if links else 0.0
+
+    def free_fragmentation(self):
+        """
+        Returns the fragmentation of free space as the fraction of free
+        sectors which are outside the largest free extent.
+
+        :returns: :obj:`float` from 0.0 for one free extent to nearly 1.0
+        """
+        if not self.free_sectors:
+            return 0.0
+        return 1.0 - self.largest_free_extent()[1] / self.free_sectors
+
+    def fits(self, nBytes):
+        """Returns True if there are enough free sectors for a file of nBytes."""
+        return fs_sectors_for_size(nBytes) <= self.free_sectors
+
+    def fits_contiguous(self, nBytes):
+        """Returns True if a file of nBytes fits in the largest free extent."""
+        return fs_sectors_for_size(nBytes) <= self.largest_free_extent()[1]
+
+    def needs_reformat(self, nBytes=None, threshold=PFX_FAT_REFORMAT_THRESHOLD):
+        """
+        Suggests whether reformatting and copying the files again would be
+        worthwhile, i.e. when the files or free space are fragmented beyond
+        a threshold.  Files need not be contiguous, so a file which fits in
+        the free space can always be copied.  A reformat does not free any
+        space, so it is never suggested for a file of nBytes which does not
+        fit; check :obj:`fits` for that.
+
+        :param nBytes: :obj:`int` optional size of a file which is to be copied
+        :param threshold: :obj:`float` fragmentation above which a reformat is suggested
+        :returns: :obj:`boolean`
+        """
+        if nBytes is not None and not self.fits(nBytes):
+            return False
+        return self.fragmentation() > threshold or self.free_fragmentation() > threshold
+
+    def __str__(self):
+        """
+        Convenient human readable summary of the FAT. This allows a
+        :py:class:`PFxFAT` object to be used with :obj:`str` and :obj:`print` methods.
+        """
+        start, n = self.largest_free_extent()
+        sb = []
+        sb.append(
+            "%d sectors: %d used by %d files, %d free"
+            % (self.num_sectors, self.used_sectors, len(self.chains), self.free_sectors)
+        )
+        for marker, count in sorted(self.markers.items()):
+            if marker not in (PFX_FAT_SECTOR_FREE, PFX_FAT_SECTOR_LAST):
+                name = fat_marker_dict.get(marker, "marker")
+                sb.append("  %04X %-8s %d sectors" % (marker, name, count))
+        sb.append(
+            "%d free runs, largest free extent %d sectors (%.1f kB) at %04X"
+            % (
+                len(self.free_runs),
+                n,
+                float(n * PFX_FLASH_SECTOR_SZ / 1000),
+                start,
+            )
+        )
+        sb.append(
+            "File fragmentation %.1f%%, free space fragmentation %.1f%%"
+            % (100 * self.fragmentation(), 100 * self.free_fragmentation())
+        )
+        return "\n".join(sb)
@@ -28,8 +28,10 @@ import time
 
 from pfxbrick import *
 from pfxbrick.pfxdict import file_attr_dict, fileid_dict
+from pfxbrick.pfxexceptions import InvalidResponseException, ResponseTimeoutException
 from pfxbrick.pfxhelpers import *
-from pfxbrick.pfxmsg import cmd_file_dir, usb_transaction
+from pfxbrick.pfxmsg import cmd_file_dir, msg_batch_transaction, msg_transaction
+from pfxbrick.pfxtransport import get_transport
 
 # fmt: off
 try:
@@ -42,6 +44,19 @@ except:
     has_rich = False
 # fmt: on
 
+# number of frames written back to back between checks of the write status
+PFX_FILE_WRITE_WINDOW = 64
+
+# number of times an interrupted file upload is resumed before giving up
+PFX_FILE_TRANSFER_RETRIES = 3
+
+# exceptions raised by a USB glitch during a file transfer
+PFX_TRANSFER_ERRORS = (ResponseTimeoutException, InvalidResponseException, OSError)
+
+# number of file read requests pipelined for each chunk of file data, chosen
+# so that a chunk is a whole number of 16 byte rows in a hex dump
+PFX_FILE_READ_WINDOW = 64
+
 if has_rich:
     progress = Progress(
         TextColumn("[white]{task.fields[filename]}", justify="right"),
@@ -56,6 +71,19 @@ if has_rich:
     )
 
 
+def fs_sectors_for_size(nBytes):
+    """Returns the number of flash sectors occupied by a file of nBytes."""
+    return max((nBytes + PFX_FLASH_SECTOR_SZ - 1) // PFX_FLASH_SECTOR_SZ, 1)
+
+
+def _first_free_file_id(used_ids):
+    # the lowest file ID which is clear in a bitmap of used file IDs, or None
+    x = (~used_ids & (used_ids + 1)).bit_length() - 1
+    if x < 255:
+        return x
+    return None
+
+
 def fs_get_fileid_from_name(hdev, name):
     """
     Resolves a text string filename into a numeric file ID.
@@ -92,7 +120,7 @@ def fs_format(hdev, quick=False):
     """
     Sends an ICD message to format the PFx Brick file system.
 
-    :param hdev: USB HID session handle
+    :param hdev: USB HID session handle or :obj:`PFxTransport`
     :param boolean quick: If True, only occupied sectors are erased. If False, every sector is erased, i.e. a complete format.
     """
     msg = [PFX_CMD_FILE_FORMAT_FS, PFX_FORMAT_BYTE0, PFX_FORMAT_BYTE1, PFX_FORMAT_BYTE2]
@@ -100,7 +128,7 @@ def fs_format(hdev, quick=False):
         msg.append(0)
     else:
         msg.append(1)
-    res = usb_transaction(hdev, msg)
+    res = msg_transaction(hdev, msg)
     fs_error_check(res[1])
 
 
@@ -108,16 +136,154 @@ def fs_remove_file(hdev, fid, silent=False):
     """
     Sends an ICD message to remove a file from the PFx Brick file system.
 
-    :param hdev: USB HID session handle
+    :param hdev: USB HID session handle or :obj:`PFxTransport`
     :param fid: the file ID of the file to remove
     """
     msg = [PFX_CMD_FILE_REMOVE]
     msg.append(fid)
-    res = usb_transaction(hdev, msg)
+    res = msg_transaction(hdev, msg)
     fs_error_check(res[1], silent=silent)
 
 
-def fs_copy_file_to(brick, fid, fn, show_progress=True, with_bytes=None):
+def _fs_write_window(fid, view, fast_write):
+    # Slices one window of file data into ICD write messages.  With fast
+    # writes every frame but the last is a PFX_CMD_FILE_WRITE_FAST message
+    # which has no response, and the last frame is a PFX_CMD_FILE_WRITE
+    # message whose response is the checkpoint confirming the whole window.
+    msgs = []
+    pos, n = 0, len(view)
+    if fast_write:
+        while n - pos > 61:
+            k = min(62, n - pos - 1)
+            msgs.append(bytes((PFX_CMD_FILE_WRITE_FAST, k)) + view[pos : pos + k])
+            pos += k
+    while pos < n:
+        k = min(61, n - pos)
+        msgs.append(bytes((PFX_CMD_FILE_WRITE, fid, k)) + view[pos : pos + k])
+        pos += k
+    return msgs
+
+
+def fs_write_file_data(brick, fid, src, nBytes, window=None, callback=None, offset=0):
+    """
+    Writes the data of a file which is open for writing on the PFx Brick.
+
+    Data is sent in windows of back to back frames sliced from a
+    :obj:`memoryview` of the source.  The write status is checked once per
+    window rather than after every frame, and callback is called with the
+    number of bytes written so far after each window.
+
+    :param brick: :obj:`PFxBrick` object
+    :param fid: the file ID of the open file
+    :param src: a bytes-like object or a binary file object to read nBytes from
+    :param nBytes: :obj:`int` number of bytes to write
+    :param window: :obj:`int` optional number of frames per window, defaults to `PFX_FILE_WRITE_WINDOW`
+    :param callback: optional function called as ``callback(nCount)``
+    :param offset: :obj:`int` optional position in the source and file to continue writing from
+    :returns: :obj:`int` number of bytes confirmed written, which is less than nBytes on error
+    """
+    window = window if window is not None else PFX_FILE_WRITE_WINDOW
+    fast_write = not is_version_less_than(brick.icd_rev, "3.39")
+    if fast_write:
+        block = (window - 1) * 62 + 61
+    else:
+        block = window * 61
+    if hasattr(src, "readinto"):
+        bufview = memoryview(bytearray(block))
+        src.seek(offset)
+    else:
+        bufview = None
+        srcview = memoryview(src).cast("B")
+    nCount = offset
+    while nCount < nBytes:
+        n = min(block, nBytes - nCount)
+        if bufview is not None:
+            view = bufview[: src.readinto(bufview[:n])]
+        else:
+            view = srcview[nCount : nCount + n]
+        if not len(view):
+            break
+        msgs = _fs_write_window(fid, view, fast_write)
+        for res in msg_batch_transaction(brick.dev, msgs):
+            if not res or (
+                res[0] & 0x7F == PFX_CMD_FILE_WRITE and fs_error_check(res[1])
+            ):
+                return nCount
+        nCount += len(view)
+        if callback is not None:
+            callback(nCount)
+    return nCount
+
+
+def fs_seek_file(hdev, fid, offset):
+    """
+    Sends an ICD message to move the read or write position of an open file.
+
+    :param hdev: USB HID session handle or :obj:`PFxTransport`
+    :param fid: the file ID of the open file
+    :param offset: :obj:`int` byte offset from the start of the file
+    :returns: True if the position was moved
+    """
+    msg = [PFX_CMD_FILE_SEEK]
+    msg.append(fid)
+    msg.extend(uint32_to_bytes(offset))
+    res = msg_transaction(hdev, msg)
+    return bool(res) and not fs_error_check(res[1], silent=True)
+
+
+def _fs_open_for_write(brick, fid, name, nBytes):
+    msg = [PFX_CMD_FILE_OPEN]
+    msg.append(fid)
+    msg.append(0x06)  # CREATE | WRITE mode
+    msg.extend(uint32_to_bytes(nBytes))
+    nd = bytes(name, "utf-8")
+    for b in nd:
+        msg.append(b)
+    for i in range(32 - len(nd)):
+        msg.append(0)
+    res = msg_transaction(brick.dev, msg)
+    if not res:
+        return False
+    return not fs_error_check(res[1])
+
+
+def _fs_write_resumable(brick, fid, name, src, nBytes, retries, callback):
+    # Writes the file data, continuing from the last confirmed checkpoint
+    # with a FILE_SEEK if the transfer is interrupted.  If the PFx Brick
+    # cannot seek, the partial file is removed and the upload starts again.
+    # Re-writing bytes after the checkpoint which may already have reached
+    # flash is harmless since they are programmed with the same values.
+    checkpoint = 0
+
+    def _checkpoint(n):
+        nonlocal checkpoint
+        checkpoint = n
+        if callback is not None:
+            callback(n)
+
+    resume = False
+    while True:
+        try:
+            if resume and not fs_seek_file(brick.dev, fid, checkpoint):
+                msg = [PFX_CMD_FILE_CLOSE]
+                msg.append(fid)
+                msg_transaction(brick.dev, msg)
+                fs_remove_file(brick.dev, fid, silent=True)
+                if not _fs_open_for_write(brick, fid, name, nBytes):
+                    return checkpoint
+                _checkpoint(0)
+            return fs_write_file_data(
+                brick, fid, src, nBytes, callback=_checkpoint, offset=checkpoint
+            )
+        except PFX_TRANSFER_ERRORS:
+            if retries <= 0:
+                raise
+            retries -= 1
+            get_transport(brick.dev).drain()
+            resume = True
+
+
+def fs_copy_file_to(brick, fid, fn, show_progress=True, with_bytes=None, retries=None):
     """
     File copy handler to put a file on the PFx Brick.
 
@@ -127,118 +293,143 @@ def fs_copy_file_to(brick, fid, fn, show_progress=True, with_bytes=None):
     be time consuming. Therefore, a progress bar can be optionally shown
     on the console to monitor the transfer.
 
+    If a USB transaction fails during the transfer, it is resumed from the
+    last confirmed window of data rather than started again.
+
     :param brick: :obj:`PFxBrick` object
     :param fid: a unique file ID to assign the copied file.
     :param fn: the host filename (optionally including path) to copy
     :param boolean show_progress: a flag to show the progress bar indicator during transfer.
+    :param with_bytes: optional bytes-like object to copy instead of the contents of fn
+    :param retries: :obj:`int` optional number of times an interrupted transfer is resumed, defaults to `PFX_FILE_TRANSFER_RETRIES`
+    :returns: :obj:`int` number of bytes copied, less than the file size if the file could not be opened or written
     """
     if with_bytes is not None:
         nBytes = len(with_bytes)
     else:
         nBytes = os.path.getsize(fn)
-    if is_version_less_than(brick.icd_rev, "3.39"):
-        tx_chunk = 61
-        fast_write = False
-    else:
-        tx_chunk = 62
-        fast_write = True
+    if retries is None:
+        retries = PFX_FILE_TRANSFER_RETRIES
     if nBytes > 0:
-        msg = [PFX_CMD_FILE_OPEN]
-        msg.append(fid)
-        msg.append(0x06)  # CREATE | WRITE mode
-        msg.extend(uint32_to_bytes(nBytes))
         name = os.path.basename(fn)
-        nd = bytes(name, "utf-8")
-        for b in nd:
-            msg.append(b)
-        for i in range(32 - len(nd)):
-            msg.append(0)
-        res = usb_transaction(brick.dev, msg)
-        if not res:
-            return
-        if fs_error_check(res[1]):
-            return
-        if has_rich and show_progress:
-            with progress:
-                if with_bytes is None:
-                    f = open(fn, "rb")
-                nCount = 0
-                err = False
-                transfer = progress.add_task("copy_to", filename=name, total=nBytes)
-                while (nCount < nBytes) and not err:
-                    if with_bytes is None:
-                        buf = f.read(tx_chunk)
-                    else:
-                        remain = len(with_bytes) - nCount
-                        remain = min(tx_chunk, remain)
-                        buf = with_bytes[nCount : nCount + remain]
-                    nRead = len(buf)
-                    nCount += nRead
-                    if nRead > 0:
-                        if fast_write:
-                            msg = [PFX_CMD_FILE_WRITE_FAST]
-                            msg.append(nRead)
-                        else:
-                            msg = [PFX_CMD_FILE_WRITE]
-                            msg.append(fid)
-                            msg.append(nRead)
-                        for b in buf:
-                            msg.append(b)
-                        res = usb_transaction(brick.dev, msg)
-                        err = fs_error_check(res[1])
-                        progress.update(transfer, advance=nRead)
-
-                if with_bytes is None:
-                    f.close()
-                msg = [PFX_CMD_FILE_CLOSE]
-                msg.append(fid)
-                res = usb_transaction(brick.dev, msg)
-                fs_error_check(res[1])
-            progress.remove_task(transfer)
-        else:
-            if with_bytes is None:
-                f = open(fn, "rb")
-            nCount = 0
-            err = False
-            while (nCount < nBytes) and not err:
-                if with_bytes is None:
-                    buf = f.read(tx_chunk)
-                else:
-                    remain = len(with_bytes) - nCount
-                    remain = min(tx_chunk, remain)
-                    buf = with_bytes[nCount : nCount + remain]
-                nRead = len(buf)
-                nCount += nRead
-                if nRead > 0:
-                    if fast_write:
-                        msg = [PFX_CMD_FILE_WRITE_FAST]
-                        msg.append(nRead)
-                    else:
-                        msg = [PFX_CMD_FILE_WRITE]
-                        msg.append(fid)
-                        msg.append(nRead)
-                    for b in buf:
-                        msg.append(b)
-                    res = usb_transaction(brick.dev, msg)
-                    err = fs_error_check(res[1])
-                    if show_progress:
-                        printProgressBar(
-                            nCount,
-                            nBytes,
-                            prefix="Copying:",
-                            suffix="Complete",
-                            length=50,
-                        )
-            if with_bytes is None:
+        if not _fs_open_for_write(brick, fid, name, nBytes):
+            return 0
+        f = open(fn, "rb") if with_bytes is None else None
+        src = f if f is not None else with_bytes
+        nCount = 0
+        try:
+            if has_rich and show_progress:
+                with progress:
+                    transfer = progress.add_task("copy_to", filename=name, total=nBytes)
+                    nCount = _fs_write_resumable(
+                        brick,
+                        fid,
+                        name,
+                        src,
+                        nBytes,
+                        retries,
+                        lambda n: progress.update(transfer, completed=n),
+                    )
+                progress.remove_task(transfer)
+            else:
+                callback = None
+                if show_progress:
+                    callback = lambda n: printProgressBar(
+                        n, nBytes, prefix="Copying:", suffix="Complete", length=50
+                    )
+                nCount = _fs_write_resumable(
+                    brick, fid, name, src, nBytes, retries, callback
+                )
+        finally:
+            if f is not None:
                 f.close()
             msg = [PFX_CMD_FILE_CLOSE]
             msg.append(fid)
-            res = usb_transaction(brick.dev, msg)
-            fs_error_check(res[1])
+            try:
+                res = msg_transaction(brick.dev, msg)
+                fs_error_check(res[1])
+                # a partial file is not left behind on the PFx Brick
+                if nCount < nBytes:
+                    fs_remove_file(brick.dev, fid, silent=True)
+            except PFX_TRANSFER_ERRORS:
+                if nCount == nBytes:
+                    raise
+        return nCount
+    return 0
+
+
+def fs_read_file_chunks(brick, pfile, window=None):
+    """
+    Generator which reads a file from the PFx Brick and yields its data as
+    :obj:`bytes` chunks as they arrive, so that memory use does not depend
+    on the file size.  Each chunk is read with one pipelined batch of
+    ``window`` file read requests.  The file is closed when the generator
+    is exhausted or closed.
+
+    If the brick has a ``file_cache``, a file with the same CRC32 and size
+    which was read before is served from the cache without a USB transfer,
+    and files read from the PFx Brick are added to the cache.
+
+    :param brick: :obj:`PFxBrick` object
+    :param PFxFile pfile: a PFxFile object specifying the file to read.
+    :param window: :obj:`int` optional number of read requests per chunk, defaults to `PFX_FILE_READ_WINDOW`
+    """
+    if pfile is None:
+        return
+    cache = getattr(brick, "file_cache", None)
+    if cache is None:
+        yield from _fs_read_file_usb(brick, pfile, window)
+    elif cache.get(pfile.crc32, pfile.size) is not None:
+        yield from cache.read_chunks(pfile.crc32, pfile.size)
+    else:
+        chunks = _fs_read_file_usb(brick, pfile, window)
+        yield from cache.tee(pfile.crc32, pfile.size, chunks)
+
+
+def _fs_read_file_usb(brick, pfile, window):
+    window = window if window is not None else PFX_FILE_READ_WINDOW
+    msg = [PFX_CMD_FILE_OPEN]
+    msg.append(pfile.id)
+    msg.append(0x01)  # READ mode
+    res = msg_transaction(brick.dev, msg)
+    if not res:
+        return
+    if fs_error_check(res[1]):
+        return
+    try:
+        nCount = 0
+        while nCount < pfile.size:
+            n = min(window * 62, pfile.size - nCount)
+            msgs = [
+                [PFX_CMD_FILE_READ, pfile.id, min(62, n - i)] for i in range(0, n, 62)
+            ]
+            chunk = bytearray()
+            err = False
+            for res in msg_batch_transaction(brick.dev, msgs):
+                if not res or res[1] == 0 or fs_error_check(res[1]):
+                    err = True
+                    break
+                chunk += bytes(res[2 : 2 + res[1]])
+            if chunk:
+                nCount += len(chunk)
+                yield bytes(chunk)
+            if err:
+                return
+    finally:
+        msg = [PFX_CMD_FILE_CLOSE]
+        msg.append(pfile.id)
+        res = msg_transaction(brick.dev, msg)
+        fs_error_check(res[1])
 
 
 def fs_copy_file_from(
-    brick, pfile, fn=None, show_progress=True, as_bytes=False, to_console=False
+    brick,
+    pfile,
+    fn=None,
+    show_progress=True,
+    as_bytes=False,
+    to_console=False,
+    dest=None,
 ):
     """
     File copy handler to get a file from the PFx Brick.
@@ -249,107 +440,78 @@ def fs_copy_file_from(
     be time consuming. Therefore, a progress bar can be optionally shown
     on the console to monitor the transfer.
 
-    :param hdev: USB HID session handle
+    File data is written to its destination as it arrives rather than
+    after the whole file has been read.  Only copies into dest avoid
+    holding the whole file in memory, since the file contents are
+    otherwise returned.
+
+    :param brick: :obj:`PFxBrick` object
     :param PFxFile pfile: a PFxFile object specifying the file to copy.
     :param fn: optional name to override the filename of the host's copy.
     :param boolean show_progress: a flag to show the progress bar indicator during transfer.
+    :param boolean as_bytes: return the file contents rather than writing a host file
+    :param boolean to_console: print the file contents as they arrive, as a hex dump with as_bytes, if show_progress is False
+    :param dest: optional writable binary file object or pre-allocated writable buffer to copy into instead of a host file
+    :returns: :obj:`bytearray` file contents, or the :obj:`int` number of bytes copied if dest is specified
     """
     if pfile is None:
         return None
-    rx_chunk = 62
-    msg = [PFX_CMD_FILE_OPEN]
-    msg.append(pfile.id)
-    msg.append(0x01)  # READ mode
-    res = usb_transaction(brick.dev, msg)
-    if not res:
-        return None
-    if fs_error_check(res[1]):
-        return None
-
-    rbytes = bytearray()
-    if has_rich and show_progress:
-        with progress:
-            nf = pfile.name
-            if fn is not None:
-                nf = fn
-            nCount = 0
-            err = False
-            transfer = progress.add_task("copy_from", filename=nf, total=pfile.size)
-            while (nCount < pfile.size) and not err:
-                msg = [PFX_CMD_FILE_READ]
-                msg.append(pfile.id)
-                nToRead = pfile.size - nCount
-                if nToRead > rx_chunk:
-                    nToRead = rx_chunk
-                msg.append(nToRead)
-                res = usb_transaction(brick.dev, msg)
-                err = fs_error_check(res[1])
-                if not err:
-                    nCount += res[1]
-                    b = bytes(res[2 : 2 + res[1]])
-                    rbytes.extend(b)
-                    if to_console and not show_progress:
-                        if as_bytes:
-                            pprint_bytes(b)
-                        else:
-                            s = []
-                            for bc in b:
-                                s.append("%c" % (bc))
-                            print("".join(s), end="")
-                    progress.update(transfer, advance=res[1])
-            msg = [PFX_CMD_FILE_CLOSE]
-            msg.append(pfile.id)
-            res = usb_transaction(brick.dev, msg)
-            fs_error_check(res[1])
-        progress.remove_task(transfer)
-        if not as_bytes:
-            with open(nf, "wb") as f:
-                f.write(rbytes)
-        return rbytes
+    nf = pfile.name
+    if fn is not None:
+        nf = fn
+    f = None
+    if dest is not None and hasattr(dest, "write"):
+        write = dest.write
+    elif dest is not None:
+        view = memoryview(dest).cast("B")
+
+        def write(b):
+            view[nCount : nCount + len(b)] = b
+
+    elif as_bytes:
+        rbytes = bytearray()
+        write = rbytes.extend
     else:
-        nf = pfile.name
-        if fn is not None:
-            nf = fn
-        nCount = 0
-        err = False
-        while (nCount < pfile.size) and not err:
-            msg = [PFX_CMD_FILE_READ]
-            msg.append(pfile.id)
-            nToRead = pfile.size - nCount
-            if nToRead > rx_chunk:
-                nToRead = rx_chunk
-            msg.append(nToRead)
-            res = usb_transaction(brick.dev, msg)
-            err = fs_error_check(res[1])
-            if not err:
-                nCount += res[1]
-                b = bytes(res[2 : 2 + res[1]])
-                rbytes.extend(b)
-                if to_console and not show_progress:
-                    if as_bytes:
-                        pprint_bytes(b)
-                    else:
-                        s = []
-                        for bc in b:
-                            s.append("%c" % (bc))
-                        print("".join(s), end="")
-            if show_progress:
-                printProgressBar(
-                    nCount,
-                    pfile.size,
-                    prefix="Copying:",
-                    suffix="Complete",
-                    length=50,
-                )
-        msg = [PFX_CMD_FILE_CLOSE]
-        msg.append(pfile.id)
-        res = usb_transaction(brick.dev, msg)
-        fs_error_check(res[1])
-        if not as_bytes:
-            with open(nf, "wb") as f:
-                f.write(rbytes)
-        return rbytes
-    return None
+        rbytes = bytearray()
+        f = open(nf, "wb")
+
+        def write(b):
+            f.write(b)
+            rbytes.extend(b)
+
+    console = to_console and not show_progress
+    nCount = 0
+    try:
+        if has_rich and show_progress:
+            with progress:
+                transfer = progress.add_task("copy_from", filename=nf, total=pfile.size)
+                for chunk in fs_read_file_chunks(brick, pfile):
+                    write(chunk)
+                    nCount += len(chunk)
+                    progress.update(transfer, advance=len(chunk))
+            progress.remove_task(transfer)
+        else:
+            for chunk in fs_read_file_chunks(brick, pfile):
+                write(chunk)
+                if console and as_bytes:
+                    pprint_bytes(chunk, address=nCount)
+                elif console:
+                    print(chunk.decode("latin-1"), end="", flush=True)
+                nCount += len(chunk)
+                if show_progress:
+                    printProgressBar(
+                        nCount,
+                        pfile.size,
+                        prefix="Copying:",
+                        suffix="Complete",
+                        length=50,
+                    )
+    finally:
+        if f is not None:
+            f.close()
+    if dest is not None:
+        return nCount
+    return rbytes
 
 
 class PFxFile:
@@ -485,11 +647,74 @@ class PFxFile:
         return s
 
 
+class PFxFileList(list):
+    """
+    List of :obj:`PFxFile` directory entries which keeps the indexes of the
+    :obj:`PFxDir` which owns it up to date as entries are added or removed.
+    """
+
+    def __init__(self, owner, files=()):
+        super().__init__(files)
+        self._owner = owner
+
+    def append(self, f):
+        super().append(f)
+        self._owner._index(f)
+
+    def extend(self, files):
+        for f in files:
+            self.append(f)
+
+    def __iadd__(self, files):
+        self.extend(files)
+        return self
+
+    def insert(self, i, f):
+        super().insert(i, f)
+        self._owner._index(f, appended=False)
+
+    def remove(self, f):
+        super().remove(f)
+        self._owner._unindex(f)
+
+    def pop(self, i=-1):
+        f = super().pop(i)
+        self._owner._unindex(f)
+        return f
+
+    def clear(self):
+        super().clear()
+        self._owner.reindex()
+
+    def __setitem__(self, i, f):
+        if isinstance(i, slice):
+            super().__setitem__(i, f)
+            self._owner.reindex()
+            return
+        old = self[i]
+        super().__setitem__(i, f)
+        self._owner._unindex(old)
+        self._owner._index(f, appended=False)
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            super().__delitem__(i)
+            self._owner.reindex()
+            return
+        f = self[i]
+        super().__delitem__(i)
+        self._owner._unindex(f)
+
+
 class PFxDir:
     """
     File directory container class.
 
-    This class contains PFx file system directory.
+    This class contains PFx file system directory.  Directory entries are
+    indexed by file ID and by name, and a bitmap of used file IDs is kept,
+    so that lookups and finding an available file ID do not scan the files.
+    The indexes are updated as entries are added to or removed from files;
+    :obj:`reindex` must be called if an entry's id or name is changed in place.
 
     Attributes:
         numFiles (:obj:`int`): number of files in the file system
@@ -507,6 +732,66 @@ class PFxDir:
         self.bytesUsed = 0
         self.bytesLeft = 0
 
+    @property
+    def files(self):
+        return self._files
+
+    @files.setter
+    def files(self, files):
+        self._files = PFxFileList(self, files)
+        self.reindex()
+
+    def _index(self, f, appended=True):
+        # the first entry with an ID or name is found, as with a linear scan;
+        # entries sharing an ID or name are counted so that the indexes of a
+        # single entry can be updated without scanning the files
+        for index, refs, attr in self._indexes():
+            key = getattr(f, attr)
+            refs[key] = refs.get(key, 0) + 1
+            if refs[key] == 1:
+                index[key] = f
+            elif not appended:
+                index[key] = self._first(attr, key)
+        if 0 <= f.id < 0xFF:
+            self._used_ids |= 1 << f.id
+
+    def _unindex(self, f):
+        # updates the indexes for an entry which was removed from files
+        for index, refs, attr in self._indexes():
+            key = getattr(f, attr)
+            refs[key] -= 1
+            if refs[key] == 0:
+                del refs[key]
+                del index[key]
+            elif index[key] is f:
+                index[key] = self._first(attr, key)
+        if 0 <= f.id < 0xFF and f.id not in self._id_refs:
+            self._used_ids &= ~(1 << f.id)
+
+    def _indexes(self):
+        return (
+            (self._by_id, self._id_refs, "id"),
+            (self._by_name, self._name_refs, "name"),
+        )
+
+    def _first(self, attr, key):
+        for f in self._files:
+            if getattr(f, attr) == key:
+                return f
+
+    def reindex(self):
+        """
+        Rebuilds the file ID and name indexes and the bitmap of used file IDs
+        from the files list.
+        """
+        self._by_id = {}
+        self._by_name = {}
+        self._id_refs = {}
+        self._name_refs = {}
+        self._used_ids = 0
+        for f in self._files:
+            self._index(f)
+
     def get_file_dir_entry(self, fid):
         """
         Returns a file directory entry containined in a :py:class:`PFxFile` class.
@@ -514,10 +799,16 @@ class PFxDir:
         :param int fid: the unique file ID of desired directory entry
         :returns: :py:class:`PFxFile` directory entry
         """
-        for f in self.files:
-            if f.id == fid:
-                return f
-        return None
+        return self._by_id.get(fid)
+
+    def get_file_dir_entry_by_name(self, name):
+        """
+        Returns a file directory entry with a filename.
+
+        :param str name: the filename of desired directory entry
+        :returns: :py:class:`PFxFile` directory entry, or None
+        """
+        return self._by_name.get(name)
 
     def get_filename(self, fid):
         """
@@ -526,7 +817,7 @@ class PFxDir:
         :param int fid: the unique file ID of desired directory entry
         :returns: :obj:`str` filename of file ID, or None
         """
-        f = self.get_file_dir_entry(fid)
+        f = self._by_id.get(fid)
         if f is not None:
             return f.name
         return None
@@ -535,16 +826,12 @@ class PFxDir:
         """
         Returns the next available unique file ID from the file system.
 
-        The directory is scanned for all currently used file ID values and
-        returns an un-used/available file ID value.
+        The lowest file ID which is clear in the bitmap of used file ID
+        values is returned.
 
         :returns: :obj:`int` next available file ID value, or None
         """
-        used_ids = [x.id for x in self.files]
-        for x in range(255):
-            if x not in used_ids:
-                return x
-        return None
+        return _first_free_file_id(self._used_ids)
 
     def has_file(self, fileID):
         """
@@ -553,13 +840,10 @@ class PFxDir:
 
         :returns: :obj:`boolean` True or False if the file is found
         """
-        for file in self.files:
-            if isinstance(fileID, int):
-                if file.id == fileID:
-                    return True
-            elif isinstance(fileID, str):
-                if file.name == fileID:
-                    return True
+        if isinstance(fileID, int):
+            return fileID in self._by_id
+        elif isinstance(fileID, str):
+            return fileID in self._by_name
         return False
 
     def __str__(self):
@@ -626,3 +910,220 @@ class PFxDir:
         )
         s = "\n".join(sb)
         return s
+
+
+class PFxSyncReport:
+    """
+    Summary of a directory synchronized to the PFx Brick with :obj:`PFxBrick.sync_dir`.
+
+    Attributes:
+        uploaded ([:obj:`str`]): filenames which were new or changed and were copied to the PFx Brick
+
+        unchanged ([:obj:`str`]): filenames with the same size and CRC32 on the PFx Brick which were skipped
+
+        removed ([:obj:`str`]): filenames on the PFx Brick not found in the directory which were removed
+
+        skipped ([:obj:`str`]): filenames which cannot be stored on the PFx Brick, e.g. names longer than 32 bytes
+
+        failed ([:obj:`str`]): filenames which could not be opened or written on the PFx Brick
+
+        bytes_uploaded (:obj:`int`): bytes copied to the PFx Brick
+
+        bytes_saved (:obj:`int`): bytes of unchanged files which were not copied again
+    """
+
+    def __init__(self):
+        self.uploaded = []
+        self.unchanged = []
+        self.removed = []
+        self.skipped = []
+        self.failed = []
+        self.bytes_uploaded = 0
+        self.bytes_saved = 0
+
+    def __str__(self):
+        sb = []
+        for name in self.uploaded:
+            sb.append("  uploaded  %s" % (name))
+        for name in self.removed:
+            sb.append("  removed   %s" % (name))
+        for name in self.skipped:
+            sb.append("  skipped   %s" % (name))
+        for name in self.failed:
+            sb.append("  failed    %s" % (name))
+        sb.append(
+            "%d uploaded, %d unchanged, %d removed, %d failed, %.1f kB copied, %.1f kB saved"
+            % (
+                len(self.uploaded),
+                len(self.unchanged),
+                len(self.removed),
+                len(self.failed),
+                float(self.bytes_uploaded / 1000),
+                float(self.bytes_saved / 1000),
+            )
+        )
+        return "\n".join(sb)
+
+
+class PFxUploadPlan:
+    """
+    Plan for copying a set of local files to the PFx Brick, made from the
+    file directory and free space before any file is opened.
+
+    Attributes:
+        uploads ([(:obj:`str`, :obj:`int`)]): local filename and file ID of each file to copy, in the order to copy them
+
+        removals ([:obj:`PFxFile`]): files on the PFx Brick to remove before copying
+
+        unchanged ([:obj:`str`]): filenames with the same size and CRC32 on the PFx Brick which need not be copied
+
+        skipped ([:obj:`str`]): filenames which cannot be stored on the PFx Brick, e.g. names longer than 32 bytes
+
+        sectors_needed (:obj:`int`): flash sectors needed by the files to copy
+
+        sectors_free (:obj:`int`): flash sectors free before the plan is carried out
+
+        sectors_freed (:obj:`int`): flash sectors freed by replaced and removed files
+    """
+
+    def __init__(self):
+        self.uploads = []
+        self.removals = []
+        self.unchanged = []
+        self.skipped = []
+        self.sectors_needed = 0
+        self.sectors_free = 0
+        self.sectors_freed = 0
+
+    @property
+    def fits(self):
+        """True if the files to copy fit in the free and freed space."""
+        return self.sectors_needed <= self.sectors_free + self.sectors_freed
+
+    @property
+    def shortfall(self):
+        """Number of bytes which must still be freed for the files to fit."""
+        n = self.sectors_needed - self.sectors_free - self.sectors_freed
+        return max(n, 0) * PFX_FLASH_SECTOR_SZ
+
+    def __str__(self):
+        sb = []
+        for f in self.removals:
+            sb.append("  remove    %s" % (f.name))
+        for fn, fid in self.uploads:
+            sb.append("  copy      %s as %d" % (os.path.basename(fn), fid))
+        for name in self.skipped:
+            sb.append("  skip      %s" % (name))
+        if self.fits:
+            sb.append(
+                "%d files fit, %.1f kB needed, %.1f kB available"
+                % (
+                    len(self.uploads),
+                    float(self.sectors_needed * PFX_FLASH_SECTOR_SZ / 1000),
+                    float(
+                        (self.sectors_free + self.sectors_freed)
+                        * PFX_FLASH_SECTOR_SZ
+                        / 1000
+                    ),
+                )
+            )
+        else:
+            sb.append(
+                "%d files do not fit, %.1f kB more space is needed"
+                % (len(self.uploads), float(self.shortfall / 1000))
+            )
+        return "\n".join(sb)
+
+
+def _upload_growth(upload):
+    # the change in used flash sectors when a planned upload is copied
+    size, name, fn, f = upload
+    n = fs_sectors_for_size(size)
+    if f is not None:
+        n -= fs_sectors_for_size(f.size)
+    return n
+
+
+def fs_plan_upload(filedir, fns, removable=None, remove_stale=False):
+    """
+    Plans copying a set of local files to the PFx Brick from its file
+    directory and free space, without any transactions with the PFx Brick.
+
+    Files already on the PFx Brick with the same name, size and CRC32 are
+    not copied again, and changed files keep their file ID.  Space is
+    counted in whole flash sectors.  If the files do not fit, the largest
+    removable files are chosen for removal until they do, and removals
+    which turn out not to be needed are dropped again.  Changed files which
+    shrink are copied first, since a replaced file's sectors are only freed
+    when it is copied, and the rest are copied largest first so that they
+    are placed while free space is least fragmented.
+
+    :param filedir: :obj:`PFxDir` an up to date file directory with bytesLeft
+    :param fns: [:obj:`str`] local filenames to copy
+    :param removable: optional iterable of file IDs or filenames on the PFx Brick which may be removed to make space
+    :param remove_stale: :obj:`boolean` remove every file on the PFx Brick which is not in fns
+    :returns: :obj:`PFxUploadPlan`
+    """
+    plan = PFxUploadPlan()
+    plan.sectors_free = filedir.bytesLeft // PFX_FLASH_SECTOR_SZ
+    names = {}
+    for fn in fns:
+        name = os.path.basename(fn)
+        if len(bytes(name, "utf-8")) > 32 or os.path.getsize(fn) == 0:
+            plan.skipped.append(name)
+            continue
+        names[name] = fn
+    uploads = []
+    for name, fn in names.items():
+        size = os.path.getsize(fn)
+        f = filedir.get_file_dir_entry_by_name(name)
+        if f is not None and f.size == size and f.has_same_crc32_as_file(fn):
+            plan.unchanged.append(name)
+            continue
+        if f is not None:
+            # a changed file replaces the file with the same name
+            plan.sectors_freed += fs_sectors_for_size(f.size)
+        plan.sectors_needed += fs_sectors_for_size(size)
+        uploads.append((size, name, fn, f))
+    stale = [f for f in filedir.files if f.name not in names]
+    if remove_stale:
+        plan.removals = stale
+    elif removable is not None:
+        removable = set(removable)
+        candidates = [f for f in stale if f.id in removable or f.name in removable]
+        candidates.sort(key=lambda f: f.size, reverse=True)
+        for f in candidates:
+            if plan.fits:
+                break
+            plan.removals.append(f)
+            plan.sectors_freed += fs_sectors_for_size(f.size)
+        for f in sorted(plan.removals, key=lambda f: f.size):
+            n = fs_sectors_for_size(f.size)
+            if plan.sectors_needed <= plan.sectors_free + plan.sectors_freed - n:
+                plan.removals.remove(f)
+                plan.sectors_freed -= n
+    if remove_stale:
+        plan.sectors_freed += sum(fs_sectors_for_size(f.size) for f in stale)
+    used = filedir._used_ids
+    for f in plan.removals:
+        used &= ~(1 << f.id)
+    # a replaced file's sectors are only freed when it is copied, so files
+    # which shrink are copied first, most sectors freed first.  Every later
+    # copy only uses up space, so the running free space never drops below
+    # the free space left once the whole plan is carried out.
+    def order(u):
+        n = _upload_growth(u)
+        return (0, n) if n <= 0 else (1, -u[0])
+
+    for size, name, fn, f in sorted(uploads, key=order):
+        if f is not None:
+            fid = f.id
+        else:
+            fid = _first_free_file_id(used)
+            if fid is None:
+                plan.skipped.append(name)
+                plan.sectors_needed -= fs_sectors_for_size(size)
+                continue
+            used |= 1 << fid
+        plan.uploads.append((fn, fid))
+    return plan
@@ -0,0 +1,753 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2021  Fx Bricks Inc.
+# This file is part of the pfxbrick python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# PFx Brick flash memory snapshots and archives
+
+import json
+import mmap
+import os
+import time
+import zipfile
+import zlib
+
+from .pfx import *
+from .pfxexceptions import FileCRCMismatchException
+from .pfxfat import PFxFAT
+from .pfxfiles import PFxFile, fs_sectors_for_size, has_rich, progress
+from .pfxhelpers import printProgressBar
+from .pfxmsg import flash_read_exact
+
+# number of flash sectors read between saves of the snapshot progress, i.e.
+# the most which is read again when an interrupted snapshot is resumed
+PFX_SNAPSHOT_SAVE_INTERVAL = 64
+
+# flash memory size of each product part number
+_FLASH_SIZES = {
+    v: globals()[k[:-3] + "_FLASH_SZ"]
+    for k, v in list(globals().items())
+    if k.startswith("PFX_") and k.endswith("_PN") and k[:-3] + "_FLASH_SZ" in globals()
+}
+
+# directory entry fields kept in snapshot and archive manifests
+_FILE_FIELDS = (
+    "id",
+    "name",
+    "size",
+    "firstSector",
+    "attributes",
+    "userData1",
+    "userData2",
+    "crc32",
+)
+
+
+def flash_size_from_product_id(product_id):
+    """
+    Returns the flash memory size of a PFx Brick product.
+
+    :param product_id: :obj:`str` product ID code reported by the PFx Brick (e.g. 'A216')
+    :returns: :obj:`int` flash memory size in bytes, 16 MB if the product is not known
+    """
+    try:
+        pn = int(product_id, 16)
+    except (TypeError, ValueError):
+        pn = None
+    return _FLASH_SIZES.get(pn, PFX_PFXBRICK_16MB_FLASH_SZ)
+
+
+def default_archive_dir():
+    """Returns the default directory of flash archives, e.g. ``~/.local/share/pfxbrick/archives``."""
+    base = os.environ.get("XDG_DATA_HOME") or os.path.join(
+        os.path.expanduser("~"), ".local", "share"
+    )
+    return os.path.join(base, "pfxbrick", "archives")
+
+
+def _file_to_dict(f):
+    return {k: getattr(f, k) for k in _FILE_FIELDS}
+
+
+def _file_from_dict(d):
+    f = PFxFile()
+    for k in _FILE_FIELDS:
+        setattr(f, k, d[k])
+    return f
+
+
+def _check_crc32(f, data):
+    crc = zlib.crc32(data) & 0xFFFFFFFF
+    if crc != f.crc32:
+        raise FileCRCMismatchException(
+            "File %d %s has CRC32 0x%08X instead of 0x%08X"
+            % (f.id, f.name, crc, f.crc32)
+        )
+
+
+class PFxFlashImage:
+    """
+    Image of PFx Brick flash memory stored in a memory-mapped file.
+
+    The image file has the same layout as the flash memory so that it can
+    be inspected with any tool.  Its details, the file directory of the
+    PFx Brick and the sectors which have been read so far are kept in a
+    JSON file next to it named with an added ``.json`` suffix, so that an
+    interrupted snapshot can be resumed.
+
+    An image without a JSON file, e.g. a raw dump of the flash memory, can
+    also be opened.  It is treated as complete and has no file directory
+    unless files are assigned.  Opening an image only maps it into memory,
+    so that files can be listed, extracted and checked offline without
+    reading the whole image.
+
+    :param filename: :obj:`str` the image file to open or create
+    :param size: :obj:`int` size of the image in bytes, only required when a new image is created
+    :param readonly: :obj:`boolean` open an existing image without changing it or its JSON file
+    :raises: :obj:`ValueError` if size differs from the size of an existing image, see :obj:`reset`
+
+    Attributes:
+        filename (:obj:`str`): the image filename
+
+        size (:obj:`int`): size of the image in bytes
+
+        serial_no (:obj:`str`): serial number of the imaged PFx Brick
+
+        product_id (:obj:`str`): product ID code of the imaged PFx Brick
+
+        name (:obj:`str`): user defined name of the imaged PFx Brick
+
+        created (:obj:`str`): local time the snapshot was started, e.g. '2024-03-01 12:00:00'
+
+        files ([:obj:`PFxFile`]): file directory of the imaged PFx Brick
+
+        data (:obj:`mmap.mmap`): the image contents
+    """
+
+    def __init__(self, filename, size=None, readonly=False):
+        self.filename = filename
+        self.size = size
+        self.readonly = readonly
+        self.serial_no = ""
+        self.product_id = ""
+        self.name = ""
+        self.created = ""
+        self.files = []
+        self._sectors = 0
+        exists = os.path.isfile(filename)
+        if os.path.isfile(self.meta_filename):
+            self._load_meta()
+            if size is not None and size != self.size:
+                raise ValueError(
+                    "The flash image %s is %d bytes, not %d"
+                    % (filename, self.size, size)
+                )
+        elif exists:
+            self.size = os.path.getsize(filename)
+            self._sectors = (1 << self.num_sectors) - 1
+        if readonly:
+            self._file = open(filename, "rb")
+            self.data = mmap.mmap(
+                self._file.fileno(), self.size, access=mmap.ACCESS_READ
+            )
+            return
+        if self.size is None:
+            raise ValueError("The size of a new flash image must be specified")
+        self._file = open(filename, "r+b" if exists else "w+b")
+        if os.path.getsize(filename) != self.size:
+            self._file.truncate(self.size)
+        self.data = mmap.mmap(self._file.fileno(), self.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def meta_filename(self):
+        """Filename of the JSON file with the details of the image."""
+        return self.filename + ".json"
+
+    @property
+    def num_sectors(self):
+        """Number of flash sectors in the image."""
+        return self.size // PFX_FLASH_SECTOR_SZ
+
+    def _load_meta(self):
+        with open(self.meta_filename, "r") as f:
+            meta = json.load(f)
+        self.size = meta["size"]
+        self.serial_no = meta["serial_no"]
+        self.product_id = meta["product_id"]
+        self.name = meta["name"]
+        self.created = meta["created"]
+        self.files = [_file_from_dict(d) for d in meta["files"]]
+        self._sectors = int(meta["sectors"], 16)
+
+    def save(self):
+        """Flushes the image contents and saves its details and progress."""
+        self.data.flush()
+        meta = {
+            "size": self.size,
+            "serial_no": self.serial_no,
+            "product_id": self.product_id,
+            "name": self.name,
+            "created": self.created,
+            "files": [_file_to_dict(f) for f in self.files],
+            "sectors": "%X" % (self._sectors),
+        }
+        tmp = self.meta_filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f, indent=1)
+        os.replace(tmp, self.meta_filename)
+
+    def close(self):
+        """Saves and closes the image."""
+        if self.data is None:
+            return
+        if not self.readonly:
+            self.save()
+        self.data.close()
+        self._file.close()
+        self.data = None
+
+    def has_sector(self, sector):
+        """Returns True if a flash sector has been read into the image."""
+        return bool(self._sectors >> sector & 1)
+
+    def mark_sector(self, sector, done=True):
+        """Records whether a flash sector has been read into the image."""
+        if done:
+            self._sectors |= 1 << sector
+        else:
+            self._sectors &= ~(1 << sector)
+
+    def missing_sectors(self, sectors=None):
+        """
+        Returns the flash sectors which have not been read into the image.
+
+        :param sectors: optional iterable of sector indexes to check, defaults to every sector
+        :returns: [:obj:`int`] sector indexes in ascending order
+        """
+        if sectors is None:
+            sectors = range(self.num_sectors)
+        return [s for s in sorted(sectors) if not self.has_sector(s)]
+
+    def reset(self, size=None):
+        """
+        Forgets which sectors have been read so that a snapshot starts again.
+
+        :param size: :obj:`int` optional new size of the image in bytes
+        """
+        self._sectors = 0
+        if size is not None and size != self.size:
+            self.data.close()
+            self._file.truncate(size)
+            self.size = size
+            self.data = mmap.mmap(self._file.fileno(), size)
+
+    def fat_entry(self, sector):
+        """Returns the file allocation table entry of a flash sector."""
+        a = PFX_FLASH_FAT_ADDR + 2 * sector
+        return self.data[a] | (self.data[a + 1] << 8)
+
+    def fat(self):
+        """
+        Returns the file allocation table of the image.
+
+        :returns: :obj:`PFxFAT` the parsed file allocation table
+        :raises: :obj:`ValueError` if the image does not contain the file allocation table
+        """
+        if self.size < PFX_FLASH_FAT_ADDR + PFX_FLASH_FAT_SZ:
+            raise ValueError(
+                "The flash image does not contain the file allocation table"
+            )
+        fat = PFxFAT()
+        fat.from_bytes(
+            self.data[PFX_FLASH_FAT_ADDR : PFX_FLASH_FAT_ADDR + PFX_FLASH_FAT_SZ]
+        )
+        return fat
+
+    def get_file(self, fileID):
+        """
+        Returns the directory entry of a file in the image.
+
+        :param fileID: :obj:`int` or :obj:`str` the file ID or filename
+        :returns: :obj:`PFxFile` directory entry, or None
+        """
+        for f in self.files:
+            if f.id == fileID or f.name == fileID:
+                return f
+        return None
+
+    def file_sectors(self, pfile, fat=None):
+        """
+        Returns the flash sectors of a file by following its chain in the
+        file allocation table.
+
+        :param pfile: :obj:`PFxFile` directory entry of the file
+        :param fat: optional :obj:`PFxFAT` of the image, to avoid parsing it again
+        :returns: [:obj:`int`] sector indexes in file order
+        """
+        fat = fat if fat is not None else self.fat()
+        return fat.chain(pfile.firstSector, fs_sectors_for_size(pfile.size)).sectors
+
+    def file_chunks(self, pfile, fat=None):
+        """
+        Generator which yields the contents of a file in the image one
+        sector at a time.
+
+        :param pfile: :obj:`PFxFile` directory entry of the file
+        :param fat: optional :obj:`PFxFAT` of the image, to avoid parsing it again
+        :raises: :obj:`ValueError` if a sector of the file is not in the image
+        """
+        sectors = self.file_sectors(pfile, fat)
+        if len(sectors) < fs_sectors_for_size(pfile.size) and pfile.size:
+            raise ValueError("The sector chain of file %d is broken" % (pfile.id))
+        if any(not self.has_sector(s) for s in sectors):
+            raise ValueError("File %d is not complete in the flash image" % (pfile.id))
+        n = pfile.size
+        for s in sectors:
+            a = s * PFX_FLASH_SECTOR_SZ
+            k = min(n, PFX_FLASH_SECTOR_SZ)
+            if k <= 0:
+                break
+            yield self.data[a : a + k]
+            n -= k
+
+    def read_file(self, pfile):
+        """
+        Returns the contents of a file in the image.
+
+        :param pfile: :obj:`PFxFile` directory entry of the file
+        :returns: :obj:`bytes` the file contents
+        :raises: :obj:`ValueError` if a sector of the file is not in the image
+        :raises: :obj:`FileCRCMismatchException` if the contents do not match the CRC32 of the file
+        """
+        data = b"".join(self.file_chunks(pfile))
+        _check_crc32(pfile, data)
+        return data
+
+    def extract_file(self, pfile, fn):
+        """
+        Copies a file in the image to the host.  The file is only written
+        if its contents match the CRC32 of its directory entry.
+
+        :param pfile: :obj:`PFxFile` directory entry of the file
+        :param fn: :obj:`str` the host filename to write
+        :returns: :obj:`int` number of bytes copied
+        :raises: :obj:`FileCRCMismatchException` if the contents do not match the CRC32 of the file
+        """
+        tmp = fn + ".tmp"
+        crc = 0
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in self.file_chunks(pfile):
+                    f.write(chunk)
+                    crc = zlib.crc32(chunk, crc)
+            if crc != pfile.crc32:
+                raise FileCRCMismatchException(
+                    "File %d %s has CRC32 0x%08X instead of 0x%08X"
+                    % (pfile.id, pfile.name, crc, pfile.crc32)
+                )
+            os.replace(tmp, fn)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return pfile.size
+
+    def check(self, files=None):
+        """
+        Checks the file system in the image, like fsck.  The sector chain of
+        every file is followed in the file allocation table and the CRC32 of
+        its contents is verified, and sectors which are allocated but belong
+        to no file, belong to more than one file, or are free but not erased
+        are found.
+
+        :param files: optional [:obj:`PFxFile`] file directory to check against, defaults to the directory of the image
+        :returns: :obj:`PFxFsckReport`
+        """
+        files = files if files is not None else self.files
+        fat = self.fat()
+        report = PFxFsckReport()
+        owners = {}
+        if files:
+            for f in files:
+                c = fat.chain(f.firstSector, fs_sectors_for_size(f.size))
+                for sector in c.sectors:
+                    owners.setdefault(sector, []).append(f)
+                report.files_checked += 1
+                if len(c) < fs_sectors_for_size(f.size):
+                    report.broken.append(f)
+                    continue
+                if any(not self.has_sector(sector) for sector in c.sectors):
+                    report.unchecked.append(f)
+                    continue
+                crc = 0
+                for chunk in self.file_chunks(f, fat):
+                    crc = zlib.crc32(chunk, crc)
+                if crc != f.crc32:
+                    report.crc_errors.append((f, crc))
+        else:
+            for first, c in fat.chains.items():
+                for sector in c.sectors:
+                    owners.setdefault(sector, []).append(first)
+        for sector, e in enumerate(fat.entries):
+            if (
+                e < fat.num_sectors or e == PFX_FAT_SECTOR_LAST
+            ) and sector not in owners:
+                report.orphaned.append(sector)
+        report.cross_linked = {s: o for s, o in owners.items() if len(o) > 1}
+        erased = b"\xFF" * PFX_FLASH_SECTOR_SZ
+        for start, n in fat.free_runs:
+            for sector in range(start, min(start + n, self.num_sectors)):
+                a = sector * PFX_FLASH_SECTOR_SZ
+                if (
+                    self.has_sector(sector)
+                    and self.data[a : a + PFX_FLASH_SECTOR_SZ] != erased
+                ):
+                    report.not_erased.append(sector)
+        return report
+
+
+class PFxFsckReport:
+    """
+    Result of checking the file system of a :obj:`PFxFlashImage`.
+
+    Attributes:
+        files_checked (:obj:`int`): number of directory entries checked
+
+        crc_errors ([(:obj:`PFxFile`, :obj:`int`)]): files whose contents do not match their CRC32, with the CRC32 of the contents
+
+        broken ([:obj:`PFxFile`]): files whose sector chain ends before the end of the file
+
+        unchecked ([:obj:`PFxFile`]): files with sectors which are not in the image
+
+        orphaned ([:obj:`int`]): allocated sectors which do not belong to any file
+
+        cross_linked ({:obj:`int`: [:obj:`PFxFile`]}): sectors which belong to more than one file, with the files
+
+        not_erased ([:obj:`int`]): free sectors which are not erased
+    """
+
+    def __init__(self):
+        self.files_checked = 0
+        self.crc_errors = []
+        self.broken = []
+        self.unchecked = []
+        self.orphaned = []
+        self.cross_linked = {}
+        self.not_erased = []
+
+    @property
+    def ok(self):
+        """True if no file system errors were found."""
+        return not (
+            self.crc_errors
+            or self.broken
+            or self.orphaned
+            or self.cross_linked
+            or self.not_erased
+        )
+
+    def __str__(self):
+        sb = []
+        for f, crc in self.crc_errors:
+            sb.append(
+                "  CRC32 error  %3d %s is %08X instead of %08X"
+                % (f.id, f.name, crc, f.crc32)
+            )
+        for f in self.broken:
+            sb.append("  broken chain %3d %s" % (f.id, f.name))
+        for f in self.unchecked:
+            sb.append("  not in image %3d %s" % (f.id, f.name))
+        for s, owners in sorted(self.cross_linked.items()):
+            names = ", ".join(
+                o.name if isinstance(o, PFxFile) else "%04X" % (o) for o in owners
+            )
+            sb.append("  cross-linked sector %04X: %s" % (s, names))
+        if self.orphaned:
+            sb.append(
+                "  orphaned sectors: %s" % (" ".join("%04X" % s for s in self.orphaned))
+            )
+        if self.not_erased:
+            sb.append(
+                "  free sectors not erased: %s"
+                % (" ".join("%04X" % s for s in self.not_erased))
+            )
+        sb.append(
+            "%d files checked, %d CRC32 errors, %d broken, %d cross-linked and %d orphaned sectors"
+            % (
+                self.files_checked,
+                len(self.crc_errors),
+                len(self.broken),
+                len(self.cross_linked),
+                len(self.orphaned),
+            )
+        )
+        return "\n".join(sb)
+
+
+def _snapshot_sectors(size, regions):
+    if regions is None:
+        regions = [(0, size)]
+    sectors = set()
+    for add, n in regions:
+        first = add // PFX_FLASH_SECTOR_SZ
+        last = (add + n + PFX_FLASH_SECTOR_SZ - 1) // PFX_FLASH_SECTOR_SZ
+        sectors.update(range(first, min(last, size // PFX_FLASH_SECTOR_SZ)))
+    return sectors
+
+
+def snapshot_flash(
+    brick, filename, regions=None, skip_free=True, show_progress=True, callback=None
+):
+    """
+    Reads the flash memory of a PFx Brick into a :obj:`PFxFlashImage`.
+
+    The flash memory is streamed sector by sector straight into the
+    memory-mapped image.  If an image of the same PFx Brick with the same
+    file allocation table already exists, e.g. from a snapshot which was
+    interrupted, only the sectors which are missing from it are read.
+    The file allocation table is always read, and by default sectors it
+    marks as free are filled with erased bytes rather than read.
+
+    :param brick: :obj:`PFxBrick` object
+    :param filename: :obj:`str` the image file to create or resume
+    :param regions: optional list of (address, bytes) flash regions to read, defaults to the whole flash memory
+    :param skip_free: :obj:`boolean` do not read sectors which are free in the file allocation table
+    :param show_progress: :obj:`boolean` a flag to show the progress bar indicator during transfer.
+    :param callback: optional function called as ``callback(nCount, nBytes)`` after each sector
+    :returns: :obj:`PFxFlashImage` the image, which must be closed after use
+    :raises: :obj:`FlashReadException` if a read fails, after saving the sectors read so far so that the snapshot can be resumed
+    """
+    flash_size = flash_size_from_product_id(brick.product_id)
+    size = max(flash_size, PFX_FLASH_FAT_ADDR + PFX_FLASH_FAT_SZ)
+    brick.refresh_file_dir()
+    files = [_file_to_dict(f) for f in brick.filedir.files]
+    name = brick.get_name()
+    fat = bytearray(PFX_FLASH_FAT_SZ)
+    flash_read_exact(brick, PFX_FLASH_FAT_ADDR, fat)
+    # an existing image made with a different size is recreated by reset
+    image = PFxFlashImage(filename, None if os.path.isfile(filename) else size)
+    fat_end = PFX_FLASH_FAT_ADDR + PFX_FLASH_FAT_SZ
+    if (
+        image.size != size
+        or image.serial_no != brick.serial_no
+        or image.data[PFX_FLASH_FAT_ADDR:fat_end] != fat
+        or [_file_to_dict(f) for f in image.files] != files
+    ):
+        image.reset(size)
+        image.created = time.strftime("%Y-%m-%d %H:%M:%S")
+    image.serial_no = brick.serial_no
+    image.product_id = brick.product_id
+    image.name = name
+    image.files = [_file_from_dict(d) for d in files]
+    image.data[PFX_FLASH_FAT_ADDR:fat_end] = fat
+    for s in range(
+        PFX_FLASH_FAT_ADDR // PFX_FLASH_SECTOR_SZ, fat_end // PFX_FLASH_SECTOR_SZ
+    ):
+        image.mark_sector(s)
+
+    sectors = image.missing_sectors(_snapshot_sectors(flash_size, regions))
+    if skip_free:
+        erased = b"\xFF" * PFX_FLASH_SECTOR_SZ
+        todo = []
+        for s in sectors:
+            if s < PFX_FLASH_FAT_SZ // 2 and image.fat_entry(s) == PFX_FAT_SECTOR_FREE:
+                a = s * PFX_FLASH_SECTOR_SZ
+                image.data[a : a + PFX_FLASH_SECTOR_SZ] = erased
+                image.mark_sector(s)
+            else:
+                todo.append(s)
+        sectors = todo
+    nBytes = len(sectors) * PFX_FLASH_SECTOR_SZ
+
+    def _read_sectors(cb):
+        with memoryview(image.data) as mv:
+            for i, s in enumerate(sectors):
+                a = s * PFX_FLASH_SECTOR_SZ
+                # released even on error, so that the image can be closed
+                with mv[a : a + PFX_FLASH_SECTOR_SZ] as buf:
+                    flash_read_exact(brick, a, buf)
+                image.mark_sector(s)
+                if (i + 1) % PFX_SNAPSHOT_SAVE_INTERVAL == 0:
+                    image.save()
+                if cb is not None:
+                    cb((i + 1) * PFX_FLASH_SECTOR_SZ, nBytes)
+
+    try:
+        if has_rich and show_progress and nBytes:
+            with progress:
+                transfer = progress.add_task(
+                    "snapshot", filename=os.path.basename(filename), total=nBytes
+                )
+
+                def _update(n, total):
+                    progress.update(transfer, completed=n)
+                    if callback is not None:
+                        callback(n, total)
+
+                _read_sectors(_update)
+            progress.remove_task(transfer)
+        else:
+            cb = callback
+            if show_progress and nBytes:
+
+                def cb(n, total):
+                    printProgressBar(
+                        n, total, prefix="Reading:", suffix="Complete", length=50
+                    )
+                    if callback is not None:
+                        callback(n, total)
+
+            _read_sectors(cb)
+    except BaseException:
+        image.close()
+        raise
+    image.save()
+    return image
+
+
+class PFxFlashArchive:
+    """
+    Compact archive of the files of a PFx Brick.
+
+    An archive is a zip file with a ``manifest.json`` describing the PFx
+    Brick and its file directory, and the contents of each file stored
+    once under its CRC32 and size.  Archives are created from a
+    :obj:`PFxFlashImage` with :obj:`save_flash_archive` and can be
+    restored with :obj:`PFxBrick.restore_files`.
+
+    :param filename: :obj:`str` the archive file to open
+
+    Attributes:
+        filename (:obj:`str`): the archive filename
+
+        serial_no (:obj:`str`): serial number of the archived PFx Brick
+
+        product_id (:obj:`str`): product ID code of the archived PFx Brick
+
+        name (:obj:`str`): user defined name of the archived PFx Brick
+
+        created (:obj:`str`): local time the snapshot was started
+
+        files ([:obj:`PFxFile`]): file directory of the archived PFx Brick
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._zip = zipfile.ZipFile(filename, "r")
+        meta = json.loads(self._zip.read("manifest.json"))
+        self.serial_no = meta["serial_no"]
+        self.product_id = meta["product_id"]
+        self.name = meta["name"]
+        self.created = meta["created"]
+        self.files = [_file_from_dict(d) for d in meta["files"]]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._zip.close()
+
+    def read_file(self, pfile):
+        """
+        Returns the contents of a file in the archive.
+
+        :param pfile: :obj:`PFxFile` directory entry of the file
+        :returns: :obj:`bytes` the file contents
+        :raises: :obj:`FileCRCMismatchException` if the contents do not match the CRC32 of the file
+        """
+        data = self._zip.read(_archive_member(pfile))
+        _check_crc32(pfile, data)
+        return data
+
+
+def _archive_member(pfile):
+    return "files/%08X-%d.bin" % (pfile.crc32, pfile.size)
+
+
+def save_flash_archive(image, path=None):
+    """
+    Saves the files of a flash image as a compact archive in a directory
+    named after the serial number of the PFx Brick.
+
+    :param image: :obj:`PFxFlashImage` a complete snapshot of the PFx Brick files
+    :param path: :obj:`str` optional archive directory, defaults to :obj:`default_archive_dir`
+    :returns: :obj:`str` the archive filename
+    :raises: :obj:`ValueError` if a file is not complete in the image
+    """
+    path = path if path is not None else default_archive_dir()
+    folder = os.path.join(path, image.serial_no or "unknown")
+    os.makedirs(folder, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    fn = os.path.join(folder, stamp + ".zip")
+    n = 1
+    while os.path.exists(fn):
+        n += 1
+        fn = os.path.join(folder, "%s-%d.zip" % (stamp, n))
+    meta = {
+        "serial_no": image.serial_no,
+        "product_id": image.product_id,
+        "name": image.name,
+        "created": image.created,
+        "files": [_file_to_dict(f) for f in image.files],
+    }
+    tmp = fn + ".tmp"
+    try:
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("manifest.json", json.dumps(meta, indent=1))
+            stored = set()
+            for f in image.files:
+                member = _archive_member(f)
+                if member not in stored:
+                    z.writestr(member, image.read_file(f))
+                    stored.add(member)
+        os.replace(tmp, fn)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return fn
+
+
+def flash_archives(serial_no, path=None):
+    """
+    Returns the archives of a PFx Brick from oldest to newest.
+
+    :param serial_no: :obj:`str` serial number of the PFx Brick
+    :param path: :obj:`str` optional archive directory, defaults to :obj:`default_archive_dir`
+    :returns: [:obj:`str`] archive filenames
+    """
+    path = path if path is not None else default_archive_dir()
+    folder = os.path.join(path, serial_no)
+    if not os.path.isdir(folder):
+        return []
+    fns = [
+        os.path.join(folder, e.name)
+        for e in os.scandir(folder)
+        if e.name.endswith(".zip") and e.is_file()
+    ]
+    return sorted(fns, key=lambda fn: (os.path.getmtime(fn), fn))
@@ -527,9 +527,11 @@ def printProgressBar(
 
 def get_file_crc32(fn):
     """Returns the CRC32 over the bytes of specified file on the local file system."""
+    crc = 0
     with open(fn, "rb") as fp:
-        fb = fp.read()
-    return zlib.crc32(fb) & 0xFFFFFFFF
+        for fb in iter(lambda: fp.read(0x10000), b""):
+            crc = zlib.crc32(fb, crc)
+    return crc & 0xFFFFFFFF
 
 
 def bounds_from_notchcount(count):
@@ -659,25 +661,30 @@ def get_one_pfxbrick(serial_no=None):
     If only one is connected, then a PFxBrick object is returned for it.
     If more than one is connected, a warning to select using serial number is shown.
     """
-    from pfxbrick.pfxbrick import PFxBrick, find_bricks
+    from pfxbrick.pfxbrick import PFxBrick
+    from pfxbrick.pfxregistry import usb_registry
 
     b = None
-    bricks = find_bricks()
+    devices = usb_registry.devices()
+    bricks = [dev.serial_no for dev in devices]
     if len(bricks) > 1 and serial_no is None:
         print(
             "More than one PFx Brick is attached.  Please specify brick serial number with the -s argument."
         )
         print("Currently attached PFx Bricks:")
-        for brick in bricks:
-            b = PFxBrick(brick)
-            r = b.open()
-            b.get_status()
-            name = b.get_name()
+        # the PFx Bricks are opened in parallel to read their names
+        for dev in usb_registry.describe(devices):
+            if dev.status is None:
+                continue
             print(
                 "[light_slate_blue]%-4s[/] [bold cyan]%-24s[/] Serial no: [bold cyan]%-9s[/] Name: [bold yellow]%s[/]"
-                % (b.product_id, b.product_desc, b.serial_no, name)
+                % (
+                    dev.status["product_id"],
+                    dev.status["product_desc"],
+                    dev.serial_no,
+                    dev.status["name"],
+                )
             )
-            b.close()
         exit()
     if serial_no is not None and len(bricks) > 1:
         b = PFxBrick(serial_no=serial_no)
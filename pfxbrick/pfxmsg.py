@@ -23,72 +23,127 @@
 #
 # PFx Brick message helpers
 
-
-import hid
-
 from .pfx import *
-from .pfxexceptions import InvalidResponseException
+from .pfxexceptions import FlashReadException, InvalidResponseException
 from .pfxhelpers import uint32_to_bytes
+from .pfxtransport import PFX_USB_PIPELINE_DEPTH, get_transport, usb_transport
+
+# pre-computed templates for ICD messages which never change
+_MSG_GET_ICD_REV = bytes(
+    (PFX_CMD_GET_ICD_REV, PFX_GET_ICD_BYTE0, PFX_GET_ICD_BYTE1, PFX_GET_ICD_BYTE2, 0)
+)
+_MSG_GET_ICD_REV_SILENT = bytes(
+    (PFX_CMD_GET_ICD_REV, PFX_GET_ICD_BYTE0, PFX_GET_ICD_BYTE1, PFX_GET_ICD_BYTE2, 1)
+)
+_MSG_GET_STATUS = bytes(
+    (
+        PFX_CMD_GET_STATUS,
+        PFX_STATUS_BYTE0,
+        PFX_STATUS_BYTE1,
+        PFX_STATUS_BYTE2,
+        PFX_STATUS_BYTE3,
+        PFX_STATUS_BYTE4,
+        PFX_STATUS_BYTE5,
+        PFX_STATUS_BYTE6,
+    )
+)
+_MSG_SET_FACTORY_DEFAULTS = bytes(
+    (
+        PFX_CMD_SET_FACTORY_DEFAULTS,
+        PFX_RESET_BYTE0,
+        PFX_RESET_BYTE1,
+        PFX_RESET_BYTE2,
+        PFX_RESET_BYTE3,
+        PFX_RESET_BYTE4,
+        PFX_RESET_BYTE5,
+        PFX_RESET_BYTE6,
+    )
+)
+_MSG_GET_CONFIG = bytes((PFX_CMD_GET_CONFIG,))
+_MSG_GET_NAME = bytes((PFX_CMD_GET_NAME,))
+_MSG_GET_CURRENT_STATE = bytes((PFX_CMD_GET_CURRENT_STATE,))
+_MSG_GET_NUM_FILES = bytes((PFX_CMD_FILE_DIR, PFX_DIR_REQ_GET_FILE_COUNT))
+_MSG_GET_FREE_SPACE = bytes((PFX_CMD_FILE_DIR, PFX_DIR_REQ_GET_FREE_SPACE))
+
+# number of bytes of flash memory read by each PFX_CMD_READ_FLASH request
+PFX_FLASH_READ_SZ = 60
+
+
+def usb_frame(hdev):
+    """Returns the reusable :obj:`PFxUSBFrame` report buffer for a device handle."""
+    return usb_transport(hdev).frame
+
+
+def usb_start_reader(hdev, callback=None):
+    """
+    Starts a background :obj:`PFxUSBReader` for a device handle if one is not
+    already running.  An existing reader has its callback replaced.
+
+    :returns: the running :obj:`PFxUSBReader`
+    """
+    return usb_transport(hdev).start_reader(callback)
+
+
+def usb_stop_reader(hdev):
+    """Stops the background reader of a device handle, if any."""
+    usb_transport(hdev).stop_reader()
+
+
+def usb_reader(hdev):
+    """Returns the running background reader of a device handle or None."""
+    return usb_transport(hdev).reader
+
+
+def usb_write(hdev, msg):
+    usb_transport(hdev).send(msg)
 
 
 def usb_transaction(hdev, msg):
-    # enforce non-numbered report pre-pending and report length
-    # This ensures consistent operation on Windows, macOS, etc.
-    # since Windows insists on matched report length/buffer size
-    # and for all non-numbered reports to start with 0
-    msglen = len(msg)
-    buf = [0]
-    buf.extend(msg)
-    buf.extend([0] * (64 - msglen))
-    hdev.write(buf)
-    if not msg[0] == PFX_CMD_FILE_WRITE_FAST:
-        res = hdev.read(64)
-    else:
-        res = [msg[0] | 0x80]
-        res.extend([0] * 63)
-    if res:
-        if res[0] == msg[0] | 0x80:
-            return res
-        else:
-            raise InvalidResponseException()
-    return 0
+    return usb_transport(hdev).transact(msg)
+
+
+def usb_pipelined_transaction(hdev, msgs, depth=PFX_USB_PIPELINE_DEPTH):
+    """
+    Sends a sequence of ICD messages with several requests in flight at once.
+    See :obj:`PFxUSBTransport.batch`.
+
+    :param hdev: USB HID session handle
+    :param msgs: a list of ICD messages, each an integer list of bytes
+    :param depth: :obj:`int` maximum number of outstanding requests
+    :returns: a list of responses in the same order as msgs
+    """
+    return usb_transport(hdev).batch(msgs, depth)
 
 
 def msg_transaction(hdev, msg):
-    if isinstance(hdev, hid.device):
-        return usb_transaction(hdev, msg)
-    else:
-        return hdev.ble_transaction(msg)
+    transport = get_transport(hdev)
+    if transport.stats is None:
+        return transport.transact(msg)
+    return transport.stats.timed(transport.transact, msg)
+
+
+def msg_batch_transaction(hdev, msgs):
+    """
+    Sends a list of ICD messages and returns their responses in order.
+    USB sessions are pipelined, Bluetooth sessions are sent one at a time.
+    """
+    transport = get_transport(hdev)
+    if transport.stats is None:
+        return transport.batch(msgs)
+    return transport.stats.timed_batch(transport.batch, msgs)
 
 
 def cmd_get_icd_rev(hdev, silent=False):
-    msg = [
-        PFX_CMD_GET_ICD_REV,
-        PFX_GET_ICD_BYTE0,
-        PFX_GET_ICD_BYTE1,
-        PFX_GET_ICD_BYTE2,
-        int(silent),
-    ]
+    msg = _MSG_GET_ICD_REV_SILENT if silent else _MSG_GET_ICD_REV
     return msg_transaction(hdev, msg)
 
 
 def cmd_get_status(hdev):
-    msg = [
-        PFX_CMD_GET_STATUS,
-        PFX_STATUS_BYTE0,
-        PFX_STATUS_BYTE1,
-        PFX_STATUS_BYTE2,
-        PFX_STATUS_BYTE3,
-        PFX_STATUS_BYTE4,
-        PFX_STATUS_BYTE5,
-        PFX_STATUS_BYTE6,
-    ]
-    return msg_transaction(hdev, msg)
+    return msg_transaction(hdev, _MSG_GET_STATUS)
 
 
 def cmd_get_config(hdev):
-    msg = [PFX_CMD_GET_CONFIG]
-    return msg_transaction(hdev, msg)
+    return msg_transaction(hdev, _MSG_GET_CONFIG)
 
 
 def cmd_set_config(hdev, cfgbytes):
@@ -98,8 +153,7 @@ def cmd_set_config(hdev, cfgbytes):
 
 
 def cmd_get_name(hdev):
-    msg = [PFX_CMD_GET_NAME]
-    return msg_transaction(hdev, msg)
+    return msg_transaction(hdev, _MSG_GET_NAME)
 
 
 def cmd_set_name(hdev, name):
@@ -123,6 +177,11 @@ def cmd_set_event_action(hdev, evtID, ch, action):
     return msg_transaction(hdev, msg)
 
 
+def cmd_get_event_actions(hdev, evtchs):
+    msgs = [[PFX_CMD_GET_EVENT_ACTION, evtID, ch] for evtID, ch in evtchs]
+    return msg_batch_transaction(hdev, msgs)
+
+
 def cmd_test_action(hdev, action):
     msg = [PFX_CMD_TEST_ACTION]
     msg.extend(action)
@@ -134,28 +193,41 @@ def cmd_get_dir_entry(hdev, idx):
     return msg_transaction(hdev, msg)
 
 
-def cmd_get_num_files(hdev):
-    msg = [PFX_CMD_FILE_DIR, PFX_DIR_REQ_GET_FILE_COUNT]
+def cmd_get_dir_entries(hdev, indices):
+    msgs = [[PFX_CMD_FILE_DIR, PFX_DIR_REQ_GET_DIR_ENTRY_IDX, idx] for idx in indices]
+    return msg_batch_transaction(hdev, msgs)
+
+
+def cmd_get_dir_entry_id(hdev, fid):
+    msg = [PFX_CMD_FILE_DIR, PFX_DIR_REQ_GET_DIR_ENTRY_ID, fid]
     return msg_transaction(hdev, msg)
 
 
+def cmd_get_dir_entry_with_space(hdev, fid):
+    """
+    Reads the directory entry of a file ID, the number of files and the free
+    space of the file system in one pipelined batch.
+
+    :returns: a list of the three responses
+    """
+    msgs = [
+        [PFX_CMD_FILE_DIR, PFX_DIR_REQ_GET_DIR_ENTRY_ID, fid],
+        _MSG_GET_NUM_FILES,
+        _MSG_GET_FREE_SPACE,
+    ]
+    return msg_batch_transaction(hdev, msgs)
+
+
+def cmd_get_num_files(hdev):
+    return msg_transaction(hdev, _MSG_GET_NUM_FILES)
+
+
 def cmd_get_free_space(hdev):
-    msg = [PFX_CMD_FILE_DIR, PFX_DIR_REQ_GET_FREE_SPACE]
-    return msg_transaction(hdev, msg)
+    return msg_transaction(hdev, _MSG_GET_FREE_SPACE)
 
 
 def cmd_set_factory_defaults(hdev):
-    msg = [
-        PFX_CMD_SET_FACTORY_DEFAULTS,
-        PFX_RESET_BYTE0,
-        PFX_RESET_BYTE1,
-        PFX_RESET_BYTE2,
-        PFX_RESET_BYTE3,
-        PFX_RESET_BYTE4,
-        PFX_RESET_BYTE5,
-        PFX_RESET_BYTE6,
-    ]
-    return msg_transaction(hdev, msg)
+    return msg_transaction(hdev, _MSG_SET_FACTORY_DEFAULTS)
 
 
 def cmd_set_notifications(hdev, flags):
@@ -176,14 +248,17 @@ def cmd_file_dir(hdev, req, params=None):
 
 
 def cmd_get_current_state(hdev):
-    msg = [PFX_CMD_GET_CURRENT_STATE]
-    return msg_transaction(hdev, msg)
+    return msg_transaction(hdev, _MSG_GET_CURRENT_STATE)
 
 
 def cmd_raw(hdev, msg):
     return msg_transaction(hdev, msg)
 
 
+def cmd_raw_batch(hdev, msgs):
+    return msg_batch_transaction(hdev, msgs)
+
+
 def i2c_write(brick, add, data):
     brick.send_raw_icd_command([PFX_CMD_WRITE_I2C, 0x30, add, data])
 
@@ -194,12 +269,53 @@ def i2c_read(brick, add):
     return res[2 : 2 + nbytes]
 
 
+def flash_read_into(brick, add, buf):
+    """
+    Reads flash memory directly into a writable buffer such as a
+    :obj:`bytearray` or a slice of an :obj:`mmap.mmap`.  The read requests
+    for the whole buffer are sent as one pipelined batch.
+
+    :param brick: :obj:`PFxBrick` object
+    :param add: :obj:`int` flash memory address to start reading from
+    :param buf: writable bytes-like object to fill with len(buf) bytes
+    :returns: :obj:`int` number of bytes read, which is less than len(buf) on error
+    """
+    with memoryview(buf) as mv, mv.cast("B") as view:
+        n = len(view)
+        msgs = []
+        for x in range(0, n, PFX_FLASH_READ_SZ):
+            msg = [PFX_CMD_READ_FLASH]
+            msg.extend(uint32_to_bytes(add + x))
+            msg.append(min(PFX_FLASH_READ_SZ, n - x))
+            msgs.append(msg)
+        x = 0
+        for res in brick.send_raw_icd_commands(msgs):
+            k = min(PFX_FLASH_READ_SZ, n - x)
+            if not res or len(res) < k + 1:
+                break
+            view[x : x + k] = bytes(res[1 : k + 1])
+            x += k
+        return x
+
+
+def flash_read_exact(brick, add, buf):
+    """
+    Reads flash memory into a writable buffer like :obj:`flash_read_into`,
+    but raises an exception rather than returning a partly filled buffer.
+
+    :param brick: :obj:`PFxBrick` object
+    :param add: :obj:`int` flash memory address to start reading from
+    :param buf: writable bytes-like object to fill with len(buf) bytes
+    :raises: :obj:`FlashReadException` if the PFx Brick did not return every byte
+    """
+    n = flash_read_into(brick, add, buf)
+    if n < len(buf):
+        raise FlashReadException(
+            "Flash read failed at 0x%06X after %d of %d bytes" % (add + n, n, len(buf))
+        )
+
+
 def flash_read(brick, add, num_bytes):
-    rbytes = []
-    for x in range(0, num_bytes, 60):
-        msg = [PFX_CMD_READ_FLASH]
-        msg.extend(uint32_to_bytes(add + x))
-        msg.append(60)
-        res = brick.send_raw_icd_command(msg)
-        rbytes.extend(res[1:61])
-    return rbytes[0:num_bytes]
+    rbytes = bytearray(num_bytes)
+    flash_read_exact(brick, add, rbytes)
+    return list(rbytes)
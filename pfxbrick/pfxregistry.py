@@ -0,0 +1,316 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2021  Fx Bricks Inc.
+# This file is part of the pfxbrick python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# PFx Brick USB device registry
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import hid
+
+from .pfx import *
+
+# seconds for which a USB enumeration is reused before hid.enumerate is called again
+PFX_USB_ENUM_MAX_AGE = 2.0
+
+# maximum number of PFx Bricks opened at once to read their names
+PFX_USB_OPEN_WORKERS = 8
+
+
+class PFxUSBDevice:
+    """
+    A PFx Brick found on the USB bus, described only with data from
+    ``hid.enumerate()`` so that the device does not need to be opened.
+
+    Attributes:
+        serial_no (:obj:`str`): USB serial number string
+
+        product_string (:obj:`str`): USB product descriptor string
+
+        manufacturer_string (:obj:`str`): USB manufacturer string
+
+        path (:obj:`bytes`): platform specific HID device path
+
+        release_number (:obj:`int`): USB device release number
+
+        status (:obj:`dict`): product_id, product_desc and name read from the PFx Brick by :obj:`PFxBrickRegistry.describe`, or None
+    """
+
+    def __init__(self, d):
+        self.serial_no = d["serial_number"]
+        self.product_string = d["product_string"]
+        self.manufacturer_string = d["manufacturer_string"]
+        self.path = d["path"]
+        self.release_number = d["release_number"]
+        self.status = None
+
+    def __str__(self):
+        return "%s, Serial No: %s" % (self.product_string, self.serial_no)
+
+
+class PFxBrickRegistry:
+    """
+    Cache of the PFx Bricks connected to the USB bus.
+
+    ``hid.enumerate`` is only called when the cached enumeration is older
+    than max_age seconds, so repeated lookups, e.g. from :obj:`find_bricks`
+    and :obj:`PFxBrick.open`, cost nothing.  PFx Bricks are only opened by
+    :obj:`describe`, and then in parallel, when information which is not
+    available from the USB descriptors, such as the brick name, is needed.
+
+    :param max_age: :obj:`float` seconds for which an enumeration is reused
+    """
+
+    def __init__(self, max_age=PFX_USB_ENUM_MAX_AGE):
+        self.max_age = max_age
+        self._devices = {}
+        self._time = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Enumerates the USB bus for PFx Bricks now.  Descriptions read by
+        :obj:`describe` are kept for PFx Bricks which are still connected.
+
+        :returns: [:obj:`PFxUSBDevice`] connected PFx Bricks
+        """
+        devices = {}
+        for d in hid.enumerate(PFX_USB_VENDOR_ID, PFX_USB_PRODUCT_ID):
+            if (
+                d["vendor_id"] == PFX_USB_VENDOR_ID
+                and d["product_id"] == PFX_USB_PRODUCT_ID
+                and d["serial_number"] not in devices
+            ):
+                devices[d["serial_number"]] = PFxUSBDevice(d)
+        with self._lock:
+            for serial_no, dev in devices.items():
+                if serial_no in self._devices:
+                    dev.status = self._devices[serial_no].status
+            self._devices = devices
+            self._time = time.monotonic()
+        return list(devices.values())
+
+    def invalidate(self):
+        """
+        Forces the next lookup to enumerate the USB bus again and the next
+        :obj:`describe` to open the PFx Bricks again.
+        """
+        with self._lock:
+            self._time = None
+            self._devices = {}
+
+    def devices(self, max_age=None):
+        """
+        Returns the connected PFx Bricks, enumerating the USB bus only if the
+        cached enumeration is too old.
+
+        :param max_age: :obj:`float` optional override of the cache age limit in seconds
+        :returns: [:obj:`PFxUSBDevice`] connected PFx Bricks
+        """
+        if max_age is None:
+            max_age = self.max_age
+        with self._lock:
+            if self._time is not None and time.monotonic() - self._time <= max_age:
+                return list(self._devices.values())
+        return self.refresh()
+
+    def serials(self, max_age=None):
+        """Returns the serial numbers of the connected PFx Bricks."""
+        return [dev.serial_no for dev in self.devices(max_age)]
+
+    def get(self, serial_no, max_age=None):
+        """
+        Returns the :obj:`PFxUSBDevice` with a serial number, enumerating
+        again if it is not in the cached enumeration.
+
+        :returns: :obj:`PFxUSBDevice` or None if not connected
+        """
+        for dev in self.devices(max_age):
+            if dev.serial_no == serial_no:
+                return dev
+        for dev in self.refresh():
+            if dev.serial_no == serial_no:
+                return dev
+        return None
+
+    def describe(self, devices=None, max_workers=PFX_USB_OPEN_WORKERS):
+        """
+        Opens PFx Bricks in parallel to read their product ID, product
+        description and name.  Results are cached in :obj:`PFxUSBDevice.status`
+        and PFx Bricks which were already described are not opened again.
+
+        :param devices: [:obj:`PFxUSBDevice`] optional PFx Bricks to describe, defaults to all connected
+        :param max_workers: :obj:`int` maximum number of PFx Bricks opened at once
+        :returns: [:obj:`PFxUSBDevice`] the described PFx Bricks
+        """
+        from pfxbrick.pfxbrick import PFxBrick
+
+        def _describe(dev):
+            b = PFxBrick()
+            if b.open(dev.serial_no):
+                try:
+                    dev.status = {
+                        "product_id": b.product_id,
+                        "product_desc": b.product_desc,
+                        "name": b.get_name(),
+                    }
+                finally:
+                    b.close()
+
+        if devices is None:
+            devices = self.devices()
+        todo = [dev for dev in devices if dev.status is None]
+        if len(todo) == 1:
+            _describe(todo[0])
+        elif todo:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(todo))) as ex:
+                list(ex.map(_describe, todo))
+        return devices
+
+
+usb_registry = PFxBrickRegistry()
+
+
+PFX_HOTPLUG_ATTACH = "attach"
+PFX_HOTPLUG_DETACH = "detach"
+
+# seconds between checks for attached or detached PFx Bricks
+PFX_HOTPLUG_INTERVAL = 0.5
+
+# on Linux, every HID device has a node in this directory, so listing it is a
+# cheap way to notice that a device was attached or detached before calling
+# the much slower hid.enumerate
+_HIDRAW_DIR = "/sys/class/hidraw"
+
+
+class PFxHotplugWatcher(threading.Thread):
+    """
+    Background thread which watches the USB bus for PFx Bricks being
+    attached or detached.
+
+    Each listener is called from the watcher thread as
+    ``func(event, serial_no)`` where event is `PFX_HOTPLUG_ATTACH` or
+    `PFX_HOTPLUG_DETACH`.  The registry enumeration is only refreshed when
+    the set of HID devices may have changed; on Linux this is detected by
+    listing ``/sys/class/hidraw``, elsewhere the enumeration is refreshed
+    every interval.
+
+    :param callback: optional listener function
+    :param interval: :obj:`float` seconds between checks
+    :param registry: :obj:`PFxBrickRegistry` to keep up to date, defaults to ``usb_registry``
+    """
+
+    def __init__(self, callback=None, interval=PFX_HOTPLUG_INTERVAL, registry=None):
+        super().__init__(name="PFxHotplugWatcher", daemon=True)
+        self.interval = interval
+        self.registry = registry if registry is not None else usb_registry
+        self._listeners = []
+        if callback is not None:
+            self._listeners.append(callback)
+        self._stop_event = threading.Event()
+        self._hidraw = None
+        self._serials = set(self.registry.serials())
+        self._log = logging.getLogger(str(self.__class__))
+
+    @property
+    def serials(self):
+        """Serial numbers of the PFx Bricks currently attached."""
+        return sorted(self._serials)
+
+    def add_listener(self, func):
+        """Adds a function called with (event, serial_no) for every event."""
+        if func not in self._listeners:
+            self._listeners.append(func)
+
+    def remove_listener(self, func):
+        """Removes a listener added with :obj:`add_listener`."""
+        if func in self._listeners:
+            self._listeners.remove(func)
+
+    def stop(self):
+        """Stops the watcher thread and waits for it to finish."""
+        self._stop_event.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def _may_have_changed(self):
+        if not os.path.isdir(_HIDRAW_DIR):
+            return True
+        try:
+            nodes = frozenset(os.listdir(_HIDRAW_DIR))
+        except OSError:
+            return True
+        if nodes == self._hidraw:
+            return False
+        self._hidraw = nodes
+        return True
+
+    def check(self):
+        """
+        Checks for attached or detached PFx Bricks now and calls the
+        listeners for every change.
+
+        :returns: ([:obj:`str`], [:obj:`str`]) serial numbers attached and detached
+        """
+        if not self._may_have_changed():
+            return [], []
+        serials = set(dev.serial_no for dev in self.registry.refresh())
+        attached = sorted(serials - self._serials)
+        detached = sorted(self._serials - serials)
+        self._serials = serials
+        for serial_no in detached:
+            self._notify(PFX_HOTPLUG_DETACH, serial_no)
+        for serial_no in attached:
+            self._notify(PFX_HOTPLUG_ATTACH, serial_no)
+        return attached, detached
+
+    def _notify(self, event, serial_no):
+        for func in list(self._listeners):
+            try:
+                func(event, serial_no)
+            except Exception as e:
+                self._log.error("Hotplug listener failed: %s" % (e))
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.check()
+            except (IOError, OSError) as e:
+                self._log.error("USB enumeration failed: %s" % (e))
+
+
+_hotplug_watcher = None
+_hotplug_lock = threading.Lock()
+
+
+def hotplug_watcher():
+    """Returns the shared :obj:`PFxHotplugWatcher`, starting it if necessary."""
+    global _hotplug_watcher
+    with _hotplug_lock:
+        if _hotplug_watcher is None or not _hotplug_watcher.is_alive():
+            _hotplug_watcher = PFxHotplugWatcher()
+            _hotplug_watcher.start()
+        return _hotplug_watcher
@@ -0,0 +1,225 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2021  Fx Bricks Inc.
+# This file is part of the pfxbrick python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# PFx Brick ICD transaction statistics
+
+import copy
+import inspect
+import threading
+import time
+
+import pfxbrick.pfx as pfx
+
+# number of log2 latency histogram buckets, bucket i counts latencies
+# below 2^i microseconds and the last bucket counts everything slower
+PFX_STATS_BUCKETS = 24
+
+_CMD_NAMES = {}
+for k, v in vars(pfx).items():
+    if k.startswith("PFX_CMD_"):
+        _CMD_NAMES.setdefault(v, k[8:])
+
+
+def icd_command_name(cmd):
+    """Returns a readable name for an ICD command byte, e.g. 'FILE_WRITE_FAST'."""
+    return _CMD_NAMES.get(cmd, "0x%02X" % (cmd))
+
+
+class PFxCommandStats:
+    """
+    Counters and latency histogram for one ICD command byte.
+
+    Attributes:
+        cmd (:obj:`int`): ICD command byte
+
+        count (:obj:`int`): number of transactions
+
+        bytes_out (:obj:`int`): total request bytes sent
+
+        bytes_in (:obj:`int`): total response bytes received
+
+        total_time (:obj:`float`): total latency in seconds
+
+        max_time (:obj:`float`): slowest latency in seconds
+
+        buckets ([:obj:`int`]): log2 latency histogram, bucket i counts latencies below 2^i microseconds
+    """
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.count = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * PFX_STATS_BUCKETS
+
+    def add(self, nout, nin, dt):
+        self.count += 1
+        self.bytes_out += nout
+        self.bytes_in += nin
+        self.total_time += dt
+        if dt > self.max_time:
+            self.max_time = dt
+        b = int(dt * 1e6).bit_length()
+        self.buckets[min(b, PFX_STATS_BUCKETS - 1)] += 1
+
+    @property
+    def name(self):
+        return icd_command_name(self.cmd)
+
+    @property
+    def mean_time(self):
+        """Mean latency in seconds."""
+        return self.total_time / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """
+        Returns an upper bound of the latency percentile in seconds from the
+        histogram bucket which contains it.
+
+        :param p: :obj:`float` percentile (0 - 100)
+        """
+        if not self.count:
+            return 0.0
+        target = self.count * p / 100
+        n = 0
+        for i, c in enumerate(self.buckets):
+            n += c
+            if n >= target and c:
+                return min((1 << i) / 1e6, self.max_time)
+        return self.max_time
+
+    def __str__(self):
+        return "%-20s %8d %10d %10d %9.3f %9.3f %9.3f %9.3f" % (
+            self.name,
+            self.count,
+            self.bytes_out,
+            self.bytes_in,
+            self.total_time,
+            self.mean_time * 1e3,
+            self.percentile(99) * 1e3,
+            self.max_time * 1e3,
+        )
+
+
+class PFxTransportStats:
+    """
+    Per ICD command transaction statistics of a :obj:`PFxTransport`.
+
+    Statistics are collected by :obj:`msg_transaction` and
+    :obj:`msg_batch_transaction` only while an instance is assigned to the
+    ``stats`` attribute of a transport.  Messages sent in a batch are each
+    assigned an equal share of the batch time.
+
+    Attributes:
+        commands ({:obj:`int`: :obj:`PFxCommandStats`}): statistics by ICD command byte
+    """
+
+    def __init__(self):
+        self.commands = {}
+        self._lock = threading.Lock()
+
+    def add(self, msg, res, dt):
+        nin = len(res) if res and msg[0] != pfx.PFX_CMD_FILE_WRITE_FAST else 0
+        with self._lock:
+            s = self.commands.get(msg[0])
+            if s is None:
+                s = PFxCommandStats(msg[0])
+                self.commands[msg[0]] = s
+            s.add(len(msg), nin, dt)
+
+    def timed(self, func, msg):
+        """
+        Calls func(msg) and records its latency.  A co-routine returned by
+        func, e.g. for Bluetooth, is wrapped so that its latency is recorded
+        when it is awaited.
+        """
+        t = time.perf_counter()
+        res = func(msg)
+        if inspect.iscoroutine(res):
+            return self._timed_coro(res, msg)
+        self.add(msg, res, time.perf_counter() - t)
+        return res
+
+    async def _timed_coro(self, coro, msg):
+        t = time.perf_counter()
+        res = await coro
+        self.add(msg, res, time.perf_counter() - t)
+        return res
+
+    def timed_batch(self, func, msgs):
+        """Calls func(msgs) and records an equal share of its latency per message."""
+        t = time.perf_counter()
+        results = func(msgs)
+        if inspect.iscoroutine(results):
+            return self._timed_batch_coro(results, msgs)
+        self._add_batch(msgs, results, time.perf_counter() - t)
+        return results
+
+    async def _timed_batch_coro(self, coro, msgs):
+        t = time.perf_counter()
+        results = await coro
+        self._add_batch(msgs, results, time.perf_counter() - t)
+        return results
+
+    def _add_batch(self, msgs, results, dt):
+        dt = dt / max(len(msgs), 1)
+        for msg, res in zip(msgs, results):
+            self.add(msg, res, dt)
+
+    def snapshot(self):
+        """Returns an independent copy of the current statistics."""
+        s = PFxTransportStats()
+        with self._lock:
+            s.commands = copy.deepcopy(self.commands)
+        return s
+
+    def reset(self):
+        """Clears all statistics."""
+        with self._lock:
+            self.commands = {}
+
+    @property
+    def total_time(self):
+        """Total latency in seconds of all transactions."""
+        return sum(s.total_time for s in self.commands.values())
+
+    def __str__(self):
+        sb = []
+        sb.append(
+            "%-20s %8s %10s %10s %9s %9s %9s %9s"
+            % (
+                "Command",
+                "Count",
+                "Bytes out",
+                "Bytes in",
+                "Total s",
+                "Mean ms",
+                "p99 ms",
+                "Max ms",
+            )
+        )
+        for s in sorted(self.commands.values(), key=lambda x: -x.total_time):
+            sb.append(str(s))
+        return "\n".join(sb)
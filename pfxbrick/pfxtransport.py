@@ -0,0 +1,975 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2021  Fx Bricks Inc.
+# This file is part of the pfxbrick python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# PFx Brick ICD message transports
+
+import contextlib
+import logging
+import struct
+import threading
+import time
+import weakref
+from collections import deque
+
+import hid
+
+from .pfx import *
+from .pfxexceptions import (
+    InvalidResponseException,
+    ReplayMismatchException,
+    USBResponseTimeoutException,
+)
+
+# maximum number of ICD requests allowed in flight during a pipelined transaction
+PFX_USB_PIPELINE_DEPTH = 8
+
+# read timeout used by the background reader so that it can notice a stop request
+PFX_USB_READER_POLL_MS = 100
+
+# default time in seconds to wait for a USB response and the number of times
+# an idempotent query is retried after a timeout
+PFX_USB_TIMEOUT = 2.0
+PFX_USB_RETRIES = 1
+
+# time in seconds a new request waits for the late responses to earlier
+# requests with the same command byte which timed out, after which they are
+# assumed to be lost
+PFX_USB_STALE_TIMEOUT = 0.02
+
+# file system requests which erase or scan flash memory can take much longer
+# than other requests, so they are given at least this long to respond
+_USB_SLOW_TIMEOUTS = {
+    PFX_CMD_FILE_FORMAT_FS: 180.0,
+    PFX_CMD_FILE_OPEN: 60.0,
+    PFX_CMD_FILE_REMOVE: 60.0,
+    PFX_CMD_FILE_CLOSE: 30.0,
+}
+
+# queries which can be safely sent again if their response is lost
+_USB_IDEMPOTENT = {
+    PFX_CMD_GET_ICD_REV,
+    PFX_CMD_GET_STATUS,
+    PFX_CMD_GET_CONFIG,
+    PFX_CMD_GET_CURRENT_STATE,
+    PFX_CMD_GET_NAME,
+    PFX_CMD_GET_EVENT_ACTION,
+    PFX_CMD_FILE_GET_FS_STATE,
+    PFX_CMD_GET_BT_STATUS,
+    PFX_CMD_READ_FLASH,
+}
+_USB_IDEMPOTENT_DIR = {
+    PFX_DIR_REQ_GET_FILE_COUNT,
+    PFX_DIR_REQ_GET_FREE_SPACE,
+    PFX_DIR_REQ_GET_DIR_ENTRY_IDX,
+    PFX_DIR_REQ_GET_DIR_ENTRY_ID,
+    PFX_DIR_REQ_GET_NAMED_FILE_ID,
+}
+
+# the PFX_CMD_FILE_WRITE_FAST message has no response, so a successful
+# response is synthesized for it
+_USB_FAST_WRITE_RESPONSE = tuple([PFX_CMD_FILE_WRITE_FAST | 0x80] + [0] * 63)
+
+_USB_REPORT_ZEROS = memoryview(bytes(64))
+
+
+class PFxTransport:
+    """
+    Base class for a link which carries ICD messages to and from a PFx Brick.
+
+    Every ICD helper function reaches the PFx Brick through a transport by way
+    of :obj:`get_transport`.  A transport must provide :obj:`send` and
+    :obj:`receive`, and the default :obj:`transact` and :obj:`batch` methods
+    are built from them.  Transports which can do better, e.g. by pipelining
+    requests, override :obj:`transact` and :obj:`batch` directly.  A
+    transport can be passed to :obj:`PFxBrick.open` in place of a USB
+    connection.
+
+    Attributes:
+        stats (:obj:`PFxTransportStats`): transaction statistics being collected, or None
+    """
+
+    stats = None
+
+    def send(self, msg):
+        """
+        Sends an ICD message without waiting for its response.
+
+        :param msg: [:obj:`int`] ICD message as an integer list of bytes
+        """
+        raise NotImplementedError
+
+    def receive(self):
+        """
+        Waits for and returns the next message received from the PFx Brick.
+
+        :returns: [:obj:`int`] received message or an empty list if nothing was received
+        """
+        raise NotImplementedError
+
+    def transact(self, msg):
+        """
+        Sends an ICD message and returns its validated response.
+
+        :param msg: [:obj:`int`] ICD message as an integer list of bytes
+        :returns: [:obj:`int`] response message or 0 if nothing was received
+        :raises: :obj:`InvalidResponseException` if the response does not match the request
+        """
+        self.send(msg)
+        if msg[0] == PFX_CMD_FILE_WRITE_FAST:
+            return _USB_FAST_WRITE_RESPONSE
+        res = self.receive()
+        if res:
+            if res[0] == msg[0] | 0x80:
+                return res
+            raise InvalidResponseException()
+        return 0
+
+    def batch(self, msgs):
+        """
+        Sends a list of ICD messages and returns their responses in order.
+
+        :param msgs: [[:obj:`int`]] a list of ICD messages
+        :returns: [[:obj:`int`]] a list of responses in the same order as msgs
+        """
+        return [self.transact(msg) for msg in msgs]
+
+    def drain(self):
+        """
+        Discards late responses to requests which were abandoned, e.g. after
+        a timeout, so that they are not mistaken for the next response.
+        """
+        pass
+
+    def close(self):
+        """Closes the link to the PFx Brick."""
+        pass
+
+
+class PFxUSBFrame:
+    """
+    Reusable USB HID output report buffer.
+
+    One 65 byte buffer is kept per device handle so that ICD messages can be
+    framed without building and padding a new list for every transaction.
+    Only the bytes left over from a longer previous message are cleared.
+    """
+
+    def __init__(self):
+        self.buf = bytearray(65)
+        self.view = memoryview(self.buf)
+        self.msglen = 0
+
+    def pack(self, msg):
+        """
+        Copies an ICD message into the report buffer after the leading
+        non-numbered report byte and returns the buffer.
+        """
+        msglen = len(msg)
+        if msglen > 64:
+            raise ValueError("ICD message length %d exceeds 64 bytes" % (msglen))
+        self.buf[1 : 1 + msglen] = msg
+        if self.msglen > msglen:
+            self.view[1 + msglen : 1 + self.msglen] = _USB_REPORT_ZEROS[
+                : self.msglen - msglen
+            ]
+        self.msglen = msglen
+        return self.buf
+
+
+class PFxUSBWaiter:
+    """A pending request waiting for its response from a :obj:`PFxUSBReader`."""
+
+    def __init__(self, rsp):
+        self.rsp = rsp
+        self.res = None
+        self.exc = None
+        self.cancelled = False
+        self.event = threading.Event()
+
+    def set_result(self, res):
+        self.res = res
+        self.event.set()
+
+    def set_exception(self, exc):
+        self.exc = exc
+        self.event.set()
+
+    def wait(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise USBResponseTimeoutException()
+        if self.exc is not None:
+            raise self.exc
+        return self.res
+
+
+class PFxUSBReader(threading.Thread):
+    """
+    Background reader thread for a USB HID device handle.
+
+    The reader owns every ``hdev.read`` call for the device.  Responses are
+    routed in FIFO order to the oldest request with the same command byte and
+    `PFX_MSG_NOTIFICATION` frames are passed to a notification callback,
+    which is called from the reader thread.  A request which timed out keeps
+    its place in the queue so that its late response is discarded, until a
+    new request with the same command byte gives up waiting for it.
+
+    :param hdev: USB HID session handle
+    :param callback: optional function called with each notification message
+    """
+
+    def __init__(self, hdev, callback=None):
+        super().__init__(name="PFxUSBReader", daemon=True)
+        self.hdev = hdev
+        self.callback = callback
+        self.write_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._waiters = {}
+        self._order = deque()
+        self._stop_flag = False
+        self._exc = None
+        self._log = logging.getLogger(str(self.__class__))
+
+    def expect(self, rsp):
+        """
+        Registers a caller waiting for a response starting with rsp.
+        This must be called before the request is written.
+
+        :returns: :obj:`PFxUSBWaiter` to wait on for the response
+        """
+        waiter = PFxUSBWaiter(rsp)
+        with self._cond:
+            if self._exc is not None:
+                raise self._exc
+            waiters = self._waiters.setdefault(rsp, deque())
+            if any(w.cancelled for w in waiters):
+                self._cond.wait_for(
+                    lambda: not any(w.cancelled for w in waiters),
+                    PFX_USB_STALE_TIMEOUT,
+                )
+                # late responses which have not arrived by now are lost
+                for w in [w for w in waiters if w.cancelled]:
+                    waiters.remove(w)
+            waiters.append(waiter)
+            self._order.append(waiter)
+        return waiter
+
+    def cancel(self, waiter):
+        """
+        Withdraws a waiter whose caller gave up waiting.  A late response for
+        it will be discarded rather than given to another request.
+
+        :returns: True if the waiter was withdrawn, False if it has already completed
+        """
+        with self._lock:
+            if waiter.event.is_set() or waiter not in self._order:
+                return False
+            self._order.remove(waiter)
+            waiter.cancelled = True
+        return True
+
+    def stop(self):
+        """Stops the reader thread and waits for it to finish."""
+        self._stop_flag = True
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        while not self._stop_flag:
+            try:
+                res = self.hdev.read(64, PFX_USB_READER_POLL_MS)
+            except (IOError, OSError, ValueError) as e:
+                if not self._stop_flag:
+                    self._log.error("USB read failed: %s" % (e))
+                    self._fail_all(e)
+                break
+            if res:
+                self._dispatch(res)
+        self._fail_all(InvalidResponseException("USB reader stopped"))
+
+    def _dispatch(self, res):
+        if res[0] == PFX_MSG_NOTIFICATION:
+            if self.callback is not None:
+                try:
+                    self.callback(res)
+                except Exception as e:
+                    self._log.error("Notification callback failed: %s" % (e))
+            return
+        with self._cond:
+            waiters = self._waiters.get(res[0])
+            if waiters and waiters[0].cancelled:
+                # the late response to a request which has timed out
+                waiters.popleft()
+                self._cond.notify_all()
+                return
+            if waiters:
+                waiter = waiters.popleft()
+                self._order.remove(waiter)
+            elif self._order:
+                # a response nobody asked for fails the oldest request
+                waiter = self._order.popleft()
+                self._waiters[waiter.rsp].remove(waiter)
+                waiter.set_exception(InvalidResponseException())
+                return
+            else:
+                self._log.warning("Unexpected USB message 0x%02X" % (res[0]))
+                return
+        waiter.set_result(res)
+
+    def _fail_all(self, exc):
+        with self._lock:
+            self._exc = exc
+            waiters = list(self._order)
+            self._order.clear()
+            self._waiters.clear()
+        for waiter in waiters:
+            waiter.set_exception(exc)
+
+
+class PFxUSBTransport(PFxTransport):
+    """
+    ICD message transport over a USB HID device handle.
+
+    The transport owns the reusable :obj:`PFxUSBFrame` report buffer and the
+    optional :obj:`PFxUSBReader` background thread of the device handle.
+    Batches of messages are pipelined with up to depth requests in flight.
+
+    Every response is waited for at most timeout seconds, or longer for file
+    system requests which erase flash memory, and a
+    :obj:`USBResponseTimeoutException` is raised if it does not arrive.
+    Idempotent queries such as `PFX_CMD_GET_STATUS` are sent again up to
+    retries times after a timeout.  A tighter deadline can be applied to a
+    group of transactions with :obj:`deadline`.
+
+    :obj:`close` may be called from another thread, e.g. when the device is
+    detached, and waits for calls still using the handle to return.  Later
+    calls raise :obj:`IOError`.
+
+    :param hdev: USB HID session handle
+    :param depth: :obj:`int` maximum number of outstanding pipelined requests
+    :param timeout: :obj:`float` seconds to wait for each response, None waits forever
+    :param retries: :obj:`int` number of times an idempotent query is retried after a timeout
+    """
+
+    def __init__(
+        self,
+        hdev,
+        depth=PFX_USB_PIPELINE_DEPTH,
+        timeout=PFX_USB_TIMEOUT,
+        retries=PFX_USB_RETRIES,
+    ):
+        self.hdev = hdev
+        self.depth = depth
+        self.timeout = timeout
+        self.retries = retries
+        self.frame = PFxUSBFrame()
+        self._reader = None
+        self._local = threading.local()
+        self._stale = deque(maxlen=PFX_USB_PIPELINE_DEPTH * 4)
+        self._users = 0
+        self._closed = False
+        self._idle = threading.Condition()
+        self._log = logging.getLogger(str(self.__class__))
+
+    @property
+    def hdev(self):
+        """The USB HID session handle, or None once a weakly held handle is gone."""
+        if isinstance(self._hdev, weakref.ref):
+            return self._hdev()
+        return self._hdev
+
+    @hdev.setter
+    def hdev(self, hdev):
+        self._hdev = hdev
+
+    @contextlib.contextmanager
+    def deadline(self, timeout):
+        """
+        Context manager which requires every transaction made by the calling
+        thread inside the with block to complete within timeout seconds in
+        total, e.g. to keep the cycle time of a control loop::
+
+            with transport.deadline(0.05):
+                brick.get_current_state()
+
+        :param timeout: :obj:`float` seconds from now
+        """
+        prev = getattr(self._local, "deadline", None)
+        t = time.monotonic() + timeout
+        if prev is not None:
+            t = min(t, prev)
+        self._local.deadline = t
+        try:
+            yield
+        finally:
+            self._local.deadline = prev
+
+    @contextlib.contextmanager
+    def _in_use(self):
+        # counts the calls using the handle so that close, e.g. from a
+        # hotplug watcher thread, waits for them rather than closing the
+        # handle under a read or write
+        with self._idle:
+            if self._closed:
+                raise IOError("The USB session is closed")
+            self._users += 1
+        try:
+            yield
+        finally:
+            with self._idle:
+                self._users -= 1
+                self._idle.notify_all()
+
+    def _wait_time(self, msg, timeout=None):
+        # returns seconds to wait for the response to msg, or None to wait forever
+        if timeout is None:
+            timeout = self.timeout
+            if timeout is not None and msg[0] in _USB_SLOW_TIMEOUTS:
+                timeout = max(timeout, _USB_SLOW_TIMEOUTS[msg[0]])
+        deadline = getattr(self._local, "deadline", None)
+        if deadline is not None:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise USBResponseTimeoutException("Transaction deadline expired")
+            timeout = left if timeout is None else min(timeout, left)
+        return timeout
+
+    def _read(self, timeout):
+        if timeout is None:
+            return self.hdev.read(64)
+        res = self.hdev.read(64, max(int(timeout * 1000), 1))
+        if not res:
+            raise USBResponseTimeoutException()
+        return res
+
+    def _drain(self):
+        # discards late responses still queued by the device
+        while self.hdev.read(64, 1):
+            pass
+
+    def _mark_stale(self, msgs):
+        # Records the requests in msgs, each (msg, wait), whose responses
+        # were given up on.  A late response is waited for before the next
+        # request for up to twice the wait, bounded by the transport timeout.
+        now = time.monotonic()
+        for msg, wait in msgs:
+            if msg[0] == PFX_CMD_FILE_WRITE_FAST:
+                continue
+            if wait is None or (self.timeout is not None and wait > self.timeout):
+                wait = self.timeout if self.timeout is not None else 0
+            grace = max(2 * wait, PFX_USB_STALE_TIMEOUT)
+            self._stale.append((msg[0] | 0x80, now + grace))
+
+    def _drop_stale(self, res, expected=()):
+        # Returns True if res is the late response to a request which was
+        # given up on.  The PFx Brick answers in order, so the requests given
+        # up on before it will not be answered any more.  A response with
+        # the command byte of an expected response is only taken as late
+        # while its request is still waited for, since it may have been lost.
+        now = time.monotonic()
+        for i, (rsp, expiry) in enumerate(self._stale):
+            if res[0] == rsp and (rsp not in expected or expiry > now):
+                for _ in range(i + 1):
+                    self._stale.popleft()
+                return True
+        return False
+
+    def _settle(self):
+        # Waits for the late responses to requests which were given up on
+        # before a new request is written, so that a late response is not
+        # taken as the response to a new request with the same command.
+        while True:
+            now = time.monotonic()
+            expiry = max((e for _, e in self._stale), default=now)
+            wait = expiry - now
+            deadline = getattr(self._local, "deadline", None)
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            if wait <= 0:
+                return
+            res = self.hdev.read(64, max(int(wait * 1000), 1))
+            if res and not self._drop_stale(res):
+                self._log.warning("Unexpected USB message 0x%02X" % (res[0]))
+
+    def is_idempotent(self, msg):
+        """Returns True if msg is a query which can safely be sent again."""
+        if msg[0] == PFX_CMD_FILE_DIR:
+            return len(msg) > 1 and msg[1] in _USB_IDEMPOTENT_DIR
+        return msg[0] in _USB_IDEMPOTENT
+
+    @property
+    def reader(self):
+        """The running background :obj:`PFxUSBReader` or None."""
+        if self._reader is not None and self._reader.is_alive():
+            return self._reader
+        return None
+
+    def start_reader(self, callback=None):
+        """
+        Starts a background :obj:`PFxUSBReader` if one is not already running.
+        An existing reader has its callback replaced.
+
+        :returns: the running :obj:`PFxUSBReader`
+        """
+        reader = self.reader
+        if reader is not None:
+            reader.callback = callback
+            return reader
+        self._reader = PFxUSBReader(self.hdev, callback)
+        self._reader.start()
+        return self._reader
+
+    def stop_reader(self):
+        """Stops the background reader, if any."""
+        reader, self._reader = self._reader, None
+        if reader is not None:
+            reader.stop()
+
+    def _write(self, msg):
+        # enforce non-numbered report pre-pending and report length
+        # This ensures consistent operation on Windows, macOS, etc.
+        # since Windows insists on matched report length/buffer size
+        # and for all non-numbered reports to start with 0
+        self.hdev.write(self.frame.pack(msg))
+
+    def _reader_write(self, reader, msg):
+        if msg[0] == PFX_CMD_FILE_WRITE_FAST:
+            waiter = None
+        else:
+            waiter = reader.expect(msg[0] | 0x80)
+        with reader.write_lock:
+            self._write(msg)
+        return waiter
+
+    def send(self, msg):
+        with self._in_use():
+            reader = self.reader
+            if reader is not None:
+                with reader.write_lock:
+                    self._write(msg)
+            else:
+                self._write(msg)
+
+    def receive(self, timeout=None):
+        if self.reader is not None:
+            raise RuntimeError("USB messages are being received by a background reader")
+        if timeout is None:
+            timeout = self.timeout
+        with self._in_use():
+            return self._read(timeout)
+
+    def transact(self, msg, timeout=None):
+        """
+        Sends an ICD message and returns its validated response.
+
+        :param msg: [:obj:`int`] ICD message as an integer list of bytes
+        :param timeout: :obj:`float` optional seconds to wait for the response instead of the transport timeout
+        :returns: [:obj:`int`] response message
+        :raises: :obj:`USBResponseTimeoutException` if no response arrives in time
+        :raises: :obj:`InvalidResponseException` if the response does not match the request
+        """
+        retries = self.retries if self.is_idempotent(msg) else 0
+        with self._in_use():
+            while True:
+                try:
+                    return self._transact(msg, timeout)
+                except USBResponseTimeoutException:
+                    deadline = getattr(self._local, "deadline", None)
+                    if retries <= 0 or (
+                        deadline is not None and deadline <= time.monotonic()
+                    ):
+                        raise
+                    retries -= 1
+                    self._log.warning(
+                        "Retrying ICD message 0x%02X after timeout" % (msg[0])
+                    )
+
+    def _transact(self, msg, timeout):
+        reader = self.reader
+        if reader is not None:
+            wait = self._wait_time(msg, timeout)
+            waiter = self._reader_write(reader, msg)
+            if waiter is None:
+                return _USB_FAST_WRITE_RESPONSE
+            return self._wait(reader, waiter, wait)
+        self._settle()
+        if msg[0] == PFX_CMD_FILE_WRITE_FAST:
+            self._write(msg)
+            return _USB_FAST_WRITE_RESPONSE
+        wait = self._wait_time(msg, timeout)
+        self._write(msg)
+        end = time.monotonic() + wait if wait is not None else None
+        while True:
+            try:
+                res = self._read(end - time.monotonic() if end is not None else None)
+            except USBResponseTimeoutException:
+                self._mark_stale([(msg, wait)])
+                raise
+            if not res:
+                return 0
+            if self._drop_stale(res, (msg[0] | 0x80,)):
+                continue
+            if res[0] == msg[0] | 0x80:
+                # every request given up on before has been answered or lost
+                self._stale.clear()
+                return res
+            self._mark_stale([(msg, wait)])
+            raise InvalidResponseException()
+
+    def _wait(self, reader, waiter, timeout):
+        try:
+            return waiter.wait(timeout)
+        except USBResponseTimeoutException:
+            if not reader.cancel(waiter):
+                return waiter.wait()
+            raise
+
+    def batch(self, msgs, depth=None):
+        """
+        Sends a sequence of ICD messages with several requests in flight at once.
+
+        Up to depth messages are written before waiting for a response. Each
+        response is matched to the oldest outstanding request with the same
+        command byte, i.e. ``msg[0] | 0x80``, so that the PFx Brick is kept busy
+        rather than idling for a full USB round trip per message.
+
+        :param msgs: a list of ICD messages, each an integer list of bytes
+        :param depth: :obj:`int` maximum number of outstanding requests, defaults to the transport depth
+        :returns: a list of responses in the same order as msgs
+        :raises: :obj:`USBResponseTimeoutException` if a response does not arrive in time
+        """
+        with self._in_use():
+            return self._batch(msgs, depth)
+
+    def _batch(self, msgs, depth):
+        depth = max(depth if depth is not None else self.depth, 1)
+        results = [None] * len(msgs)
+        pending = deque()
+        reader = self.reader
+        if reader is not None:
+            try:
+                for idx, msg in enumerate(msgs):
+                    while len(pending) >= depth:
+                        pidx, pmsg, waiter = pending.popleft()
+                        results[pidx] = self._wait(
+                            reader, waiter, self._wait_time(pmsg)
+                        )
+                    waiter = self._reader_write(reader, msg)
+                    if waiter is None:
+                        results[idx] = _USB_FAST_WRITE_RESPONSE
+                    else:
+                        pending.append((idx, msg, waiter))
+                while pending:
+                    pidx, pmsg, waiter = pending.popleft()
+                    results[pidx] = self._wait(reader, waiter, self._wait_time(pmsg))
+            except Exception:
+                for _, _, waiter in pending:
+                    reader.cancel(waiter)
+                raise
+            return results
+        self._settle()
+        try:
+            for idx, msg in enumerate(msgs):
+                while len(pending) >= depth:
+                    self._pipeline_receive(pending, results)
+                self._write(msg)
+                if msg[0] == PFX_CMD_FILE_WRITE_FAST:
+                    results[idx] = _USB_FAST_WRITE_RESPONSE
+                else:
+                    pending.append((idx, msg))
+            while pending:
+                self._pipeline_receive(pending, results)
+        except Exception:
+            # the responses still in flight are discarded when they arrive
+            self._mark_stale([(msg, None) for _, msg in pending])
+            raise
+        return results
+
+    def _pipeline_receive(self, pending, results):
+        res = self._read(self._wait_time(pending[0][1]))
+        if not res:
+            idx, _ = pending.popleft()
+            results[idx] = 0
+            return
+        if self._drop_stale(res, [msg[0] | 0x80 for _, msg in pending]):
+            return
+        for i, (idx, msg) in enumerate(pending):
+            if res[0] == msg[0] | 0x80:
+                del pending[i]
+                results[idx] = res
+                return
+        raise InvalidResponseException()
+
+    def drain(self):
+        # the background reader drops late responses to cancelled requests itself
+        if self.reader is None:
+            with self._in_use():
+                self._settle()
+                self._drain()
+
+    def close(self):
+        with self._idle:
+            if self._closed:
+                return
+            self._closed = True
+            self._idle.wait_for(lambda: self._users == 0)
+        self.stop_reader()
+        hdev = self.hdev
+        if hdev is not None:
+            _usb_transports.pop(hdev, None)
+            hdev.close()
+
+
+class PFxBLETransport(PFxTransport):
+    """
+    ICD message transport over the Bluetooth UART link of a :obj:`PFxBrickBLE`.
+
+    Every method is a co-routine.  The Bluetooth UART link only supports a
+    single outstanding request, so batches are sent one message at a time.
+
+    :param brick: the :obj:`PFxBrickBLE` session which owns the link
+    """
+
+    def __init__(self, brick):
+        self.brick = brick
+
+    async def send(self, msg):
+        await self.brick._tx_write(self.brick.ble_wrap(msg))
+
+    async def receive(self):
+        await self.brick._rx_wait()
+        return self.brick._rxbuff
+
+    async def transact(self, msg):
+        return await self.brick.ble_transaction(msg)
+
+    async def batch(self, msgs):
+        return await self.brick.ble_batch_transaction(msgs)
+
+    async def close(self):
+        await self.brick.close()
+
+
+# session log file header and per-transaction record header:
+# seconds since the start of the log, response time in microseconds,
+# request length and response length, followed by the request and response bytes
+PFX_LOG_MAGIC = b"PFXLOG\x01\x00"
+_LOG_RECORD = struct.Struct("<dIBB")
+
+
+class PFxLogRecord:
+    """
+    One ICD transaction in a session log.
+
+    Attributes:
+        t (:obj:`float`): seconds since the start of the log when the request was sent
+
+        duration (:obj:`float`): seconds taken for the response
+
+        request (:obj:`bytes`): request message
+
+        response (:obj:`bytes`): response message, empty if there was no response
+    """
+
+    __slots__ = ("t", "duration", "request", "response")
+
+    def __init__(self, t, duration, request, response):
+        self.t = t
+        self.duration = duration
+        self.request = request
+        self.response = response
+
+
+def read_session_log(fn):
+    """
+    Reads a session log written by :obj:`PFxRecordingTransport`.
+
+    :param fn: :obj:`str` filename of the log
+    :returns: [:obj:`PFxLogRecord`] transactions in the order they were recorded
+    """
+    with open(fn, "rb") as f:
+        data = f.read()
+    if not data.startswith(PFX_LOG_MAGIC):
+        raise ValueError("%s is not a PFx Brick session log" % (fn))
+    records = []
+    idx = len(PFX_LOG_MAGIC)
+    while idx + _LOG_RECORD.size <= len(data):
+        t, dur, nreq, nrsp = _LOG_RECORD.unpack_from(data, idx)
+        idx += _LOG_RECORD.size
+        req = data[idx : idx + nreq]
+        rsp = data[idx + nreq : idx + nreq + nrsp]
+        idx += nreq + nrsp
+        records.append(PFxLogRecord(t, dur / 1e6, req, rsp))
+    return records
+
+
+class PFxRecordingTransport(PFxTransport):
+    """
+    Transport wrapper which records every transaction of another transport
+    to a compact binary session log.
+
+    Each record holds a monotonic timestamp, the response time, the request
+    bytes and the response bytes.  Messages in a batch share the batch
+    timestamp and an equal share of its response time.  A log can be played
+    back with :obj:`PFxReplayTransport`.  Other attributes, e.g.
+    ``start_reader``, are forwarded to the wrapped transport.
+
+    :param transport: the :obj:`PFxTransport` to record
+    :param fn: :obj:`str` filename of the session log to write
+    """
+
+    def __init__(self, transport, fn):
+        self.transport = transport
+        self._f = open(fn, "wb")
+        self._f.write(PFX_LOG_MAGIC)
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic()
+
+    def __getattr__(self, name):
+        if name == "transport":
+            raise AttributeError(name)
+        return getattr(self.transport, name)
+
+    def _record(self, t, duration, msg, res):
+        if not res or msg[0] == PFX_CMD_FILE_WRITE_FAST:
+            res = b""
+        with self._lock:
+            self._f.write(
+                _LOG_RECORD.pack(t - self._t0, int(duration * 1e6), len(msg), len(res))
+            )
+            self._f.write(bytes(msg))
+            self._f.write(bytes(res))
+
+    def send(self, msg):
+        self.transport.send(msg)
+
+    def receive(self):
+        return self.transport.receive()
+
+    def transact(self, msg):
+        t = time.monotonic()
+        res = self.transport.transact(msg)
+        self._record(t, time.monotonic() - t, msg, res)
+        return res
+
+    def batch(self, msgs):
+        t = time.monotonic()
+        results = self.transport.batch(msgs)
+        duration = (time.monotonic() - t) / max(len(msgs), 1)
+        for msg, res in zip(msgs, results):
+            self._record(t, duration, msg, res)
+        return results
+
+    def close(self):
+        with self._lock:
+            if not self._f.closed:
+                self._f.close()
+        self.transport.close()
+
+
+class PFxReplayTransport(PFxTransport):
+    """
+    Transport which plays back a session log recorded by
+    :obj:`PFxRecordingTransport` without a PFx Brick attached.
+
+    Each request is checked against the next recorded request and answered
+    with the recorded response.  With realtime enabled, every response is
+    delayed by its recorded response time so that the PFx Brick side of the
+    original session is reproduced while the host side runs at its own pace.
+    Otherwise responses are returned as fast as possible.
+
+    :param fn: :obj:`str` filename of the session log to play back
+    :param realtime: :obj:`boolean` reproduce the recorded response times
+    :raises: :obj:`ReplayMismatchException` if a request differs from the log
+    """
+
+    product_string = "PFx Brick session replay"
+
+    def __init__(self, fn, realtime=False):
+        self.records = read_session_log(fn)
+        self.realtime = realtime
+        self._idx = 0
+        self._rx = deque()
+
+    @property
+    def remaining(self):
+        """Number of recorded transactions which have not been played back."""
+        return len(self.records) - self._idx
+
+    def transact(self, msg):
+        if self._idx >= len(self.records):
+            raise ReplayMismatchException("Session log has no more transactions")
+        rec = self.records[self._idx]
+        if bytes(msg) != rec.request:
+            raise ReplayMismatchException(
+                "Request %d differs from the session log" % (self._idx)
+            )
+        self._idx += 1
+        if self.realtime and rec.duration > 0:
+            time.sleep(rec.duration)
+        if msg[0] == PFX_CMD_FILE_WRITE_FAST:
+            return _USB_FAST_WRITE_RESPONSE
+        if not rec.response:
+            return 0
+        return list(rec.response)
+
+    def send(self, msg):
+        res = self.transact(msg)
+        if msg[0] != PFX_CMD_FILE_WRITE_FAST:
+            self._rx.append(res)
+
+    def receive(self):
+        if self._rx:
+            return self._rx.popleft()
+        return []
+
+
+_usb_transports = weakref.WeakKeyDictionary()
+
+
+def usb_transport(hdev):
+    """Returns the :obj:`PFxUSBTransport` for a USB HID device handle."""
+    transport = _usb_transports.get(hdev)
+    if transport is None:
+        transport = PFxUSBTransport(hdev)
+        # the registry must not keep the handle alive through its transport
+        transport.hdev = weakref.ref(hdev)
+        _usb_transports[hdev] = transport
+    return transport
+
+
+def get_transport(hdev):
+    """
+    Returns the :obj:`PFxTransport` which carries ICD messages for a session handle.
+
+    :param hdev: a :obj:`PFxTransport`, a USB HID device handle, or a session object with a ``transport`` attribute such as :obj:`PFxBrickBLE`
+    :returns: :obj:`PFxTransport`
+    """
+    if isinstance(hdev, PFxTransport):
+        return hdev
+    if isinstance(hdev, hid.device):
+        return usb_transport(hdev)
+    transport = getattr(hdev, "transport", None)
+    if transport is None:
+        raise TypeError("%s is not a PFx Brick ICD transport" % (type(hdev).__name__))
+    return transport
@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+"""
+pfxbackup - save an image of the PFx Brick flash memory and archive its files
+"""
+import argparse
+import os
+
+from pfxbrick import *
+
+
+def full_path(file):
+    """Returns the fully expanded path of a file"""
+    if "~" in str(file):
+        return os.path.expanduser(file)
+    return os.path.expanduser(os.path.abspath(file))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="save an image of the PFx Brick flash memory and archive its files",
+        prefix_chars="-+",
+    )
+    parser.add_argument(
+        "image",
+        metavar="image",
+        type=str,
+        nargs="?",
+        default=None,
+        help="is the image file to create or resume (default is <serial number>.img)",
+    )
+    parser.add_argument(
+        "-a",
+        "--archive",
+        action="store_true",
+        default=False,
+        help="Also save the files in a compact archive for the PFx Brick serial number",
+    )
+    parser.add_argument(
+        "-d",
+        "--dir",
+        default=None,
+        help="Archive directory (default is %s)" % (default_archive_dir()),
+    )
+    parser.add_argument(
+        "-f",
+        "--full",
+        action="store_true",
+        default=False,
+        help="Read every flash sector, including sectors which are free",
+    )
+    parser.add_argument(
+        "-s",
+        "--serialno",
+        default=None,
+        help="Specify PFx Brick with serial number (if more than one connected)",
+    )
+    args = parser.parse_args()
+    argsd = vars(args)
+
+    b = get_one_pfxbrick(argsd["serialno"])
+    r = b.open()
+    if not r:
+        exit()
+    fn = argsd["image"]
+    if fn is None:
+        fn = "%s.img" % (b.serial_no)
+    fn = full_path(fn)
+    print("Reading PFx Brick flash memory into %s..." % (fn))
+    with snapshot_flash(b, fn, skip_free=not argsd["full"]) as image:
+        if argsd["archive"]:
+            afn = save_flash_archive(image, argsd["dir"])
+            print("Saved %d files to %s" % (len(image.files), afn))
+    b.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,9 @@
 pfxcat - print the contens of a file on the PFx Brick
 """
 import argparse
-import tempfile
-from sys import argv
 
 from pfxbrick import *
 
-TMP_FILE = tempfile.gettempdir() + os.sep + "pfxdump.dat"
-
 
 def main():
     parser = argparse.ArgumentParser(
@@ -19,6 +15,20 @@ def main():
     parser.add_argument(
         "file", metavar="file", type=str, help="file name or file ID to show contents"
     )
+    parser.add_argument(
+        "-x",
+        "--hex",
+        action="store_true",
+        default=False,
+        help="Show the file contents as a hex dump",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache",
+        action="store_true",
+        default=False,
+        help="Use files previously copied from any PFx Brick from a local cache",
+    )
     parser.add_argument(
         "-s",
         "--serialno",
@@ -32,21 +42,27 @@ def main():
     r = b.open()
     if not r:
         exit()
+    if argsd["cache"]:
+        b.enable_file_cache()
     b.refresh_file_dir()
     f = argsd["file"]
     if f.isnumeric():
         fid = int(f)
     else:
         fid = b.file_id_from_str_or_int(f)
-    as_bytes = True if len(argv) == 3 else False
+    as_bytes = argsd["hex"]
     fd = b.filedir.get_file_dir_entry(fid)
     if fd is not None:
-        fs_copy_file_from(
-            b, fd, TMP_FILE, show_progress=False, as_bytes=as_bytes, to_console=True
-        )
-        os.remove(TMP_FILE)
+        # print each chunk as soon as it arrives rather than after the whole file
+        address = 0
+        for chunk in fs_read_file_chunks(b, fd):
+            if as_bytes:
+                pprint_bytes(chunk, address=address)
+            else:
+                print(chunk.decode("latin-1"), end="", flush=True)
+            address += len(chunk)
     else:
-        print("File %s not found" % (argv[1]))
+        print("File %s not found" % (argsd["file"]))
     b.close()
 
 
@@ -0,0 +1,49 @@
+#! /usr/bin/env python3
+"""
+pfxdiff - show the differences between two PFx Brick flash images
+"""
+import argparse
+import os
+
+from pfxbrick import *
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="show the differences between two PFx Brick flash images",
+        prefix_chars="-+",
+    )
+    parser.add_argument(
+        "image1", metavar="image1", type=str, help="is the first flash image file"
+    )
+    parser.add_argument(
+        "image2", metavar="image2", type=str, help="is the second flash image file"
+    )
+    parser.add_argument(
+        "-c",
+        "--context",
+        type=int,
+        default=1,
+        help="Number of unchanged rows shown around changed rows (default 1)",
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        default=False,
+        help="Only show the changed sectors and files, not the changed bytes",
+    )
+    args = parser.parse_args()
+    argsd = vars(args)
+
+    with PFxFlashImage(
+        os.path.expanduser(argsd["image1"]), readonly=True
+    ) as a, PFxFlashImage(os.path.expanduser(argsd["image2"]), readonly=True) as b:
+        diff = diff_flash_images(a, b)
+        if not argsd["quiet"]:
+            diff.pprint(argsd["context"])
+        print(diff)
+
+
+if __name__ == "__main__":
+    main()
@@ -96,6 +96,7 @@ def main():
         for a in range(0x3C, 0x44):
             b.clear_action_by_address(a)
 
+    actions = b.get_actions(range(0x4C))
     al = 0
     ah = 0
     ac = 0
@@ -134,7 +135,7 @@ def main():
         if argsd["ir"]:
             add = ac
         evt, ch = address_to_evtch(add)
-        a = b.get_action_by_address(add)
+        a = actions[add]
         if argsd["raw"]:
             fmt = "0x%02X [blue]%2d[/blue] [blue](0x%02X)[/blue] [aquamarine3]%2d[/aquamarine3] : "
             ab = a.to_bytes()
@@ -15,6 +15,13 @@ def main():
         description="Dumps the contents of the PFx Brick file allocation table (FAT)",
         prefix_chars="-+",
     )
+    parser.add_argument(
+        "-a",
+        "--analyze",
+        action="store_true",
+        default=False,
+        help="Show the sector chain of each file and the fragmentation of the FAT",
+    )
     parser.add_argument(
         "-s",
         "--serialno",
@@ -28,8 +35,16 @@ def main():
     r = b.open()
     if not r:
         exit()
-    rb = flash_read(b, 0xFFC000, 8192)
+    fat = b.get_fat()
+    if argsd["analyze"]:
+        b.refresh_file_dir()
+        b.close()
+        for f, chain in fat.file_chains(b.filedir.files):
+            print("%3d %-24s %s" % (f.id, f.name, chain))
+        print(fat)
+        return
     b.close()
+    rb = fat.to_bytes()
     x = []
     for i in range(0, len(rb) - 1, 2):
         x.append(rb[i + 1])
@@ -19,6 +19,13 @@ def main():
         nargs="?",
         help="is optional local file path override for copied file",
     )
+    parser.add_argument(
+        "-c",
+        "--cache",
+        action="store_true",
+        default=False,
+        help="Use files previously copied from any PFx Brick from a local cache",
+    )
     parser.add_argument(
         "-s",
         "--serialno",
@@ -32,6 +39,8 @@ def main():
     r = b.open()
     if not r:
         exit()
+    if argsd["cache"]:
+        b.enable_file_cache()
     b.open()
     b.refresh_file_dir()
     f = str(argsd["file"])
@@ -0,0 +1,67 @@
+#! /usr/bin/env python3
+"""
+pfximage - inspect a PFx Brick flash image without a PFx Brick
+"""
+import argparse
+import os
+
+from pfxbrick import *
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="list, extract and check the files in a PFx Brick flash image",
+        prefix_chars="-+",
+    )
+    parser.add_argument(
+        "image", metavar="image", type=str, help="is the flash image file to inspect"
+    )
+    parser.add_argument(
+        "-x",
+        "--extract",
+        default=None,
+        help="Copy a file with file ID or filename from the image to the host",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="Local file path for an extracted file (default is its filename)",
+    )
+    parser.add_argument(
+        "-c",
+        "--check",
+        action="store_true",
+        default=False,
+        help="Check the CRC32 of every file and the file allocation table",
+    )
+    args = parser.parse_args()
+    argsd = vars(args)
+
+    with PFxFlashImage(os.path.expanduser(argsd["image"]), readonly=True) as image:
+        if argsd["extract"] is not None:
+            f = str(argsd["extract"])
+            if f.isnumeric():
+                f = int(f)
+            fd = image.get_file(f)
+            if fd is None:
+                print("File %s is not in the flash image" % (argsd["extract"]))
+                exit()
+            fn = argsd["output"] if argsd["output"] is not None else fd.name
+            print("Copying file %s as %s from flash image..." % (f, fn))
+            image.extract_file(fd, fn)
+        elif argsd["check"]:
+            print(image.check())
+        elif image.files:
+            for f in image.files:
+                print(str(f))
+            print("%d files" % (len(image.files)))
+        else:
+            fat = image.fat()
+            for first, chain in sorted(fat.chains.items()):
+                print(str(chain))
+            print(fat)
+
+
+if __name__ == "__main__":
+    main()
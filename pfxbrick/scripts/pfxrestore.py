@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+"""
+pfxrestore - restore the files of a flash image or archive to the PFx Brick
+"""
+import argparse
+import os
+
+from pfxbrick import *
+
+
+def full_path(file):
+    """Returns the fully expanded path of a file"""
+    if "~" in str(file):
+        return os.path.expanduser(file)
+    return os.path.expanduser(os.path.abspath(file))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="restore the files of a flash image or archive to the PFx Brick",
+        prefix_chars="-+",
+    )
+    parser.add_argument(
+        "source",
+        metavar="source",
+        type=str,
+        nargs="?",
+        default=None,
+        help="is the image or archive to restore (default is the latest archive of the PFx Brick)",
+    )
+    parser.add_argument(
+        "-d",
+        "--dir",
+        default=None,
+        help="Archive directory (default is %s)" % (default_archive_dir()),
+    )
+    parser.add_argument(
+        "-r",
+        "--remove",
+        action="store_true",
+        default=False,
+        help="Remove files on the PFx Brick which are not in the source",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        default=False,
+        help="Only show the files which would be copied or removed",
+    )
+    parser.add_argument(
+        "-s",
+        "--serialno",
+        default=None,
+        help="Specify PFx Brick with serial number (if more than one connected)",
+    )
+    args = parser.parse_args()
+    argsd = vars(args)
+
+    b = get_one_pfxbrick(argsd["serialno"])
+    r = b.open()
+    if not r:
+        exit()
+    source = argsd["source"]
+    if source is None:
+        archives = flash_archives(b.serial_no, argsd["dir"])
+        if not archives:
+            print("No archives of PFx Brick %s were found" % (b.serial_no))
+            b.close()
+            exit()
+        source = archives[-1]
+    source = full_path(source)
+    print("Restoring %s to PFx Brick..." % (source))
+    report = b.restore_files(
+        source,
+        remove_stale=argsd["remove"],
+        dry_run=argsd["dry_run"],
+    )
+    print(report)
+    b.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#! /usr/bin/env python3
+"""
+pfxsync - copy the new and changed files in a folder to the PFx Brick
+"""
+import argparse
+import os
+
+from pfxbrick import *
+
+
+def full_path(file):
+    """Returns the fully expanded path of a file"""
+    if "~" in str(file):
+        return os.path.expanduser(file)
+    return os.path.expanduser(os.path.abspath(file))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="copy new and changed files in a folder to the PFx Brick",
+        prefix_chars="-+",
+    )
+    parser.add_argument(
+        "folder", metavar="folder", type=str, help="is the local folder to copy"
+    )
+    parser.add_argument(
+        "-r",
+        "--remove",
+        action="store_true",
+        default=False,
+        help="Remove files on the PFx Brick which are not in the folder",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        default=False,
+        help="Only show the files which would be copied or removed",
+    )
+    parser.add_argument(
+        "-s",
+        "--serialno",
+        default=None,
+        help="Specify PFx Brick with serial number (if more than one connected)",
+    )
+    args = parser.parse_args()
+    argsd = vars(args)
+
+    b = get_one_pfxbrick(argsd["serialno"])
+    r = b.open()
+    if not r:
+        exit()
+    folder = full_path(argsd["folder"])
+    print("Synchronizing %s with PFx Brick..." % (folder))
+    try:
+        report = b.sync_dir(
+            folder,
+            remove_stale=argsd["remove"],
+            dry_run=argsd["dry_run"],
+        )
+    except FileSystemFullException as e:
+        print("Nothing was copied, the files do not fit: %s" % (e))
+        b.close()
+        exit()
+    print(report)
+    b.close()
+
+
+if __name__ == "__main__":
+    main()
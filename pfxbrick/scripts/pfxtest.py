@@ -47,12 +47,7 @@ def copy_script_file(brick, text):
     crc32 = get_file_crc32(file)
     console.log("Copying file [cyan]%s[/] with CRC32=0x%08X" % (fn, crc32))
     brick.put_file(file, fileID)
-    fcrc = 0
-    while fcrc == 0:
-        time.sleep(1)
-        brick.refresh_file_dir()
-        f0 = brick.filedir.get_file_dir_entry(fileID)
-        fcrc = f0.crc32
+    f0 = brick.wait_file_ready(fileID)
     test_result(
         "Copied file [cyan]%s[/] CRC32=0x%08X" % (fn, f0.crc32), f0.crc32 == crc32
     )
@@ -67,6 +67,11 @@ setuptools.setup(
             "pfxdir=pfxbrick.scripts.pfxdir:main",
             "pfxget=pfxbrick.scripts.pfxget:main",
             "pfxput=pfxbrick.scripts.pfxput:main",
+            "pfxsync=pfxbrick.scripts.pfxsync:main",
+            "pfxbackup=pfxbrick.scripts.pfxbackup:main",
+            "pfxrestore=pfxbrick.scripts.pfxrestore:main",
+            "pfximage=pfxbrick.scripts.pfximage:main",
+            "pfxdiff=pfxbrick.scripts.pfxdiff:main",
             "pfxrm=pfxbrick.scripts.pfxrm:main",
             "pfxrename=pfxbrick.scripts.pfxrename:main",
             "pfxdump=pfxbrick.scripts.pfxdump:main",
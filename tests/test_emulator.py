@@ -0,0 +1,692 @@
+# system modules
+import asyncio
+import concurrent.futures
+import io
+import os
+import time
+import zlib
+
+import pytest
+
+# my modules
+from pfxbrick import *
+from pfxbrick.pfxfiles import PFX_FILE_WRITE_WINDOW
+from pfxbrick.pfxhelpers import uint32_toint
+
+
+def _open_virtual(**kwargs):
+    vb = PFxVirtualBrick(**kwargs)
+    b = PFxBrick()
+    assert b.open(transport=vb)
+    return b, vb
+
+
+def test_virtual_status():
+    b, vb = _open_virtual(serial_no="1234ABCD", name="Loco")
+    assert b.serial_no == "1234ABCD"
+    assert b.product_id == "A216"
+    assert b.product_desc.rstrip("\0") == PFX_PFXBRICK_16MB_DESC
+    assert b.icd_rev == "03.39"
+    assert b.has_bluetooth
+    assert b.usb_prod_str == PFX_PFXBRICK_16MB_DESC
+    assert b.get_name() == "Loco"
+    b.set_name("Crocodile")
+    assert b.get_name() == "Crocodile"
+    b.close()
+
+
+def test_virtual_config_and_actions():
+    b, vb = _open_virtual()
+    b.get_config()
+    b.config.audio.defaultVolume = 77
+    b.config.lights.startupBrightness[6] = 12
+    b.config.settings.notchCount = 5
+    b.set_config()
+    b.config = PFxConfig()
+    b.get_config()
+    assert b.config.audio.defaultVolume == 77
+    assert b.config.lights.startupBrightness[6] == 12
+    assert b.config.settings.notchCount == 5
+    assert b.get_current_state().volume == 77
+    b.set_action(0x10, 2, PFxAction().light_on([1, 3]))
+    a = b.get_action(0x10, 2)
+    assert a.lightOutputMask == PFxAction().light_on([1, 3]).lightOutputMask
+    actions = b.get_actions([0x42, 0x43])
+    assert actions[0].lightOutputMask == a.lightOutputMask
+    assert actions[1].command == 0
+    b.reset_factory_config()
+    b.get_config()
+    assert b.config.audio.defaultVolume != 77
+
+
+def test_virtual_file_system(tmp_path):
+    b, vb = _open_virtual()
+    data = os.urandom(10000)
+    fn = tmp_path / "chuff.wav"
+    fn.write_bytes(data)
+    b.put_file(str(fn), show_progress=False)
+    b.refresh_file_dir()
+    assert b.filedir.numFiles == 1
+    f = b.filedir.files[0]
+    assert f.name == "chuff.wav"
+    assert f.size == 10000
+    assert f.crc32 == zlib.crc32(data)
+    assert vb.file_data(f.id) == data
+    assert b.filedir.bytesLeft + 3 * PFX_FLASH_SECTOR_SZ == vb.capacity()
+    assert b.file_id_from_str_or_int("chuff.wav") == f.id
+    b.rename_file(f.id, "horn.wav")
+    b.set_file_attributes(f.id, 0x08)
+    b.refresh_file_dir()
+    assert b.filedir.files[0].name == "horn.wav"
+    assert b.filedir.files[0].attributes == 0x0800
+    out = tmp_path / "copy.wav"
+    b.get_file(f.id, str(out), show_progress=False)
+    assert out.read_bytes() == data
+    # file contents are laid out in flash sectors chained in the FAT
+    first = f.firstSector * PFX_FLASH_SECTOR_SZ
+    assert bytes(flash_read(b, first, 100)) == data[:100]
+    fat = flash_read(b, vb.fat_addr + 2 * f.firstSector, 6)
+    assert fat[0] | (fat[1] << 8) == f.firstSector + 1
+    assert fat[4] | (fat[5] << 8) == PFX_FAT_SECTOR_LAST
+    b.remove_file(f.id)
+    b.refresh_file_dir()
+    assert b.filedir.numFiles == 0
+    assert b.get_fs_state().free_sectors == len(vb.free_sectors())
+    vb.add_file(3, "a.txt", b"hello")
+    b.format_fs()
+    b.refresh_file_dir()
+    assert b.filedir.numFiles == 0
+
+
+def test_virtual_slow_icd_write():
+    b, vb = _open_virtual(icd_rev="3.38")
+    fs_copy_file_to(b, 7, "x.txt", show_progress=False, with_bytes=b"abc" * 50)
+    assert vb.file_data(7) == b"abc" * 50
+    assert vb.files[7].name == "x.txt"
+
+
+def test_windowed_file_write(tmp_path):
+    b, vb = _open_virtual()
+    data = os.urandom(5000)
+    fn = tmp_path / "sound.wav"
+    fn.write_bytes(data)
+    fs_copy_file_to(b, 9, str(fn), show_progress=False)
+    assert vb.file_data(9) == data
+    b.remove_file(9)
+    counts = []
+    vb.process([PFX_CMD_FILE_OPEN, 9, 0x06, *uint32_to_bytes(len(data))])
+    n = fs_write_file_data(b, 9, data, len(data), window=8, callback=counts.append)
+    assert n == len(data)
+    assert counts[0] == 7 * 62 + 61
+    assert counts[-1] == len(data)
+    vb.process([PFX_CMD_FILE_CLOSE, 9])
+    assert vb.file_data(9) == data
+    assert fs_write_file_data(b, 10, data, len(data)) == 0
+
+
+class GlitchyBrick(PFxVirtualBrick):
+    def __init__(self, fail_at, can_seek=True, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_at = fail_at
+        self.can_seek = can_seek
+        self.writes = 0
+        self.opens = 0
+
+    def send(self, msg):
+        if msg[0] in (PFX_CMD_FILE_WRITE, PFX_CMD_FILE_WRITE_FAST):
+            self.writes += 1
+            if self.writes in self.fail_at:
+                raise USBResponseTimeoutException()
+        elif msg[0] == PFX_CMD_FILE_OPEN:
+            self.opens += 1
+        super().send(msg)
+
+    def process(self, msg):
+        if msg[0] == PFX_CMD_FILE_SEEK and not self.can_seek:
+            return [msg[0] | 0x80, PFX_ERR_FILE_INVALID] + [0] * 62
+        return super().process(msg)
+
+
+def test_resumable_file_write():
+    data = os.urandom(20000)
+    vb = GlitchyBrick(fail_at=[100, 200])
+    b = PFxBrick()
+    b.open(transport=vb)
+    fs_copy_file_to(b, 3, "horn.wav", show_progress=False, with_bytes=data)
+    assert vb.file_data(3) == data
+    assert vb.opens == 1
+    # only the unconfirmed windows are sent again
+    assert vb.writes < len(data) // 62 + 3 * PFX_FILE_WRITE_WINDOW
+
+    vb = GlitchyBrick(fail_at=[100], can_seek=False)
+    b = PFxBrick()
+    b.open(transport=vb)
+    fs_copy_file_to(b, 3, "horn.wav", show_progress=False, with_bytes=data)
+    assert vb.file_data(3) == data
+    assert vb.opens == 2
+    assert list(vb.files) == [3]
+
+    vb = GlitchyBrick(fail_at=range(100, 200))
+    b = PFxBrick()
+    b.open(transport=vb)
+    with pytest.raises(USBResponseTimeoutException):
+        fs_copy_file_to(b, 3, "horn.wav", show_progress=False, with_bytes=data)
+    assert not vb.files
+
+
+def test_sync_dir(tmp_path):
+    b, vb = _open_virtual()
+    horn, bell = os.urandom(3000), os.urandom(1000)
+    vb.add_file(1, "horn.wav", horn)
+    vb.add_file(2, "bell.wav", b"old")
+    vb.add_file(3, "stale.wav", b"stale")
+    (tmp_path / "horn.wav").write_bytes(horn)
+    (tmp_path / "bell.wav").write_bytes(bell)
+    (tmp_path / "chuff.wav").write_bytes(b"chuff")
+    report = b.sync_dir(str(tmp_path), show_progress=False, dry_run=True)
+    assert report.uploaded == ["bell.wav", "chuff.wav"]
+    assert vb.file_data(2) == b"old"
+    report = b.sync_dir(str(tmp_path), remove_stale=True, show_progress=False)
+    assert report.unchanged == ["horn.wav"]
+    assert report.uploaded == ["bell.wav", "chuff.wav"]
+    assert report.removed == ["stale.wav"]
+    assert report.bytes_saved == 3000
+    assert report.bytes_uploaded == 1005
+    assert vb.file_data(2) == bell
+    assert sorted(vb.files) == [0, 1, 2]
+    assert b.sync_dir(str(tmp_path), show_progress=False).bytes_saved == 4005
+
+
+def test_sync_dir_failed_upload(tmp_path, capsys):
+    b, vb = _open_virtual()
+    bell = os.urandom(1000)
+    (tmp_path / "bell.wav").write_bytes(bell)
+    (tmp_path / "chuff.wav").write_bytes(b"chuff")
+    process = vb.process
+
+    def failing_process(msg):
+        # chuff.wav cannot be opened for writing
+        if msg[0] == PFX_CMD_FILE_OPEN and bytes(msg[7:12]) == b"chuff":
+            return [msg[0] | 0x80, PFX_ERR_FILE_INVALID] + [0] * 62
+        return process(msg)
+
+    vb.process = failing_process
+    report = b.sync_dir(str(tmp_path), show_progress=False)
+    assert report.uploaded == ["bell.wav"]
+    assert report.failed == ["chuff.wav"]
+    assert report.bytes_uploaded == 1000
+    assert "1 failed" in str(report)
+    assert [f.name for f in b.filedir.files] == ["bell.wav"]
+    vb.process = process
+    report = b.sync_dir(str(tmp_path), show_progress=False)
+    assert (report.uploaded, report.unchanged) == (["chuff.wav"], ["bell.wav"])
+    assert report.failed == []
+
+
+def test_upload_plan(tmp_path):
+    b, vb = _open_virtual(flash_size=28 * PFX_FLASH_SECTOR_SZ)
+    vb.add_file(1, "a.wav", os.urandom(8 * PFX_FLASH_SECTOR_SZ))
+    vb.add_file(2, "b.wav", os.urandom(4 * PFX_FLASH_SECTOR_SZ))
+    vb.add_file(3, "keep.wav", os.urandom(4 * PFX_FLASH_SECTOR_SZ))
+    (tmp_path / "big.wav").write_bytes(os.urandom(14 * PFX_FLASH_SECTOR_SZ))
+    (tmp_path / "b.wav").write_bytes(os.urandom(2 * PFX_FLASH_SECTOR_SZ - 10))
+    (tmp_path / "small.wav").write_bytes(b"small")
+    fns = [str(tmp_path / name) for name in ("small.wav", "b.wav", "big.wav")]
+    plan = b.plan_upload(fns)
+    assert (plan.sectors_needed, plan.sectors_free, plan.sectors_freed) == (17, 12, 4)
+    assert b.get_fat().free_sectors == 12
+    assert not plan.fits
+    assert plan.shortfall == PFX_FLASH_SECTOR_SZ
+    b.enable_transaction_stats()
+    with pytest.raises(FileSystemFullException):
+        b.sync_dir(str(tmp_path), show_progress=False)
+    assert PFX_CMD_FILE_OPEN not in b.get_transaction_stats().commands
+    # only the larger of the removable files is removed
+    plan = b.plan_upload(fns, removable=["a.wav", 3])
+    assert plan.fits
+    assert [f.name for f in plan.removals] == ["a.wav"]
+    assert [(os.path.basename(fn), fid) for fn, fid in plan.uploads] == [
+        ("b.wav", 2),
+        ("big.wav", 0),
+        ("small.wav", 1),
+    ]
+    report = b.sync_dir(str(tmp_path), show_progress=False, removable=["a.wav", 3])
+    assert report.removed == ["a.wav"]
+    assert sorted(vb.files) == [0, 1, 2, 3]
+    assert len(vb.free_sectors()) == 12 + 12 - 17
+
+
+def test_upload_plan_shrinks_replacements_first(tmp_path):
+    b, vb = _open_virtual(flash_size=16 * PFX_FLASH_SECTOR_SZ)
+    vb.add_file(1, "a.wav", os.urandom(10 * PFX_FLASH_SECTOR_SZ))
+    free = len(vb.free_sectors())
+    (tmp_path / "a.wav").write_bytes(os.urandom(PFX_FLASH_SECTOR_SZ))
+    (tmp_path / "b.wav").write_bytes(os.urandom((free + 8) * PFX_FLASH_SECTOR_SZ))
+    plan = b.plan_upload([str(tmp_path / "a.wav"), str(tmp_path / "b.wav")])
+    assert plan.fits
+    assert [os.path.basename(fn) for fn, fid in plan.uploads] == ["a.wav", "b.wav"]
+    report = b.sync_dir(str(tmp_path), show_progress=False)
+    assert sorted(report.uploaded) == ["a.wav", "b.wav"]
+    assert vb.file_data(1) == (tmp_path / "a.wav").read_bytes()
+    assert len(vb.free_sectors()) == free + 10 - 1 - (free + 8)
+
+
+def test_file_cache(tmp_path):
+    b, vb = _open_virtual()
+    data = os.urandom(5000)
+    vb.add_file(6, "horn.wav", data)
+    vb.add_file(7, "bell.wav", os.urandom(3000))
+    b.enable_file_cache(path=str(tmp_path / "cache"), max_size=6000)
+    b.enable_transaction_stats()
+    out = tmp_path / "horn.wav"
+    b.get_file(6, str(out), show_progress=False)
+    reads = b.get_transaction_stats().commands[PFX_CMD_FILE_READ].count
+    b.get_file(6, str(out), show_progress=False)
+    assert out.read_bytes() == data
+    assert b.get_transaction_stats().commands[PFX_CMD_FILE_READ].count == reads
+    assert b.file_cache.hits == 1
+    # another brick with the same file is served from the cache
+    b2, vb2 = _open_virtual()
+    vb2.add_file(1, "horn.wav", data)
+    b2.file_cache = b.file_cache
+    b2.refresh_file_dir()
+    assert b"".join(fs_read_file_chunks(b2, b2.filedir.get_file_dir_entry(1))) == data
+    assert b.file_cache.hits == 2
+    # the least recently used file is evicted
+    b.get_file(7, str(tmp_path / "bell.wav"), show_progress=False)
+    f6, f7 = (b.filedir.get_file_dir_entry(fid) for fid in (6, 7))
+    assert (f6.crc32, f6.size) not in b.file_cache
+    assert (f7.crc32, f7.size) in b.file_cache
+    assert b.file_cache.total_size() == 3000
+    assert not b.file_cache.put(f6.crc32, f6.size, b"corrupt")
+
+
+def test_incremental_file_dir(tmp_path):
+    b, vb = _open_virtual()
+    vb.add_file(1, "horn.wav", os.urandom(5000))
+    fn = tmp_path / "bell.wav"
+    fn.write_bytes(os.urandom(9000))
+    b.refresh_file_dir()
+    b.enable_transaction_stats()
+    b.put_file(str(fn), 2, show_progress=False)
+    b.rename_file(2, "ding.wav")
+    b.set_file_attributes(2, 0x08)
+    assert b.filedir.get_file_dir_entry(2).name == "ding.wav"
+    assert b.filedir.get_file_dir_entry(2).attributes == 0x0800
+    assert b.filedir.bytesLeft == len(vb.free_sectors()) * PFX_FLASH_SECTOR_SZ
+    b.remove_file(1)
+    assert [f.id for f in b.filedir.files] == [2]
+    assert b.filedir.numFiles == 1
+    # only single entries were read
+    stats = b.get_transaction_stats()
+    assert stats.commands[PFX_CMD_FILE_DIR].count == 3 * 4 + 2
+    # a change made elsewhere is noticed and the whole directory is read
+    vb.add_file(7, "chuff.wav", b"chuff")
+    b.remove_file(2)
+    assert [f.id for f in b.filedir.files] == [7]
+
+
+def test_file_name_cache():
+    b, vb = _open_virtual()
+    vb.add_file(1, "horn.wav", b"horn")
+    vb.add_file(2, "bell.wav", b"bell")
+    b.enable_transaction_stats()
+    for _ in range(5):
+        assert b.file_id_from_str_or_int("horn.wav") == 1
+    assert b.file_id_from_str_or_int("chuff.wav") == 0xFF
+    assert b.get_transaction_stats().commands[PFX_CMD_FILE_DIR].count == 2
+    b.rename_file("horn.wav", "hoot.wav")
+    assert b.file_id_from_str_or_int("horn.wav") == 0xFF
+    assert b.file_id_from_str_or_int("hoot.wav") == 1
+    b.refresh_file_dir()
+    b.reset_transaction_stats()
+    assert b.file_id_from_str_or_int("bell.wav") == 2
+    assert b.get_transaction_stats().commands == {}
+    # a new session does not use the names cached from the previous one
+    b.close()
+    vb = PFxVirtualBrick()
+    vb.add_file(5, "bell.wav", b"bell")
+    assert b.open(transport=vb)
+    assert b.file_id_from_str_or_int("bell.wav") == 5
+
+
+def test_wait_file_ready():
+    b, vb = _open_virtual()
+    data = os.urandom(1000)
+    fs_copy_file_to(b, 4, "x.wav", show_progress=False, with_bytes=data)
+    crc = zlib.crc32(data)
+    assert b.wait_file_ready(4, crc).crc32 == crc
+    with pytest.raises(FileCRCMismatchException):
+        b.wait_file_ready("x.wav", crc ^ 1)
+    t0 = time.monotonic()
+    with pytest.raises(FileNotFoundError):
+        b.wait_file_ready("y.wav")
+    assert time.monotonic() - t0 < 0.5
+    vb.files[4].crc32 = 0
+    t0 = time.monotonic()
+    with pytest.raises(ResponseTimeoutException):
+        b.wait_file_ready(4, timeout=0.1)
+    assert time.monotonic() - t0 < 0.5
+
+
+def test_streaming_file_read(tmp_path):
+    b, vb = _open_virtual()
+    data = os.urandom(10000)
+    vb.add_file(4, "chuff.wav", data)
+    b.refresh_file_dir()
+    pfile = b.filedir.get_file_dir_entry(4)
+    chunks = list(fs_read_file_chunks(b, pfile))
+    assert [len(c) for c in chunks] == [3968, 3968, 2064]
+    assert b"".join(chunks) == data
+    assert not vb._open
+    out = io.BytesIO()
+    assert b.get_file(4, dest=out, show_progress=False) == len(data)
+    assert out.getvalue() == data
+    buf = bytearray(len(data))
+    fs_copy_file_from(b, pfile, show_progress=False, dest=buf)
+    assert buf == data
+    assert fs_copy_file_from(b, pfile, show_progress=False, as_bytes=True) == data
+    fn = tmp_path / "chuff.wav"
+    assert fs_copy_file_from(b, pfile, str(fn), show_progress=False) == data
+    assert fn.read_bytes() == data
+    fn.unlink()
+    assert b.get_file(4, str(fn), show_progress=False) == len(data)
+    assert fn.read_bytes() == data
+    gen = fs_read_file_chunks(b, pfile, window=2)
+    assert next(gen) == data[:124]
+    gen.close()
+    assert not vb._open
+
+
+def test_flash_snapshot_and_restore(tmp_path):
+    b, vb = _open_virtual(serial_no="1234ABCD")
+    horn, bell = os.urandom(9000), os.urandom(100)
+    vb.add_file(1, "horn.wav", horn, attributes=0x0080)
+    vb.add_file(2, "bell.wav", bell)
+    vb.files[2].userData1 = 0x1234
+    fn = str(tmp_path / "brick.img")
+
+    def interrupt(n, total):
+        if n >= 2 * PFX_FLASH_SECTOR_SZ:
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        snapshot_flash(b, fn, show_progress=False, callback=interrupt)
+    b.enable_transaction_stats()
+    with snapshot_flash(b, fn, show_progress=False) as image:
+        # only the file allocation table, the two file sectors not yet read
+        # and the two reserved sectors below the table are read again
+        reads = b.get_transaction_stats().commands[PFX_CMD_READ_FLASH].count
+        assert reads == (PFX_FLASH_FAT_SZ + 59) // 60 + 4 * 69
+        assert image.read_file(image.files[0]) == horn
+        assert image.data[0 : len(vb.flash)] == vb.flash
+        archive = save_flash_archive(image, str(tmp_path / "archives"))
+    assert flash_archives("1234ABCD", str(tmp_path / "archives")) == [archive]
+
+    b2, vb2 = _open_virtual()
+    vb2.add_file(2, "bell.wav", bell)
+    vb2.add_file(9, "stale.wav", b"stale")
+    report = b2.restore_files(archive, remove_stale=True, show_progress=False)
+    assert report.uploaded == ["horn.wav"]
+    assert report.unchanged == ["bell.wav"]
+    assert report.removed == ["stale.wav"]
+    assert vb2.file_data(1) == horn
+    assert vb2.files[1].attributes == 0x0080
+    assert b2.filedir.get_file_dir_entry(2).userData1 == 0x1234
+    assert sorted(vb2.files) == [1, 2]
+
+
+def test_flash_image_size(tmp_path):
+    fn = str(tmp_path / "brick.img")
+    with PFxFlashImage(fn, PFX_FLASH_SECTOR_SZ) as image:
+        image.mark_sector(0)
+    with pytest.raises(ValueError):
+        PFxFlashImage(fn, 2 * PFX_FLASH_SECTOR_SZ)
+    with PFxFlashImage(fn) as image:
+        assert image.size == PFX_FLASH_SECTOR_SZ
+        image.reset(2 * PFX_FLASH_SECTOR_SZ)
+        assert image.missing_sectors([0, 1]) == [0, 1]
+        image.data[-1] = 1
+    assert os.path.getsize(fn) == 2 * PFX_FLASH_SECTOR_SZ
+    # a snapshot over an image of another size starts again at the flash size
+    b, vb = _open_virtual()
+    horn = os.urandom(9000)
+    vb.add_file(1, "horn.wav", horn)
+    with snapshot_flash(b, fn, show_progress=False) as image:
+        assert image.size == PFX_PFXBRICK_16MB_FLASH_SZ
+        assert image.read_file(image.files[0]) == horn
+
+
+def test_flash_read_failure(tmp_path):
+    b, vb = _open_virtual()
+    horn = os.urandom(9000)
+    vb.add_file(1, "horn.wav", horn)
+    process = vb.process
+    bad = {PFX_FLASH_SECTOR_SZ}
+
+    def lossy_process(msg):
+        # no response to reads from the bad sector
+        if msg[0] == PFX_CMD_READ_FLASH and uint32_toint(msg[1:5]) in bad:
+            return None
+        return process(msg)
+
+    vb.process = lossy_process
+    with pytest.raises(FlashReadException):
+        flash_read(b, PFX_FLASH_SECTOR_SZ, 100)
+    fn = str(tmp_path / "brick.img")
+    with pytest.raises(FlashReadException):
+        snapshot_flash(b, fn, show_progress=False)
+    bad.clear()
+    with snapshot_flash(b, fn, show_progress=False) as image:
+        assert image.has_sector(1)
+        assert image.read_file(image.files[0]) == horn
+
+
+def test_flash_image_check(tmp_path):
+    b, vb = _open_virtual()
+    horn = os.urandom(9000)
+    vb.add_file(1, "horn.wav", horn)
+    vb.add_file(2, "bell.wav", os.urandom(100))
+    vb.add_file(3, "chuff.wav", os.urandom(100))
+    b.refresh_file_dir()
+    files = b.filedir.files
+    # a raw dump of the flash memory with a few file system errors
+    vb._set_fat_entry(1, 3)
+    vb._set_fat_entry(10, PFX_FAT_SECTOR_LAST)
+    vb.flash[6 * PFX_FLASH_SECTOR_SZ + 7] = 0
+    fn = tmp_path / "dump.img"
+    fn.write_bytes(vb.flash)
+    with PFxFlashImage(str(fn), readonly=True) as image:
+        assert image.files == []
+        assert image.check().orphaned == []
+        image.files = files
+        assert image.read_file(image.get_file("chuff.wav")) == vb.file_data(3)
+        with pytest.raises(FileCRCMismatchException):
+            image.extract_file(image.get_file(1), str(tmp_path / "horn.wav"))
+        assert not (tmp_path / "horn.wav").exists()
+        report = image.check()
+    assert not report.ok
+    assert report.files_checked == 3
+    assert [f.id for f, _ in report.crc_errors] == [1]
+    assert [f.id for f in report.cross_linked[3]] == [1, 2]
+    assert report.orphaned == [2, 10]
+    assert report.not_erased == [6]
+    assert not os.path.exists(str(fn) + ".json")
+
+
+def test_fat_fragmentation():
+    b, vb = _open_virtual()
+    vb.add_file(1, "a.wav", os.urandom(2 * PFX_FLASH_SECTOR_SZ))
+    vb.add_file(2, "b.wav", os.urandom(PFX_FLASH_SECTOR_SZ))
+    vb.add_file(3, "c.wav", os.urandom(PFX_FLASH_SECTOR_SZ))
+    fat = b.get_fat()
+    assert fat.fragmentation() == 0.0
+    assert fat.free_runs == [(4, vb.fat_addr // PFX_FLASH_SECTOR_SZ - 4)]
+    assert fat.markers[PFX_FAT_SECTOR_RESERVED] == 4
+    b.remove_file(2)
+    # the new file fills the hole left by b.wav before continuing after c.wav
+    vb.add_file(4, "d.wav", os.urandom(3 * PFX_FLASH_SECTOR_SZ))
+    fat = b.get_fat()
+    assert sorted(fat.chains) == [0, 2, 3]
+    assert fat.chains[2].sectors == [2, 4, 5]
+    assert fat.chains[2].fragments == 2
+    assert fat.chains[2].complete
+    assert fat.fragmentation() == 1 / 3
+    b.refresh_file_dir()
+    chains = dict((f.id, c) for f, c in fat.file_chains(b.filedir.files))
+    assert len(chains[4]) == 3 and len(chains[1]) == 2
+    assert fat.largest_free_extent() == (6, fat.free_sectors)
+    assert fat.fits_contiguous(fat.free_sectors * PFX_FLASH_SECTOR_SZ)
+    assert not fat.fits((fat.free_sectors + 1) * PFX_FLASH_SECTOR_SZ)
+    assert fat.needs_reformat()
+    assert fat.needs_reformat(PFX_FLASH_SECTOR_SZ)
+    assert not fat.needs_reformat((fat.free_sectors + 1) * PFX_FLASH_SECTOR_SZ)
+    assert not fat.needs_reformat(PFX_FLASH_SECTOR_SZ, threshold=0.5)
+    assert fat.to_bytes() == bytes(vb.flash[vb.fat_addr : vb.fat_addr + 8192])
+
+
+def test_async_brick():
+    vb = PFxVirtualBrick(name="Async")
+    send = vb.send
+    active = []
+    overlap = []
+
+    def checked_send(msg):
+        # a method call of another task must not be in progress
+        overlap.append(len(active))
+        active.append(msg)
+        time.sleep(0.001)
+        send(msg)
+        active.pop()
+
+    vb.send = checked_send
+
+    async def run():
+        executor = concurrent.futures.ThreadPoolExecutor(4)
+        ab = AsyncPFxBrick(executor=executor)
+        assert await ab.open(transport=vb)
+        names = await asyncio.gather(*[ab.get_name() for _ in range(8)])
+        await asyncio.gather(*[ab.get_status() for _ in range(4)])
+        assert names == ["Async"] * 8
+        assert ab.serial_no == vb.serial_no
+        await ab.close()
+        assert not ab.is_open
+        executor.shutdown()
+
+    asyncio.run(run())
+    assert overlap and max(overlap) == 0
+
+
+def test_async_auto_reopen():
+    async def run():
+        ab = AsyncPFxBrick()
+        assert await ab.open(transport=PFxVirtualBrick())
+        watcher = PFxHotplugWatcher(registry=PFxBrickRegistry())
+        ab.set_auto_reopen(watcher=watcher)
+        assert ab.brick._watcher is watcher
+        assert len(watcher._listeners) == 1
+        await ab.close()
+        assert watcher._listeners == []
+
+    asyncio.run(run())
+
+
+def test_virtual_latency():
+    b, vb = _open_virtual(latency=0.01)
+    t0 = time.monotonic()
+    b.get_status()
+    b.get_name()
+    assert time.monotonic() - t0 >= 0.02
+
+
+def test_record_and_replay(tmp_path):
+    log = str(tmp_path / "session.pfxlog")
+    vb = PFxVirtualBrick(latency=0.002)
+    vb.add_file(1, "horn.wav", os.urandom(3000))
+    vb.add_file(2, "bell.wav", os.urandom(500))
+    b = PFxBrick()
+    b.open(transport=vb, record=log)
+    b.refresh_file_dir()
+    fs_copy_file_to(b, 5, "x.txt", show_progress=False, with_bytes=b"xyz" * 30)
+    b.close()
+    records = read_session_log(log)
+    assert records[0].request[0] == PFX_CMD_GET_ICD_REV
+    assert all(r.duration > 0 for r in records if r.request[0] != 0x4C)
+    assert records[-1].request[0] == PFX_CMD_FILE_CLOSE
+
+    rt = PFxReplayTransport(log)
+    b2 = PFxBrick()
+    b2.open(transport=rt)
+    assert b2.serial_no == b.serial_no
+    b2.refresh_file_dir()
+    assert [f.name for f in b2.filedir.files] == ["horn.wav", "bell.wav"]
+    with pytest.raises(ReplayMismatchException):
+        b2.get_name()
+    fs_copy_file_to(b2, 5, "x.txt", show_progress=False, with_bytes=b"xyz" * 30)
+    assert rt.remaining == 0
+
+    rt = PFxReplayTransport(log, realtime=True)
+    t0 = time.monotonic()
+    PFxBrick().open(transport=rt)
+    assert time.monotonic() - t0 >= 2 * 0.002
+
+
+def test_transaction_stats():
+    b, vb = _open_virtual()
+    assert b.get_transaction_stats() is None
+    b.enable_transaction_stats()
+    b.get_status()
+    b.get_status()
+    fs_copy_file_to(b, 1, "a.txt", show_progress=False, with_bytes=bytes(200))
+    b.refresh_file_dir()
+    stats = b.get_transaction_stats()
+    s = stats.commands[PFX_CMD_GET_STATUS]
+    assert s.name == "GET_STATUS"
+    assert s.count == 2
+    assert s.bytes_out == 16
+    assert s.bytes_in == 128
+    assert sum(s.buckets) == 2
+    assert s.percentile(50) <= s.max_time
+    fw = stats.commands[PFX_CMD_FILE_WRITE_FAST]
+    assert fw.count == 3
+    assert stats.commands[PFX_CMD_FILE_WRITE].count == 1
+    assert fw.bytes_in == 0
+    assert stats.commands[PFX_CMD_FILE_DIR].count == 3
+    assert "FILE_WRITE_FAST" in str(stats)
+    b.get_status()
+    assert stats.commands[PFX_CMD_GET_STATUS].count == 2
+    b.reset_transaction_stats()
+    assert b.get_transaction_stats().commands == {}
+    b.enable_transaction_stats(False)
+    b.get_status()
+    assert b.get_transaction_stats() is None
+
+
+def test_flash_image_diff(tmp_path):
+    b, vb = _open_virtual()
+    vb.add_file(1, "horn.wav", os.urandom(9000))
+    vb.add_file(2, "bell.wav", os.urandom(100))
+    b.refresh_file_dir()
+    files = list(b.filedir.files)
+    before = bytes(vb.flash)
+    assert diff_flash_images(before, bytes(vb.flash)).ranges == []
+    b.remove_file(2)
+    vb.add_file(3, "chuff.wav", os.urandom(5000))
+    vb.flash[0x40] ^= 0xFF
+    vb.flash[0x60] ^= 0xFF
+    fn = tmp_path / "before.img"
+    fn.write_bytes(before)
+    with PFxFlashImage(str(fn), readonly=True) as image:
+        image.files = files
+        diff = diff_flash_images(image, bytes(vb.flash))
+        assert diff.ranges[:2] == [(0x40, 0x41), (0x60, 0x61)]
+        assert diff.sectors[0] == 0 and 3 in diff.sectors
+        assert diff.owners[3] == ("bell.wav", "chain 0003")
+        assert diff.changed_files() == [
+            "bell.wav",
+            "chain 0000",
+            "chain 0003",
+            "horn.wav",
+        ]
+        assert diff.windows(context=1)[0] == (0x30, 0x80)
+        assert diff.windows(context=0)[:2] == [(0x40, 0x50), (0x60, 0x70)]
@@ -1,4 +1,5 @@
 # system modules
+import asyncio
 import math
 import os.path
 import sys
@@ -72,3 +73,127 @@ def test_conversions():
     s3 = "speed ch 3 left button"
     e3 = script_ir_mask_to_address(s3)
     assert e3 == EVT_8879_LEFT_BUTTON + 2
+
+
+def test_registry_caches_enumeration(monkeypatch):
+    calls = []
+
+    def fake_enumerate(vid=0, pid=0):
+        calls.append((vid, pid))
+        return [
+            {
+                "path": b"/dev/hidraw%d" % (i % 2),
+                "vendor_id": PFX_USB_VENDOR_ID,
+                "product_id": PFX_USB_PRODUCT_ID,
+                "serial_number": "0000000%d" % (i % 2),
+                "release_number": 0x100,
+                "manufacturer_string": "Fx Bricks",
+                "product_string": "PFx Brick 16 MB",
+                "usage_page": 0,
+                "usage": 0,
+                "interface_number": i,
+            }
+            for i in range(4)
+        ]
+
+    monkeypatch.setattr("hid.enumerate", fake_enumerate)
+    reg = PFxBrickRegistry(max_age=60)
+    assert reg.serials() == ["00000000", "00000001"]
+    assert reg.serials() == ["00000000", "00000001"]
+    assert len(calls) == 1
+    assert reg.get("00000001").path == b"/dev/hidraw1"
+    assert reg.get("DEADBEEF") is None
+    assert len(calls) == 2
+    reg.invalidate()
+    reg.devices()
+    assert len(calls) == 3
+    assert reg.serials(max_age=0) == ["00000000", "00000001"]
+    assert len(calls) == 4
+
+
+def test_hotplug_watcher_events(monkeypatch):
+    attached = ["00000001"]
+
+    def fake_enumerate(vid=0, pid=0):
+        return [
+            {
+                "path": b"/dev/hidraw%d" % (i),
+                "vendor_id": PFX_USB_VENDOR_ID,
+                "product_id": PFX_USB_PRODUCT_ID,
+                "serial_number": serial_no,
+                "release_number": 0x100,
+                "manufacturer_string": "Fx Bricks",
+                "product_string": "PFx Brick 16 MB",
+            }
+            for i, serial_no in enumerate(attached)
+        ]
+
+    monkeypatch.setattr("hid.enumerate", fake_enumerate)
+    monkeypatch.setattr("pfxbrick.pfxregistry._HIDRAW_DIR", "/nonexistent")
+    events = []
+    watcher = PFxHotplugWatcher(
+        callback=lambda event, serial_no: events.append((event, serial_no)),
+        registry=PFxBrickRegistry(),
+    )
+    assert watcher.serials == ["00000001"]
+    attached.append("00000002")
+    assert watcher.check() == (["00000002"], [])
+    attached.remove("00000001")
+    watcher.check()
+    assert events == [
+        (PFX_HOTPLUG_ATTACH, "00000002"),
+        (PFX_HOTPLUG_DETACH, "00000001"),
+    ]
+    assert watcher.serials == ["00000002"]
+
+
+def test_dir_index():
+    d = PFxDir()
+    assert d.find_available_file_id() == 0
+    for fid, name in [(0, "horn.wav"), (1, "bell.wav"), (3, "chuff.wav")]:
+        f = PFxFile()
+        f.id, f.name = fid, name
+        d.files.append(f)
+    assert d.get_file_dir_entry(3).name == "chuff.wav"
+    assert d.get_filename(1) == "bell.wav"
+    assert d.get_file_dir_entry_by_name("horn.wav").id == 0
+    assert d.has_file("bell.wav") and d.has_file(3) and not d.has_file(2)
+    assert d.find_available_file_id() == 2
+    d.files.remove(d.get_file_dir_entry(1))
+    assert d.find_available_file_id() == 1
+    assert not d.has_file("bell.wav")
+    # entries sharing an ID or name are found in list order as they change
+    dup = PFxFile()
+    dup.id, dup.name = 3, "horn.wav"
+    d.files.insert(0, dup)
+    assert d.get_file_dir_entry(3) is dup
+    assert d.get_file_dir_entry_by_name("horn.wav") is dup
+    del d.files[0]
+    assert d.get_file_dir_entry(3).name == "chuff.wav"
+    assert d.get_file_dir_entry_by_name("horn.wav").id == 0
+    d.files[0] = dup
+    assert d.get_file_dir_entry(0) is None
+    assert d.find_available_file_id() == 0
+    assert d.get_file_dir_entry_by_name("horn.wav") is dup
+    assert d.files.pop() is not dup
+    assert d.get_file_dir_entry(3) is dup
+    assert d.find_available_file_id() == 0
+    d.files.remove(dup)
+    assert d.files == [] and not d.has_file(3) and not d.has_file("horn.wav")
+    d.files = [PFxFile() for _ in range(255)]
+    for i, f in enumerate(d.files):
+        f.id = i
+    d.reindex()
+    assert d.find_available_file_id() is None
+
+
+def test_ble_file_system_methods():
+    b = PFxBrickBLE(uuid="00:11:22:33:44:55")
+    for coro in (
+        b.get_fat(),
+        b.wait_file_ready(1),
+        b.sync_dir("."),
+        b.restore_files("brick.img"),
+    ):
+        with pytest.raises(NotImplementedError):
+            asyncio.run(coro)
@@ -0,0 +1,293 @@
+# system modules
+import gc
+import queue
+import threading
+import time
+import weakref
+
+import pytest
+
+# my modules
+from pfxbrick import *
+from pfxbrick.pfxmsg import (usb_frame, usb_pipelined_transaction, usb_reader,
+                             usb_start_reader, usb_stop_reader,
+                             usb_transaction)
+
+
+class FakeHID:
+    """Answers each request only after several are in flight, out of order by command."""
+
+    def __init__(self):
+        self.written = []
+        self.responses = []
+
+    def write(self, buf):
+        assert len(buf) == 65
+        self.written.append(list(buf))
+        msg = buf[1:]
+        if msg[0] != PFX_CMD_FILE_WRITE_FAST:
+            self.responses.append([msg[0] | 0x80, msg[2]] + [0] * 62)
+
+    def read(self, n, timeout_ms=0):
+        # reply to file dir requests before event action requests
+        for i, r in enumerate(self.responses):
+            if r[0] == PFX_CMD_FILE_DIR | 0x80:
+                return self.responses.pop(i)
+        return self.responses.pop(0) if self.responses else []
+
+
+def test_pipelined_order():
+    h = FakeHID()
+    msgs = []
+    for i in range(10):
+        msgs.append([PFX_CMD_GET_EVENT_ACTION, 0, i])
+        msgs.append([PFX_CMD_FILE_DIR, PFX_DIR_REQ_GET_DIR_ENTRY_IDX, 100 + i])
+    res = usb_pipelined_transaction(h, msgs, depth=4)
+    assert len(res) == len(msgs)
+    for msg, r in zip(msgs, res):
+        assert r[0] == msg[0] | 0x80
+        assert r[1] == msg[2]
+    assert len(h.written) == len(msgs)
+    assert len(h.responses) == 0
+
+
+def test_pipelined_fast_write():
+    h = FakeHID()
+    msgs = [[PFX_CMD_FILE_WRITE_FAST, 2, 0xAA, 0x55], [PFX_CMD_GET_STATUS, 0, 7]]
+    res = usb_pipelined_transaction(h, msgs)
+    assert res[0][0] == PFX_CMD_FILE_WRITE_FAST | 0x80
+    assert res[1][1] == 7
+
+
+def test_pipelined_invalid_response():
+    h = FakeHID()
+    h.responses.append([0x7F] + [0] * 63)
+    h.read = lambda n, timeout_ms=0: h.responses.pop(0) if h.responses else []
+    with pytest.raises(InvalidResponseException):
+        usb_pipelined_transaction(h, [[PFX_CMD_GET_STATUS, 0, 0]])
+    # the response still in flight is discarded
+    res = usb_pipelined_transaction(h, [[PFX_CMD_GET_STATUS, 0, 5]])
+    assert res[0][1] == 5
+    assert h.responses == []
+
+
+def test_frame_reuse():
+    h = FakeHID()
+    frame = usb_frame(h)
+    assert usb_frame(h) is frame
+    buf = frame.pack([PFX_CMD_FILE_DIR, PFX_DIR_REQ_GET_DIR_ENTRY_IDX, 5, 6, 7])
+    assert len(buf) == 65
+    assert list(buf[:6]) == [
+        0,
+        PFX_CMD_FILE_DIR,
+        PFX_DIR_REQ_GET_DIR_ENTRY_IDX,
+        5,
+        6,
+        7,
+    ]
+    buf2 = frame.pack(bytes([PFX_CMD_GET_CONFIG]))
+    assert buf2 is buf
+    assert list(buf[:6]) == [0, PFX_CMD_GET_CONFIG, 0, 0, 0, 0]
+    assert not any(buf[2:])
+    with pytest.raises(ValueError):
+        frame.pack([0] * 65)
+
+
+class QueuedHID:
+    """Replies to each request from another thread via a queue."""
+
+    def __init__(self, notify_after=None):
+        self.rx = queue.Queue()
+        self.notify_after = notify_after
+
+    def write(self, buf):
+        msg = buf[1:]
+        if msg[0] == self.notify_after:
+            self.rx.put([PFX_MSG_NOTIFICATION, PFX_NOTIFICATION_MOTORA_STOP, 0])
+        if msg[0] != PFX_CMD_FILE_WRITE_FAST:
+            self.rx.put([msg[0] | 0x80, msg[2]] + [0] * 62)
+
+    def read(self, n, timeout_ms=0):
+        try:
+            return self.rx.get(timeout=timeout_ms / 1000)
+        except queue.Empty:
+            return []
+
+
+def test_reader_routes_responses_and_notifications():
+    h = QueuedHID(notify_after=PFX_CMD_GET_STATUS)
+    notes = []
+    reader = usb_start_reader(h, notes.append)
+    assert usb_reader(h) is reader
+    res = usb_transaction(h, [PFX_CMD_GET_STATUS, 0, 42])
+    assert res[1] == 42
+    msgs = [[PFX_CMD_GET_EVENT_ACTION, 0, i] for i in range(20)]
+    res = usb_pipelined_transaction(h, msgs, depth=4)
+    assert [r[1] for r in res] == list(range(20))
+    assert len(notes) == 1
+    assert notes[0][1] == PFX_NOTIFICATION_MOTORA_STOP
+    usb_stop_reader(h)
+    assert usb_reader(h) is None
+
+
+class EchoTransport(PFxTransport):
+    """Answers every request with its response byte followed by the request."""
+
+    def __init__(self):
+        self.rx = []
+
+    def send(self, msg):
+        if msg[0] != PFX_CMD_FILE_WRITE_FAST:
+            self.rx.append([msg[0] | 0x80] + list(msg[1:]))
+
+    def receive(self):
+        return self.rx.pop(0)
+
+
+def test_transport():
+    t = EchoTransport()
+    assert get_transport(t) is t
+    res = msg_transaction(t, [PFX_CMD_GET_NAME, 1, 2])
+    assert res == [PFX_CMD_GET_NAME | 0x80, 1, 2]
+    res = msg_batch_transaction(
+        t, [[PFX_CMD_GET_CONFIG], [PFX_CMD_FILE_WRITE_FAST, 1, 0], [PFX_CMD_GET_NAME]]
+    )
+    assert [r[0] for r in res] == [
+        PFX_CMD_GET_CONFIG | 0x80,
+        PFX_CMD_FILE_WRITE_FAST | 0x80,
+        PFX_CMD_GET_NAME | 0x80,
+    ]
+    t.rx.append([0x7F])
+    with pytest.raises(InvalidResponseException):
+        msg_transaction(t, [PFX_CMD_GET_STATUS])
+    h = FakeHID()
+    assert usb_transport(h) is usb_transport(h)
+    # the handle is not kept alive by its transport in the registry
+    ref = weakref.ref(h)
+    del h
+    gc.collect()
+    assert ref() is None
+    with pytest.raises(TypeError):
+        get_transport(object())
+
+
+class LossyHID(QueuedHID):
+    """Loses the responses to the first few requests."""
+
+    def __init__(self, lose=0):
+        super().__init__()
+        self.lose = lose
+        self.writes = 0
+
+    def write(self, buf):
+        self.writes += 1
+        if self.lose > 0:
+            self.lose -= 1
+            return
+        super().write(buf)
+
+
+def test_usb_timeout_and_retry():
+    h = LossyHID(lose=2)
+    t = PFxUSBTransport(h, timeout=0.01, retries=2)
+    res = t.transact([PFX_CMD_GET_STATUS, 0, 9])
+    assert res[1] == 9
+    assert h.writes == 3
+
+    h = LossyHID(lose=1)
+    t = PFxUSBTransport(h, timeout=0.01, retries=2)
+    with pytest.raises(USBResponseTimeoutException):
+        t.transact([PFX_CMD_SET_NAME, 0, 0])
+    assert h.writes == 1
+    assert isinstance(USBResponseTimeoutException(), ResponseTimeoutException)
+
+    h = LossyHID(lose=5)
+    t = PFxUSBTransport(h, timeout=None, retries=5)
+    with pytest.raises(USBResponseTimeoutException):
+        with t.deadline(0.03):
+            t.transact([PFX_CMD_GET_CURRENT_STATE, 0, 0])
+    with t.deadline(0):
+        with pytest.raises(USBResponseTimeoutException):
+            t.transact([PFX_CMD_GET_STATUS, 0, 0])
+
+
+class SlowHID(QueuedHID):
+    """Answers requests in order, the first few only after a delay."""
+
+    def __init__(self, delays=()):
+        super().__init__()
+        self.delays = list(delays)
+        self.requests = queue.Queue()
+        threading.Thread(target=self._answer, daemon=True).start()
+
+    def write(self, buf):
+        delay = self.delays.pop(0) if self.delays else 0
+        self.requests.put((delay, bytes(buf)))
+
+    def _answer(self):
+        while True:
+            delay, buf = self.requests.get()
+            time.sleep(delay)
+            QueuedHID.write(self, buf)
+
+
+def test_usb_timeout_discards_late_response():
+    h = SlowHID(delays=[0.05])
+    t = PFxUSBTransport(h, timeout=0.02, retries=1)
+    for i in range(1, 5):
+        assert t.transact([PFX_CMD_GET_CURRENT_STATE, 0, i])[1] == i
+    h.delays = [0.05]
+    with pytest.raises(USBResponseTimeoutException):
+        t.transact([PFX_CMD_SET_NAME, 0, 0])
+    assert t.transact([PFX_CMD_GET_STATUS, 0, 7])[1] == 7
+    assert t.transact([PFX_CMD_GET_STATUS, 0, 8])[1] == 8
+
+
+def test_usb_close_waits_for_transaction():
+    h = SlowHID(delays=[0.05])
+    h.close = lambda: events.append("close")
+    t = PFxUSBTransport(h, timeout=1)
+    events = []
+
+    def transact():
+        events.append(t.transact([PFX_CMD_GET_STATUS, 0, 3])[1])
+
+    owner = threading.Thread(target=transact)
+    owner.start()
+    time.sleep(0.01)
+    # e.g. a hotplug watcher closing the session while a response is awaited
+    t.close()
+    owner.join()
+    assert events == [3, "close"]
+    with pytest.raises(IOError):
+        t.transact([PFX_CMD_GET_STATUS, 0, 4])
+    t.close()
+    assert events == [3, "close"]
+
+
+def test_usb_reader_timeout_discards_late_response():
+    h = QueuedHID()
+    t = PFxUSBTransport(h, timeout=0.05)
+    t.start_reader()
+    waiter = t._reader_write(t.reader, [PFX_CMD_GET_NAME, 0, 1])
+    # the response is queued, but the caller gives up before it is read
+    assert t.reader.cancel(waiter) or waiter.event.is_set()
+    res = t.transact([PFX_CMD_GET_NAME, 0, 2])
+    assert res[1] == 2
+    t.stop_reader()
+
+
+def test_usb_reader_lost_response():
+    h = LossyHID(lose=1)
+    t = PFxUSBTransport(h, timeout=0.05, retries=0)
+    t.start_reader()
+    with pytest.raises(USBResponseTimeoutException):
+        t.transact([PFX_CMD_GET_STATUS, 0, 1])
+    # the response to the first request never arrives
+    for i in range(2, 5):
+        assert t.transact([PFX_CMD_GET_STATUS, 0, i])[1] == i
+    h.lose = 1
+    with pytest.raises(USBResponseTimeoutException):
+        t.batch([[PFX_CMD_GET_NAME, 0, 0]] * 3, depth=2)
+    assert t.transact([PFX_CMD_GET_NAME, 0, 5])[1] == 5
+    t.stop_reader()